@@ -0,0 +1,92 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from tasks import cancel_task
+
+# write-behind для last_activity: время активности копится в памяти
+# и пишется в бд одним пакетом раз в N секунд или при M пользователях
+
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "5"))   # секунды
+ACTIVITY_FLUSH_BATCH = int(os.getenv("ACTIVITY_FLUSH_BATCH", "500"))         # пользователей
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityTracker:
+    def __init__(self, save, interval=ACTIVITY_FLUSH_INTERVAL, max_batch=ACTIVITY_FLUSH_BATCH):
+        # save(batch) — корутина, пишет {telegram_id: datetime} в бд
+        self.save = save
+        self.interval = interval
+        self.max_batch = max_batch
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+        # метрики
+        self.flushes = 0
+        self.flushed_users = 0
+        self.last_batch_size = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    def record(self, user_id):
+        # время в UTC без tzinfo, как func.now() в sqlite
+        self._pending[user_id] = datetime.now(timezone.utc).replace(tzinfo=None)
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+            started = time.perf_counter()
+            try:
+                await self.save(batch)
+            except (Exception, asyncio.CancelledError) as e:
+                # возвращаем пакет, не затирая более свежие отметки
+                for user_id, ts in batch.items():
+                    self._pending.setdefault(user_id, ts)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                logger.warning("activity flush failed: %s", e)
+                return 0
+            elapsed = time.perf_counter() - started
+            self.flushes += 1
+            self.flushed_users += len(batch)
+            self.last_batch_size = len(batch)
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            return len(batch)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    # при остановке дописываем все, что накопилось
+    async def stop(self):
+        await cancel_task(self._task)
+        self._task = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            "pending": len(self._pending),
+            "flushes": self.flushes,
+            "flushed_users": self.flushed_users,
+            "last_batch_size": self.last_batch_size,
+            "last_flush_seconds": self.last_flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds
+        }
@@ -0,0 +1,160 @@
+import os
+import math
+import time
+import asyncio
+import logging
+from bisect import bisect_left, bisect_right, insort
+
+from tasks import cancel_task
+
+# движок ценовых алертов: для каждого коина пороги лежат в отсортированных списках,
+# поэтому на тике цены находятся только пересеченные пороги (бинарный поиск + срез),
+# а не перебираются все подписки
+
+ALERTS_CHECK_INTERVAL = float(os.getenv("ALERTS_CHECK_INTERVAL", "30"))   # секунды
+ALERTS_PER_USER = int(os.getenv("ALERTS_PER_USER", "20"))
+ALERTS_SYNC_OVERLAP = 100     # id перечитываются с запасом: в postgres транзакции коммитятся не по порядку id
+
+ABOVE = "above"
+BELOW = "below"
+
+logger = logging.getLogger(__name__)
+
+
+class ThresholdIndex:
+    def __init__(self):
+        self.above = []     # [(порог, alert_id)] по возрастанию; срабатывают при цене >= порога
+        self.below = []     # срабатывают при цене <= порога
+
+    def __len__(self):
+        return len(self.above) + len(self.below)
+
+    def add(self, direction, threshold, alert_id):
+        insort(self.above if direction == ABOVE else self.below, (threshold, alert_id))
+
+    def remove(self, direction, threshold, alert_id):
+        items = self.above if direction == ABOVE else self.below
+        i = bisect_left(items, (threshold, alert_id))
+        if i < len(items) and items[i] == (threshold, alert_id):
+            del items[i]
+
+    def pop_crossed(self, price):
+        """Убирает из индекса и возвращает id подписок, пороги которых пересекла цена."""
+        i = bisect_right(self.above, (price, math.inf))
+        j = bisect_left(self.below, (price, -math.inf))
+        crossed = [alert_id for _, alert_id in self.above[:i]] + [alert_id for _, alert_id in self.below[j:]]
+        del self.above[:i]
+        del self.below[j:]
+        return crossed
+
+
+class AlertEngine:
+    def __init__(self, load_alerts, deactivate_alerts, get_prices, on_trigger, interval=ALERTS_CHECK_INTERVAL):
+        # load_alerts(after_id) — активные подписки из бд с id больше after_id,
+        # deactivate_alerts(ids) — выключить сработавшие, возвращает id, выключенные этим вызовом,
+        # get_prices(coin_ids, currency) — словарь цен, on_trigger(alert, price) — уведомить пользователя
+        self.load_alerts = load_alerts
+        self.deactivate_alerts = deactivate_alerts
+        self.get_prices = get_prices
+        self.on_trigger = on_trigger
+        self.interval = interval
+        self._alerts = {}      # alert_id -> подписка
+        self._indexes = {}     # (coin_id, currency) -> ThresholdIndex
+        self._loaded_id = 0    # до какого id подписки уже прочитаны из бд
+        self._task = None
+        # метрики
+        self.checks = 0
+        self.triggered = 0
+        self.last_check_seconds = 0.0
+
+    def __len__(self):
+        return len(self._alerts)
+
+    # подхватываем подписки, созданные после прошлой загрузки (в том числе другими воркерами)
+    async def sync(self):
+        for alert in await self.load_alerts(max(0, self._loaded_id - ALERTS_SYNC_OVERLAP)):
+            self._loaded_id = max(self._loaded_id, alert.id)
+            self.add(alert)
+
+    def add(self, alert):
+        if alert.id in self._alerts:
+            return
+        self._alerts[alert.id] = alert
+        index = self._indexes.setdefault((alert.coin_id, alert.currency), ThresholdIndex())
+        index.add(alert.direction, alert.threshold, alert.id)
+
+    def remove(self, alert_id):
+        alert = self._alerts.pop(alert_id, None)
+        if alert is None:
+            return
+        key = (alert.coin_id, alert.currency)
+        index = self._indexes[key]
+        index.remove(alert.direction, alert.threshold, alert.id)
+        if not index:
+            del self._indexes[key]
+
+    def match(self, coin_id, currency, price):
+        """Сработавшие подписки по коину; они сразу убираются из движка."""
+        index = self._indexes.get((coin_id, currency))
+        if index is None or price is None:
+            return []
+        alerts = [self._alerts.pop(alert_id) for alert_id in index.pop_crossed(price)]
+        if not index:
+            del self._indexes[(coin_id, currency)]
+        return alerts
+
+    async def check(self):
+        started = time.perf_counter()
+        await self.sync()
+        by_currency = {}
+        for coin_id, currency in self._indexes:
+            by_currency.setdefault(currency, []).append(coin_id)
+
+        fired = []
+        for currency, coin_ids in by_currency.items():
+            try:
+                prices = await self.get_prices(coin_ids, currency)
+            except Exception as e:
+                logger.warning("alert prices for %s failed: %s", currency, e)
+                continue
+            for coin_id in coin_ids:
+                price = prices.get(coin_id)
+                fired.extend((alert, price) for alert in self.match(coin_id, currency, price))
+
+        claimed = set()
+        if fired:
+            try:
+                claimed = await self.deactivate_alerts([alert.id for alert, _ in fired])
+            except Exception:
+                # не получилось записать в бд: возвращаем подписки, проверим на следующем тике
+                for alert, _ in fired:
+                    self.add(alert)
+                raise
+            # не выключенные этим вызовом уже отключены пользователем или сработали в другом воркере
+            for alert, price in fired:
+                if alert.id in claimed:
+                    await self.on_trigger(alert, price)
+            self.triggered += len(claimed)
+        self.checks += 1
+        self.last_check_seconds = time.perf_counter() - started
+        return len(claimed)
+
+    async def run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                await self.check()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("alert check failed: %s", e)
+            await asyncio.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    async def start(self):
+        if self._task is None:
+            await self.sync()
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        await cancel_task(self._task)
+        self._task = None
@@ -0,0 +1,279 @@
+"""Нагрузочный прогон диспетчера на синтетических апдейтах.
+
+Запуск из src:  python -m benchmarks.dispatcher --updates 5000 --concurrency 200 --latency 0.05
+
+Телеграм подменяется фейковой сессией бота, CoinGecko — локальным aiohttp-сервером
+с настраиваемой задержкой, redis (--state redis) — локальным RESP-сервером из benchmarks.resp_server. Печатает пропускную способность, p50/p95/p99 времени
+обработки апдейта и задержку event loop.
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from datetime import datetime
+
+from aiohttp import web
+from aiogram import types
+from aiogram.methods import SendMessage, SendPhoto
+from aiogram.client.session.base import BaseSession
+
+from benchmarks.resp_server import RespServer
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+# заглушка сессии бота: отвечает на методы API без сети
+class FakeSession(BaseSession):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls += 1
+        if isinstance(method, (SendMessage, SendPhoto)):
+            photo = None
+            if isinstance(method, SendPhoto):
+                photo = [types.PhotoSize(file_id=f"photo-{self.calls}", file_unique_id="u", width=800, height=400)]
+            return types.Message(
+                message_id=self.calls,
+                date=datetime.now(),
+                chat=types.Chat(id=method.chat_id, type="private"),
+                text=getattr(method, "text", None),
+                photo=photo
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+COINS = {
+    "bitcoin": "btc", "ethereum": "eth", "tether": "usdt", "solana": "sol", "binancecoin": "bnb",
+    "dogecoin": "doge", "cardano": "ada", "tron": "trx"
+}
+
+
+# локальная замена CoinGecko с задержкой на каждый ответ
+def create_coingecko_stub(latency):
+    async def delay():
+        if latency:
+            await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+
+    async def simple_price(request):
+        await delay()
+        currency = request.query.get("vs_currencies", "usd")
+        ids = [i for i in request.query.get("ids", "").split(",") if i]
+        return web.json_response({i: {currency: round(random.uniform(1, 50000), 2)} for i in ids})
+
+    async def market_chart(request):
+        await delay()
+        days = int(request.query.get("days", "7"))
+        now = int(time.time() * 1000)
+        step = 3600 * 1000
+        points = days * 24
+        return web.json_response({"prices": [[now - (points - i) * step, 100 + random.random()] for i in range(points)]})
+
+    async def coin(request):
+        await delay()
+        coin_id = request.match_info["coin_id"]
+        return web.json_response({"id": coin_id, "description": {"en": f"{coin_id} description", "ru": f"описание {coin_id}"}})
+
+    async def coins_list(request):
+        await delay()
+        return web.json_response([
+            {"id": coin_id, "symbol": symbol, "name": coin_id.capitalize()}
+            for coin_id, symbol in COINS.items()
+        ])
+
+    app = web.Application()
+    app.router.add_get("/simple/price", simple_price)
+    app.router.add_get("/coins/{coin_id}/market_chart", market_chart)
+    app.router.add_get("/coins/list", coins_list)
+    app.router.add_get("/coins/{coin_id}", coin)
+    return app
+
+
+def make_user(user_id):
+    return types.User(id=user_id, is_bot=False, first_name=f"user{user_id}", username=f"user{user_id}")
+
+
+def message_update(update_id, user_id, text):
+    return types.Update(update_id=update_id, message=types.Message(
+        message_id=update_id,
+        date=datetime.now(),
+        chat=types.Chat(id=user_id, type="private"),
+        from_user=make_user(user_id),
+        text=text
+    ))
+
+
+def callback_update(update_id, user_id, data):
+    user = make_user(user_id)
+    return types.Update(update_id=update_id, callback_query=types.CallbackQuery(
+        id=str(update_id),
+        from_user=user,
+        chat_instance=str(user_id),
+        data=data,
+        message=types.Message(
+            message_id=update_id,
+            date=datetime.now(),
+            chat=types.Chat(id=user_id, type="private"),
+            from_user=user,
+            text="menu"
+        )
+    ))
+
+
+def inline_update(update_id, user_id, query):
+    return types.Update(update_id=update_id, inline_query=types.InlineQuery(
+        id=str(update_id),
+        from_user=make_user(user_id),
+        query=query,
+        offset=""
+    ))
+
+
+# инлайн-запросы приходят на каждое нажатие клавиши
+def typing(word):
+    return word[:random.randint(0, len(word))]
+
+
+# смесь апдейтов, похожая на реальный трафик
+SCENARIOS = [
+    (20, lambda: ("message", "/crypto")),
+    (10, lambda: ("message", f"/crypto {random.choice(['bitcoin solana', 'btc eth', 'doge ada trx', 'bitcoin sol'])}")),
+    (10, lambda: ("message", f"/calc {random.randint(100, 60000)} {random.randint(1, 100)} {random.randint(10, 1000)}")),
+    (10, lambda: ("callback", f"chart_{random.choice(['bitcoin', 'ethereum', 'solana', 'binancecoin', 'dogecoin'])}")),
+    (5, lambda: ("callback", f"chart_{random.choice(['bitcoin', 'cardano', 'tron'])}:{random.choice(['1d', '30d', '1y'])}")),
+    (5, lambda: ("message", f"/indicators {random.choice(['bitcoin', 'ethereum', 'solana bitcoin'])}")),
+    (10, lambda: ("callback", f"faq_q{random.randint(1, 4)}")),
+    (15, lambda: ("inline", typing(random.choice(['bitcoin', 'eth', 'solana', 'doge', 'tron'])))),
+    (5, lambda: ("callback", f"lang_{random.choice(['ru', 'en'])}")),
+    (10, lambda: ("message", "/menu")),
+    (5, lambda: ("message", "/start")),
+    (20, lambda: ("message", random.choice(["привет", "hello", "bye", "как дела?"]))),
+]
+
+
+def generate_updates(count, users):
+    weights = [w for w, _ in SCENARIOS]
+    makers = [m for _, m in SCENARIOS]
+    updates = []
+    for update_id in range(1, count + 1):
+        kind, payload = random.choices(makers, weights)[0]()
+        user_id = random.randint(1, users)
+        if kind == "message":
+            updates.append(message_update(update_id, user_id, payload))
+        elif kind == "inline":
+            updates.append(inline_update(update_id, user_id, payload))
+        else:
+            updates.append(callback_update(update_id, user_id, payload))
+    return updates
+
+
+# меряем, на сколько event loop опаздывает разбудить корутину
+async def monitor_loop_lag(samples, interval=0.01):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+async def run(args):
+    stub = web.AppRunner(create_coingecko_stub(args.latency))
+    await stub.setup()
+    site = web.TCPSite(stub, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    resp = None
+    if args.state == "redis":
+        resp = RespServer()
+        os.environ["STATE_URL"] = f"redis://127.0.0.1:{await resp.start()}/0"
+
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.environ.setdefault("TOKEN", "123456:bench")
+    os.environ["COINGECKO_URL"] = f"http://127.0.0.1:{port}"
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["LOG_FILE"] = os.path.join(workdir, "command_logs.jsonl")
+    os.environ["COINS_SNAPSHOT"] = os.path.join(workdir, "coins.json")
+    os.environ["COINGECKO_RATE_PER_MIN"] = str(args.rate)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import main
+
+    bot = main.create_bot()
+    session = FakeSession()
+    bot.session = session
+    dp = main.create_dispatcher()
+    await dp.emit_startup(bot=bot)
+
+    updates = generate_updates(args.updates, args.users)
+    # повторные доставки тех же апдейтов, как при таймауте вебхука
+    updates += random.sample(updates, int(len(updates) * args.redeliver))
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    errors = 0
+
+    async def feed(update):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    lag_samples = []
+    lag_task = asyncio.create_task(monitor_loop_lag(lag_samples))
+    started = time.perf_counter()
+    await asyncio.gather(*(feed(u) for u in updates))
+    elapsed = time.perf_counter() - started
+    lag_task.cancel()
+
+    await dp.emit_shutdown(bot=bot)
+    await stub.cleanup()
+    if resp is not None:
+        await resp.stop()
+
+    ms = 1000
+    print(f"updates:      {len(updates)} ({errors} errors), concurrency {args.concurrency}, "
+          f"upstream latency {args.latency * ms:.0f} ms")
+    print(f"throughput:   {len(updates) / elapsed:.1f} updates/s ({elapsed:.2f} s)")
+    print(f"latency:      p50 {percentile(latencies, 50) * ms:.1f} ms, p95 {percentile(latencies, 95) * ms:.1f} ms, "
+          f"p99 {percentile(latencies, 99) * ms:.1f} ms, max {max(latencies) * ms:.1f} ms")
+    print(f"loop lag:     p50 {percentile(lag_samples, 50) * ms:.1f} ms, p99 {percentile(lag_samples, 99) * ms:.1f} ms, "
+          f"max {max(lag_samples, default=0) * ms:.1f} ms")
+    print(f"bot api calls: {session.calls}, duplicate updates skipped: {main.update_dedup.duplicates}")
+    if resp is not None:
+        print(f"state:        redis stand-in, {resp.commands} commands")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test for the bot dispatcher")
+    parser.add_argument("--updates", type=int, default=5000, help="number of synthetic updates")
+    parser.add_argument("--users", type=int, default=500, help="number of distinct users")
+    parser.add_argument("--concurrency", type=int, default=100, help="updates processed at once")
+    parser.add_argument("--latency", type=float, default=0.05, help="CoinGecko stub latency, seconds")
+    parser.add_argument("--rate", type=float, default=1e6, help="CoinGecko request budget per minute")
+    parser.add_argument("--state", choices=["memory", "redis"], default="memory", help="shared state backend")
+    parser.add_argument("--redeliver", type=float, default=0.0, help="share of updates delivered twice")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    asyncio.run(run(args))
@@ -0,0 +1,125 @@
+"""Локальная замена redis для прогонов с общим состоянием (STATE_URL).
+
+Запуск из src:  python -m benchmarks.resp_server --port 6390
+
+Понимает протокол RESP и только те команды, которые использует бот: PING, GET, MGET, SET (EX/PX/NX/XX),
+DEL, INCR/INCRBY, EXPIRE/PEXPIRE, SELECT, CLIENT. Данные живут в памяти процесса.
+"""
+import time
+import asyncio
+import argparse
+
+
+class RespServer:
+    def __init__(self):
+        self._data = {}        # ключ -> (значение, истекает в или None)
+        self.commands = 0
+
+    def _get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    def _set(self, key, value, ttl=None, keep_ttl=False):
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        if keep_ttl and key in self._data:
+            expires_at = self._data[key][1]
+        self._data[key] = (value, expires_at)
+
+    def execute(self, name, args):
+        self.commands += 1
+        if name == b"PING":
+            return b"PONG"
+        if name in (b"SELECT", b"CLIENT"):
+            return b"OK"
+        if name == b"GET":
+            return self._get(args[0])
+        if name == b"MGET":
+            return [self._get(key) for key in args]
+        if name == b"SET":
+            key, value, options = args[0], args[1], [a.upper() for a in args[2:]]
+            ttl = None
+            for i, option in enumerate(options):
+                if option == b"EX":
+                    ttl = float(args[3 + i])
+                elif option == b"PX":
+                    ttl = float(args[3 + i]) / 1000
+            exists = self._get(key) is not None
+            if (b"NX" in options and exists) or (b"XX" in options and not exists):
+                return None
+            self._set(key, value, ttl)
+            return b"OK"
+        if name == b"DEL":
+            return sum(self._data.pop(key, None) is not None for key in args)
+        if name in (b"INCR", b"INCRBY"):
+            value = int(self._get(args[0]) or 0) + (int(args[1]) if args[1:] else 1)
+            self._set(args[0], str(value).encode(), keep_ttl=True)
+            return value
+        if name in (b"EXPIRE", b"PEXPIRE"):
+            value = self._get(args[0])
+            if value is None:
+                return 0
+            self._set(args[0], value, float(args[1]) / (1000 if name == b"PEXPIRE" else 1))
+            return 1
+        return ValueError(f"unknown command '{name.decode()}'")
+
+    @staticmethod
+    def encode(value):
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, Exception):
+            return b"-ERR " + str(value).encode() + b"\r\n"
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(RespServer.encode(v) for v in value)
+        if value in (b"OK", b"PONG"):
+            return b"+" + value + b"\r\n"
+        return b"$%d\r\n" % len(value) + value + b"\r\n"
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                # клиенты шлют команды массивами bulk-строк: *<n>\r\n$<len>\r\n<arg>\r\n...
+                count = int(line[1:])
+                parts = []
+                for _ in range(count):
+                    size = int((await reader.readline())[1:])
+                    parts.append((await reader.readexactly(size + 2))[:-2])
+                writer.write(self.encode(self.execute(parts[0].upper(), parts[1:])))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Запускает сервер и возвращает его порт."""
+        self._server = await asyncio.start_server(self.handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+
+async def main(args):
+    server = RespServer()
+    port = await server.start(args.host, args.port)
+    print(f"listening on {args.host}:{port}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="In-memory RESP server for local runs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,122 @@
+"""Профиль холодного старта бота.
+
+Запуск из src:  python -m benchmarks.startup --runs 5 --budget 1.0
+
+Каждый прогон — новый интерпретатор: импорт aiogram/aiohttp (без них бот не работает),
+импорт main, сборка диспетчера и on_startup на пустой sqlite-базе. Отдельный прогон с
+python -X importtime показывает, какие пакеты сколько стоят. Бюджет проверяется для времени
+сверх фреймворка (импорт main + старт); при превышении или если в основной процесс
+попал тяжелый модуль из --forbid, код возврата 1.
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+from statistics import median
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# выполняется в дочернем процессе
+CHILD = """
+import json, sys, time, asyncio, logging
+logging.disable(logging.CRITICAL)
+started = time.perf_counter()
+import aiogram.types, aiohttp
+framework = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+async def start():
+    bot, dp = main.create_bot(), main.create_dispatcher()
+    began = time.perf_counter()
+    await dp.emit_startup(bot=bot)
+    ready = time.perf_counter() - began
+    await dp.emit_shutdown(bot=bot)
+    return ready
+
+ready = asyncio.run(start())
+print(json.dumps({
+    "framework": framework - started,
+    "import": imported - framework,
+    "startup": ready,
+    "modules": sorted(m for m in sys.modules if "." not in m)
+}))
+"""
+
+
+def child_env(workdir):
+    env = dict(os.environ)
+    env.update(
+        TOKEN=env.get("TOKEN", "123456:startup"),
+        DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'startup.db')}",
+        LOG_FILE=os.path.join(workdir, "command_logs.jsonl"),
+        COINS_SNAPSHOT=os.path.join(workdir, "coins.json"),
+        COINGECKO_URL="http://127.0.0.1:9",      # фоновые задачи не должны ходить в сеть
+        METRICS_ENABLED="0",
+        CHART_PREWARM="0",
+        STATE_URL=""
+    )
+    return env
+
+
+def measure(env):
+    out = subprocess.run([sys.executable, "-c", CHILD], cwd=SRC, env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+# собственное время импорта по пакетам верхнего уровня из вывода -X importtime
+def import_profile(env):
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                         cwd=SRC, env=env, capture_output=True, text=True, check=True)
+    packages = {}
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + int(self_us)
+    return sorted(packages.items(), key=lambda item: -item[1])
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="bot-startup-")
+    env = child_env(workdir)
+    samples = [measure(env) for _ in range(args.runs)]
+    framework = median(s["framework"] for s in samples)
+    imported = median(s["import"] for s in samples)
+    startup = median(s["startup"] for s in samples)
+    own = imported + startup
+
+    ms = 1000
+    print(f"runs:         {args.runs} (medians)")
+    print(f"framework:    {framework * ms:.0f} ms  (aiogram, aiohttp)")
+    print(f"import main:  {imported * ms:.0f} ms")
+    print(f"on_startup:   {startup * ms:.0f} ms")
+    print(f"total:        {(framework + own) * ms:.0f} ms, own {own * ms:.0f} ms, budget {args.budget * ms:.0f} ms")
+    print("top packages by import time:")
+    for package, self_us in import_profile(env)[:args.top]:
+        print(f"  {package:<24} {self_us / ms:8.1f} ms")
+
+    loaded = set(samples[-1]["modules"])
+    forbidden = [m for m in args.forbid if m in loaded]
+    print(f"lazy modules: {', '.join(args.forbid)} — {'loaded: ' + ', '.join(forbidden) if forbidden else 'not loaded'}")
+    ok = own <= args.budget and not forbidden
+    print("budget:       " + ("ok" if ok else "EXCEEDED"))
+    return 0 if ok else 1
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Cold start profile of the bot")
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters to measure")
+    parser.add_argument("--budget", type=float, default=float(os.getenv("STARTUP_BUDGET", "1.0")),
+                        help="seconds allowed for importing main and on_startup on top of the framework")
+    parser.add_argument("--top", type=int, default=10, help="packages to show in the import profile")
+    parser.add_argument("--forbid", nargs="*", default=["matplotlib", "plotting", "redis"],
+                        help="modules that must stay out of the bot process")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(run(parse_args()))
@@ -0,0 +1,190 @@
+import os
+import time
+import asyncio
+import logging
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
+
+from market import BACKGROUND
+from notifier import TELEGRAM_SEND_CONCURRENCY, split_message
+from database import claim_broadcast, save_broadcast_progress, get_active_recipients
+from tasks import cancel_task
+
+# рассылки по всем активным пользователям. получатели читаются из бд страницами по курсору,
+# сообщения уходят через общий с уведомлениями лимит телеграма (фоновым приоритетом),
+# прогресс сохраняется после каждой страницы — после рестарта рассылка продолжается с курсора
+
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", "200"))                        # получателей на страницу
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", "10"))       # проверка новых рассылок, секунды
+BROADCAST_STALE_AFTER = float(os.getenv("BROADCAST_STALE_AFTER", "120"))          # без heartbeat рассылку подхватит другой воркер
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastJob:
+    def __init__(self, row):
+        self.id = row.id
+        self.created_by = row.created_by
+        self.text = row.text
+        self.total = row.total
+        self.cursor = row.last_user_id
+        self.sent = row.sent
+        self.failed = row.failed
+        self.blocked = row.blocked
+        self.resumed = row.last_user_id > 0
+        # скорость считается по текущему запуску, без учета до рестарта
+        self.started = time.monotonic()
+        self.sent_before = row.sent
+
+    @property
+    def processed(self):
+        return self.sent + self.failed + self.blocked
+
+    @property
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return (self.sent - self.sent_before) / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        rate = self.rate
+        return max(0, self.total - self.processed) / rate if rate > 0 else None
+
+
+class Broadcaster:
+    def __init__(self, notifier, on_finish=None, chunk=BROADCAST_CHUNK, concurrency=TELEGRAM_SEND_CONCURRENCY,
+                 poll_interval=BROADCAST_POLL_INTERVAL, stale_after=BROADCAST_STALE_AFTER):
+        # отправка идет ботом уведомлений и через его лимитер, заблокировавших бота
+        # он же отмечает через on_blocked; on_finish(job) — корутина по завершении рассылки
+        self.notifier = notifier
+        self.on_finish = on_finish
+        self.chunk = chunk
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.job = None
+        self._slots = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # метрики
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retry_after = 0
+        self.finished = 0
+
+    # новая рассылка создана в этом воркере — не ждем следующего опроса
+    def wake(self):
+        self._wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                now = time.time()
+                row = await claim_broadcast(now, now - self.stale_after)
+                if row is not None:
+                    await self._run_job(BroadcastJob(row))
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("broadcast failed: %s", e)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_job(self, job):
+        self.job = job
+        logger.info("broadcast %d %s: %d recipients", job.id, "resumed" if job.resumed else "started", job.total)
+        try:
+            while True:
+                recipients = await get_active_recipients(job.cursor, self.chunk)
+                if not recipients:
+                    break
+                await self._send_chunk(job, recipients)
+                if not await save_broadcast_progress(job.id, job.cursor, job.sent, job.failed, job.blocked, time.time()):
+                    logger.info("broadcast %d cancelled at %d/%d", job.id, job.processed, job.total)
+                    return
+                logger.info("broadcast %d: %d/%d, %.1f msg/s", job.id, job.processed, job.total, job.rate)
+
+            await save_broadcast_progress(job.id, job.cursor, job.sent, job.failed, job.blocked, time.time(),
+                                          finished=True)
+            self.finished += 1
+            logger.info("broadcast %d done: sent %d, blocked %d, failed %d, %.1f msg/s",
+                        job.id, job.sent, job.blocked, job.failed, job.rate)
+            if self.on_finish is not None:
+                await self.on_finish(job)
+        finally:
+            self.job = None
+
+    async def _send_chunk(self, job, recipients):
+        governor = self.notifier.governor
+        tasks = []
+        try:
+            for chat_id in recipients:
+                await governor.acquire(BACKGROUND)
+                await self._slots.acquire()
+                tasks.append(asyncio.create_task(self._send(job, chat_id)))
+            await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            # остановка воркера: курсор — до первого неотправленного получателя,
+            # heartbeat = 0, чтобы после рестарта рассылку можно было взять сразу
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._advance(job, recipients, tasks)
+            try:
+                await save_broadcast_progress(job.id, job.cursor, job.sent, job.failed, job.blocked, 0.0)
+            except Exception as e:
+                logger.warning("broadcast %d progress not saved on stop: %s", job.id, e)
+            raise
+        self._advance(job, recipients, tasks)
+
+    @staticmethod
+    def _advance(job, recipients, tasks):
+        for chat_id, task in zip(recipients, tasks):
+            if task.cancelled():
+                break
+            job.cursor = chat_id
+
+    async def _send(self, job, chat_id):
+        try:
+            for i, text in enumerate(split_message(job.text)):
+                if i:
+                    # части длинного сообщения — с паузой лимита на чат
+                    await asyncio.sleep(self.notifier.chat_interval)
+                    await self.notifier.governor.acquire(BACKGROUND)
+                while True:
+                    try:
+                        await self.notifier.bot.send_message(chat_id, text)
+                        break
+                    except TelegramRetryAfter as e:
+                        # телеграм просит подождать: тормозим все отправки и повторяем это сообщение
+                        self.retry_after += 1
+                        self.notifier.governor.penalize(e.retry_after)
+                        await self.notifier.governor.acquire(BACKGROUND)
+            job.sent += 1
+            self.sent += 1
+        except TelegramForbiddenError:
+            job.blocked += 1
+            self.blocked += 1
+            if self.notifier.on_blocked is not None:
+                try:
+                    await self.notifier.on_blocked(chat_id)
+                except Exception as e:
+                    logger.warning("deactivating %s failed: %s", chat_id, e)
+        except Exception as e:
+            job.failed += 1
+            self.failed += 1
+            logger.warning("broadcast %d to %s failed: %s", job.id, chat_id, e)
+        finally:
+            self._slots.release()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        await cancel_task(self._task)
+        self._task = None
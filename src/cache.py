@@ -0,0 +1,76 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+# кэш в памяти: время жизни записей + вытеснение самых старых (LRU)
+# + single-flight: одновременные промахи по одному ключу ждут одну загрузку
+
+
+class TTLCache:
+    def __init__(self, ttl, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()   # key -> (expires_at, value)
+        self._inflight = {}          # key -> future текущей загрузки
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """Возвращает (найдено, значение) без загрузки."""
+        entry = self._data.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return True, value
+            del self._data[key]
+        self.misses += 1
+        return False, None
+
+    def get(self, key, default=None):
+        found, value = self.lookup(key)
+        return value if found else default
+
+    def set(self, key, value, ttl=None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    async def get_or_load(self, key, loader):
+        """Значение из кэша либо результат loader(); параллельные промахи делят одну загрузку."""
+        found, value = self.lookup(key)
+        if found:
+            return value
+
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(loader())
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._finish_load(key, f))
+        # shield: отмена одного ожидающего не должна отменять загрузку для остальных
+        return await asyncio.shield(future)
+
+    def _finish_load(self, key, future):
+        self._inflight.pop(key, None)
+        if not future.cancelled() and future.exception() is None:
+            self.set(key, future.result())
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0
+        }
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,241 @@
+import os
+import asyncio
+import logging
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from state import shared_backend
+
+# отрисовка графиков в отдельных процессах: matplotlib грузит CPU и держит GIL,
+# поэтому event loop бота только ждет готовый png. сам matplotlib (модуль plotting)
+# импортируется только в воркерах, старт бота за него не платит
+
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", str(min(4, os.cpu_count() or 1))))
+CHART_QUEUE_SIZE = int(os.getenv("CHART_QUEUE_SIZE", "16"))         # графиков в очереди сверх воркеров
+CHART_QUEUE_TIMEOUT = float(os.getenv("CHART_QUEUE_TIMEOUT", "5"))  # сколько ждать места в очереди
+CHART_PREWARM = os.getenv("CHART_PREWARM", "1") == "1"              # поднять воркеры в фоне сразу после старта
+CHART_CACHE_BYTES = int(os.getenv("CHART_CACHE_BYTES", str(32 * 1024 * 1024)))
+CHART_BUCKET = int(os.getenv("CHART_BUCKET", "300"))                # секунды на одну версию данных
+CHART_SHARED_TTL = float(os.getenv("CHART_SHARED_TTL", "3600"))     # срок png и file_id в общем кэше, секунды
+CHART_WIDTH_PX = 800
+CHART_DPI = 100
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+logger = logging.getLogger(__name__)
+
+
+class ChartBusyError(Exception):
+    pass
+
+
+# ряд цен как массивы numpy: время в мс (int64) и цены (float64)
+def price_series(history):
+    if not history:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    data = np.asarray(history, dtype=np.float64)
+    return data[:, 0].astype(np.int64), data[:, 1]
+
+
+def downsample_indices(prices, buckets=CHART_WIDTH_PX):
+    """Индексы точек, которые остаются после прореживания: минимум и максимум в каждой
+    из buckets корзин (по пикселю ширины) плюс первая и последняя точка — форма
+    графика на экране не меняется."""
+    n = len(prices)
+    if n <= 2 * buckets:
+        return np.arange(n)
+    size = -(-n // buckets)
+    rows = -(-n // size)
+    # добиваем последнюю корзину последним значением, индексы потом обрезаются до n - 1
+    body = np.pad(prices, (0, rows * size - n), mode='edge').reshape(rows, size)
+    offsets = np.arange(rows) * size
+    picked = np.concatenate((offsets + body.argmin(axis=1), offsets + body.argmax(axis=1), [0, n - 1]))
+    return np.unique(np.minimum(picked, n - 1))
+
+
+def downsample_minmax(ts, prices, buckets=CHART_WIDTH_PX):
+    picked = downsample_indices(prices, buckets)
+    return ts[picked], prices[picked]
+
+
+# точки входа воркера: функция рисования передается по имени из plotting
+def _render(name, *args):
+    import plotting
+    return getattr(plotting, name)(*args)
+
+
+def _warm():
+    import plotting  # noqa: F401
+
+
+class ChartRenderer:
+    def __init__(self, workers=CHART_WORKERS, queue_size=CHART_QUEUE_SIZE, queue_timeout=CHART_QUEUE_TIMEOUT):
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self._slots = asyncio.Semaphore(workers + queue_size)
+        self._executor = None
+
+    # forkserver, а не fork: у бота уже есть потоки (to_thread, резолвер aiohttp),
+    # форк процесса с потоками может унести в воркер захваченные блокировки.
+    # main.py и plotting импортируются один раз в самом forkserver, воркеры получают их готовыми.
+    # sys.path бота forkserver не применяет (а ImportError предзагрузки молча глотает),
+    # поэтому каталог модулей передаем ему через PYTHONPATH
+    def _get_executor(self):
+        if self._executor is None:
+            paths = os.environ.get("PYTHONPATH", "").split(os.pathsep)
+            if SRC_DIR not in paths:
+                os.environ["PYTHONPATH"] = os.pathsep.join([SRC_DIR, *filter(None, paths)])
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(["__main__", "plotting"])
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        return self._executor
+
+    # воркер упал (OOM, kill): пул больше не принимает задачи, следующий запрос поднимет новый
+    def _reset_executor(self, executor):
+        if self._executor is executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    # воркеры стартуют и импортируют matplotlib в фоне, первый график не ждет их запуска
+    def warm(self):
+        executor = self._get_executor()
+        for _ in range(self.workers):
+            executor.submit(_warm)
+
+    async def render(self, name, *args):
+        """Рисует plotting.<name>(*args) в пуле процессов; при переполненной очереди — ChartBusyError."""
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise ChartBusyError("chart queue is full")
+        try:
+            loop = asyncio.get_running_loop()
+            for attempt in range(2):
+                executor = self._get_executor()
+                try:
+                    return await loop.run_in_executor(executor, _render, name, *args)
+                except BrokenProcessPool:
+                    self._reset_executor(executor)
+                    if attempt:
+                        raise
+                    logger.warning("chart worker pool is broken, restarting it")
+        finally:
+            self._slots.release()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+# версия данных графика: время последней точки (мс), округленное до CHART_BUCKET
+def chart_version(last_ts):
+    return int(last_ts // 1000 // CHART_BUCKET) if last_ts else 0
+
+
+class ChartEntry:
+    __slots__ = ("png", "file_id")
+
+    def __init__(self, png):
+        self.png = png
+        self.file_id = None   # file_id телеграма после первой отправки
+
+
+# готовые png по ключу (коин, валюта, язык, версия данных), LRU с лимитом по байтам
+class ChartCache:
+    def __init__(self, max_bytes=CHART_CACHE_BYTES, shared=None, shared_ttl=CHART_SHARED_TTL):
+        # shared — общий кэш инстансов: график, нарисованный одним, и его file_id достаются всем
+        self.shared = shared
+        self.shared_ttl = shared_ttl
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self._data = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, png):
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.size_bytes -= len(old.png)
+        entry = ChartEntry(png)
+        self._data[key] = entry
+        self.size_bytes += len(png)
+        while self.size_bytes > self.max_bytes and len(self._data) > 1:
+            _, evicted = self._data.popitem(last=False)
+            self.size_bytes -= len(evicted.png)
+        return entry
+
+    async def set_file_id(self, key, file_id):
+        entry = self._data.get(key)
+        if entry is not None:
+            entry.file_id = file_id
+        if self.shared is not None:
+            try:
+                await self.shared.set(f"{self._shared_key(key)}:file_id", file_id.encode(), self.shared_ttl)
+            except Exception as e:
+                logger.warning("shared chart cache unavailable: %s", e)
+
+    @staticmethod
+    def _shared_key(key):
+        return "chart:" + ":".join(map(str, key))
+
+    async def _load(self, key, render):
+        if self.shared is not None:
+            shared_key = self._shared_key(key)
+            try:
+                png, file_id = await self.shared.get_many([shared_key, f"{shared_key}:file_id"])
+                if png is not None:
+                    return png, file_id.decode() if file_id else None
+            except Exception as e:
+                logger.warning("shared chart cache unavailable: %s", e)
+        png = await render()
+        if self.shared is not None:
+            try:
+                await self.shared.set(self._shared_key(key), png, self.shared_ttl)
+            except Exception as e:
+                logger.warning("shared chart cache unavailable: %s", e)
+        return png, None
+
+    async def get_or_render(self, key, render):
+        """Запись из кэша или render() -> png; одинаковые графики рисуются один раз."""
+        entry = self.get(key)
+        if entry is not None:
+            return entry
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._load(key, render))
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._inflight.pop(key, None))
+        png, file_id = await asyncio.shield(future)
+        entry = self._data.get(key)
+        if entry is None:
+            entry = self.put(key, png)
+            entry.file_id = file_id
+        return entry
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0
+        }
+
+
+chart_renderer = ChartRenderer()
+chart_cache = ChartCache(shared=shared_backend)
@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import difflib
+import tempfile
+from bisect import bisect_left
+
+from market import BACKGROUND
+from tasks import cancel_task
+
+# справочник коинов: полный список CoinGecko грузится из снапшота на диске в индексы
+# по id, тикеру и названию, в фоне раз в сутки обновляется из апи.
+# точный поиск — словари, поиск по префиксу — бинарный поиск по отсортированным ключам
+
+COINS_SNAPSHOT = os.getenv("COINS_SNAPSHOT", "resources/coins.json")
+COINS_REFRESH_INTERVAL = float(os.getenv("COINS_REFRESH_INTERVAL", str(24 * 3600)))   # секунды
+
+# при совпадении тикеров у нескольких коинов побеждает основной
+PREFERRED_IDS = (
+    "bitcoin", "ethereum", "tether", "binancecoin", "solana", "ripple", "usd-coin", "dogecoin",
+    "cardano", "tron", "the-open-network", "avalanche-2", "chainlink", "polkadot", "shiba-inu",
+    "litecoin", "bitcoin-cash", "uniswap", "stellar", "monero", "near", "aptos", "sui"
+)
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(text):
+    return " ".join(text.lower().split())
+
+
+class CoinIndex:
+    """Неизменяемый набор индексов по одному снапшоту списка коинов."""
+
+    def __init__(self, coins, preferred=PREFERRED_IDS):
+        rank = {coin_id: i for i, coin_id in enumerate(preferred)}
+        self.coins = {}        # id -> (id, тикер, название)
+        self.by_symbol = {}    # тикер -> id
+        self.by_name = {}      # название -> id
+        for coin in coins:
+            coin_id, symbol, name = coin["id"], normalize(coin.get("symbol") or ""), coin.get("name") or ""
+            self.coins[coin_id] = (coin_id, symbol, name)
+            for index, key in ((self.by_symbol, symbol), (self.by_name, normalize(name))):
+                if key and self._better(coin_id, index.get(key), rank):
+                    index[key] = coin_id
+
+        # ключ поиска -> id; сортированный список ключей для поиска по префиксу
+        self.keys = {}
+        for index in (self.by_name, self.by_symbol, {coin_id: coin_id for coin_id in self.coins}):
+            self.keys.update(index)
+        self.sorted_keys = sorted(self.keys)
+        # для нечеткого поиска кандидаты берутся только с той же первой буквы
+        self.by_first = {}
+        for key in self.sorted_keys:
+            self.by_first.setdefault(key[0], []).append(key)
+
+    # основной коин из списка, иначе самый короткий id (без суффиксов вроде -wormhole)
+    @staticmethod
+    def _better(coin_id, current, rank):
+        if current is None:
+            return True
+        new_rank, old_rank = rank.get(coin_id, len(rank)), rank.get(current, len(rank))
+        if new_rank != old_rank:
+            return new_rank < old_rank
+        return (len(coin_id), coin_id) < (len(current), current)
+
+    def __len__(self):
+        return len(self.coins)
+
+
+class CoinResolver:
+    def __init__(self, client, path=COINS_SNAPSHOT, refresh_interval=COINS_REFRESH_INTERVAL, aliases=None):
+        self.client = client
+        self.path = path
+        self.refresh_interval = refresh_interval
+        # aliases — тикер -> id, перекрывают справочник (популярные токены бота)
+        self.aliases = {normalize(k): v for k, v in (aliases or {}).items()}
+        self.index = CoinIndex([])
+        self.loaded_at = 0.0
+        self._task = None
+
+    @property
+    def ready(self):
+        return len(self.index) > 0
+
+    def resolve(self, text):
+        """id коина по id, тикеру или названию; None, если не найден.
+        Пока справочник не загружен, текст считается id как есть."""
+        key = normalize(text)
+        if key in self.aliases:
+            return self.aliases[key]
+        if not self.ready:
+            return key or None
+        index = self.index
+        if key in index.coins:
+            return key
+        return index.by_symbol.get(key) or index.by_name.get(key)
+
+    def search(self, prefix, limit=10):
+        """Коины, у которых id, тикер или название начинаются с prefix; точные совпадения первыми."""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        index = self.index
+        found = []
+        exact = self.resolve(prefix)
+        if exact in index.coins:
+            found.append(exact)
+        i = bisect_left(index.sorted_keys, prefix)
+        while i < len(index.sorted_keys) and len(found) < limit and index.sorted_keys[i].startswith(prefix):
+            coin_id = index.keys[index.sorted_keys[i]]
+            if coin_id not in found:
+                found.append(coin_id)
+            i += 1
+        return [index.coins[coin_id] for coin_id in found[:limit]]
+
+    def suggest(self, text, limit=3):
+        """Похожие коины для опечаток."""
+        key = normalize(text)
+        if not key or not self.ready:
+            return []
+        candidates = self.index.by_first.get(key[0], [])
+        matches = difflib.get_close_matches(key, candidates, n=limit * 2, cutoff=0.75)
+        result = []
+        for match in matches:
+            coin_id = self.index.keys[match]
+            if coin_id not in result:
+                result.append(coin_id)
+        return result[:limit]
+
+    def _read_snapshot(self):
+        with open(self.path, encoding="utf-8") as f:
+            return json.load(f)
+
+    # снапшот пишется во временный файл и подменяется атомарно;
+    # имя временного файла уникальное — воркеры вебхука пишут снапшот одновременно
+    def _write_snapshot(self, coins):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(self.path) + ".", suffix=".tmp", dir=directory or ".")
+        try:
+            with open(fd, "w", encoding="utf-8") as f:
+                json.dump(coins, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    async def load(self):
+        """Индексы из снапшота на диске; False, если снапшота нет или он не читается."""
+        try:
+            coins = await asyncio.to_thread(self._read_snapshot)
+            self.loaded_at = os.path.getmtime(self.path)
+        except (OSError, ValueError) as e:
+            logger.info("coin list snapshot not loaded: %s", e)
+            return False
+        self.index = await asyncio.to_thread(CoinIndex, coins)
+        return True
+
+    async def refresh(self):
+        coins = await self.client.coins_list(priority=BACKGROUND)
+        # индексы строятся в потоке, а подмена — одним присваиванием, читатели не видят полусобранный индекс
+        self.index = await asyncio.to_thread(CoinIndex, coins)
+        self.loaded_at = time.time()
+        await asyncio.to_thread(self._write_snapshot, coins)
+
+    async def run(self):
+        while True:
+            wait = self.loaded_at + self.refresh_interval - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("coin list refresh failed: %s", e)
+                await asyncio.sleep(min(self.refresh_interval, 600))
+
+    async def start(self):
+        if self._task is None:
+            await self.load()
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        await cancel_task(self._task)
+        self._task = None
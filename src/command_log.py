@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import glob
+import asyncio
+import logging
+from datetime import datetime
+
+# журнал команд: хендлеры кладут записи в очередь, фоновый писатель
+# пачками пишет их в JSON Lines и ротирует файл по размеру или времени
+
+LOG_FILE = os.getenv("LOG_FILE", "resources/command_logs.jsonl")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "500"))
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_ROTATE_SECONDS = float(os.getenv("LOG_ROTATE_SECONDS", str(24 * 3600)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "7"))
+
+logger = logging.getLogger(__name__)
+
+
+# у каждого воркера вебхука свой файл: в общий записи больше PIPE_BUF перемешиваются, а ротации гоняются
+def worker_log_path(path, index):
+    root, ext = os.path.splitext(path)
+    return f"{root}.{index}{ext}"
+
+
+class CommandLog:
+    def __init__(self, path=LOG_FILE, queue_size=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE,
+                 max_bytes=LOG_MAX_BYTES, rotate_seconds=LOG_ROTATE_SECONDS, backup_count=LOG_BACKUP_COUNT):
+        self.path = path
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backup_count = backup_count
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._task = None
+        self._opened_at = time.time()
+        self.written = 0
+        self.dropped = 0
+
+    def write(self, record):
+        """Не блокирует: при переполненной очереди запись отбрасывается и считается."""
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def log_user_event(self, user, kind, value):
+        self.write({
+            "ts": datetime.now().isoformat(timespec="seconds"),
+            "user_id": user.id,
+            "username": user.username,
+            "full_name": user.full_name,
+            "kind": kind,
+            "value": value
+        })
+
+    # синхронная часть, выполняется в отдельном потоке
+    def _write_batch(self, batch):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if self._should_rotate():
+            self._rotate()
+        with open(self.path, "a", encoding="utf-8") as log_file:
+            log_file.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in batch))
+        self.written += len(batch)
+
+    def _should_rotate(self):
+        if not os.path.exists(self.path):
+            self._opened_at = time.time()
+            return False
+        return (os.path.getsize(self.path) >= self.max_bytes
+                or time.time() - self._opened_at >= self.rotate_seconds)
+
+    def _rotate(self):
+        # суффикс с микросекундами и номером: две ротации подряд не затирают друг друга
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        target, n = f"{self.path}.{stamp}", 0
+        while os.path.exists(target):
+            n += 1
+            target = f"{self.path}.{stamp}-{n}"
+        os.replace(self.path, target)
+        self._opened_at = time.time()
+        backups = sorted(glob.glob(f"{glob.escape(self.path)}.*"))
+        for old in backups[:-self.backup_count] if self.backup_count else backups:
+            os.remove(old)
+
+    def _take_batch(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    # None в очереди — сигнал остановки: все, что пришло до него, дописывается
+    async def run(self):
+        while True:
+            batch = [await self._queue.get()]
+            batch.extend(self._take_batch())
+            stopping = None in batch
+            if stopping:
+                batch = batch[:batch.index(None)]
+            if batch:
+                try:
+                    await asyncio.to_thread(self._write_batch, batch)
+                except OSError as e:
+                    self.dropped += len(batch)
+                    logger.warning("command log write failed: %s", e)
+            if stopping:
+                return
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    # без cancel: отмена не останавливает запись, уже ушедшую в поток, и она шла бы параллельно
+    # с дозаписью остатка. писатель сам доходит до сигнала; после него дописываем опоздавшие записи
+    async def stop(self):
+        if self._task is not None:
+            await self._queue.put(None)
+            await self._task
+            self._task = None
+        while batch := self._take_batch():
+            await asyncio.to_thread(self._write_batch, batch)
+
+
+command_log = CommandLog()
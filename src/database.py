@@ -0,0 +1,450 @@
+import os
+
+from sqlalchemy import (Column, Integer, BigInteger, Float, String, Boolean, DateTime, LargeBinary, Text,
+                        ForeignKey, func, event, select, update, delete, bindparam, inspect)
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+
+# асинхронный слой бд: aiosqlite локально, asyncpg для postgres
+
+
+# приводим обычные url к асинхронным драйверам
+def async_database_url(url):
+    if url.startswith("sqlite:///"):
+        return url.replace("sqlite:///", "sqlite+aiosqlite:///", 1)
+    if url.startswith("postgres://"):
+        return url.replace("postgres://", "postgresql+asyncpg://", 1)
+    if url.startswith("postgresql://"):
+        return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    return url
+
+
+DATABASE_URL = async_database_url(os.getenv("DATABASE_URL", "sqlite:///bot_database.db"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+
+is_sqlite = DATABASE_URL.startswith("sqlite")
+
+# sqlite допускает одного писателя: с пулом параллельные upsert ловят "database is locked",
+# поэтому одно соединение и сессии по очереди. пул настраивается только для postgres
+if is_sqlite:
+    engine = create_async_engine(DATABASE_URL, pool_size=1, max_overflow=0)
+else:
+    engine = create_async_engine(
+        DATABASE_URL,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_pre_ping=True,
+        pool_recycle=1800
+    )
+Session = async_sessionmaker(engine, expire_on_commit=False)
+
+
+# WAL: чтения не ждут запись; synchronous=NORMAL достаточно для WAL
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not is_sqlite:
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-16000")
+    cursor.close()
+
+
+Base = declarative_base()
+
+
+BROADCAST_PENDING = "pending"
+BROADCAST_RUNNING = "running"
+BROADCAST_DONE = "done"
+BROADCAST_CANCELLED = "cancelled"
+
+
+# даша
+class User(Base):
+    __tablename__ = "users"
+
+    id = Column(Integer, primary_key=True)
+    telegram_id = Column(BigInteger, unique=True, nullable=False)
+    username = Column(String(255), nullable=True)
+    full_name = Column(String(255), nullable=True)
+    language = Column(String(2), default='ru')
+    is_active = Column(Boolean, default=True)
+    first_seen = Column(DateTime, default=func.now())
+    last_activity = Column(DateTime, default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<User(telegram_id={self.telegram_id}, username={self.username})>"
+
+
+# точки истории цен: время в мс, как отдает CoinGecko. у каждого шага (секунды) свой ряд,
+# в ряду не больше одной точки на интервал шага
+class PricePoint(Base):
+    __tablename__ = "price_points"
+
+    coin_id = Column(String(100), primary_key=True)
+    currency = Column(String(10), primary_key=True)
+    resolution = Column(Integer, primary_key=True)
+    ts = Column(BigInteger, primary_key=True)
+    price = Column(Float, nullable=False)
+
+
+# что уже скачано по коину с данным шагом: с какого момента история полная и когда была синхронизация
+class PriceHistorySync(Base):
+    __tablename__ = "price_history_sync"
+
+    coin_id = Column(String(100), primary_key=True)
+    currency = Column(String(10), primary_key=True)
+    resolution = Column(Integer, primary_key=True)
+    covered_from = Column(BigInteger, nullable=False)
+    last_ts = Column(BigInteger, nullable=False)
+    synced_at = Column(BigInteger, nullable=False)
+
+
+# подписки на цену: срабатывают, когда цена коина поднимается выше или опускается ниже порога
+class PriceAlert(Base):
+    __tablename__ = "price_alerts"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, ForeignKey("users.telegram_id"), nullable=False, index=True)
+    coin_id = Column(String(100), nullable=False)
+    currency = Column(String(10), nullable=False, default='usd')
+    direction = Column(String(5), nullable=False)      # above / below
+    threshold = Column(Float, nullable=False)
+    is_active = Column(Boolean, default=True, index=True)
+    created_at = Column(DateTime, default=func.now())
+    triggered_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<PriceAlert(id={self.id}, {self.coin_id} {self.direction} {self.threshold})>"
+
+
+# описания токенов по языкам, текст сжат zlib
+class TokenDescription(Base):
+    __tablename__ = "token_descriptions"
+
+    coin_id = Column(String(100), primary_key=True)
+    lang = Column(String(2), primary_key=True)
+    text = Column(LargeBinary, nullable=False)
+    fetched_at = Column(BigInteger, nullable=False)
+
+
+# рассылки: курсор по telegram_id последнего обработанного получателя и счетчики,
+# heartbeat — время последнего сохранения прогресса воркером, который ее ведет
+class Broadcast(Base):
+    __tablename__ = "broadcasts"
+
+    id = Column(Integer, primary_key=True)
+    created_by = Column(BigInteger, nullable=True)
+    text = Column(Text, nullable=False)
+    status = Column(String(16), default=BROADCAST_PENDING, nullable=False, index=True)
+    last_user_id = Column(BigInteger, default=0, nullable=False)
+    total = Column(Integer, default=0, nullable=False)
+    sent = Column(Integer, default=0, nullable=False)
+    failed = Column(Integer, default=0, nullable=False)
+    blocked = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, default=func.now())
+    started_at = Column(Float, nullable=True)
+    heartbeat = Column(Float, nullable=True)
+    finished_at = Column(Float, nullable=True)
+
+
+# история цен старого формата (без ряда на каждый шаг) — только кэш CoinGecko, ее проще скачать заново
+def _drop_outdated_history(conn):
+    inspector = inspect(conn)
+    if not inspector.has_table(PricePoint.__tablename__):
+        return
+    if "resolution" not in inspector.get_pk_constraint(PricePoint.__tablename__)["constrained_columns"]:
+        PricePoint.__table__.drop(conn)
+        PriceHistorySync.__table__.drop(conn, checkfirst=True)
+
+
+async def init_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(_drop_outdated_history)
+        await conn.run_sync(Base.metadata.create_all)
+
+
+async def close_db():
+    await engine.dispose()
+
+
+def _insert(table):
+    return sqlite_insert(table) if is_sqlite else postgresql_insert(table)
+
+
+# скалярные min/max двух значений: в sqlite это min/max, в postgres least/greatest
+def _least(a, b):
+    return func.min(a, b) if is_sqlite else func.least(a, b)
+
+
+def _greatest(a, b):
+    return func.max(a, b) if is_sqlite else func.greatest(a, b)
+
+
+# получение/создание пользователя одним атомарным upsert, возвращает язык;
+# написавший боту пользователь снова получает рассылки
+async def upsert_user(user_id, username=None, full_name=None):
+    stmt = _insert(User.__table__).values(
+        telegram_id=user_id,
+        username=username,
+        full_name=full_name,
+        language='ru',
+        is_active=True
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.telegram_id],
+        set_={"username": stmt.excluded.username, "full_name": stmt.excluded.full_name, "is_active": True}
+    ).returning(User.language)
+    async with Session() as session:
+        language = (await session.execute(stmt)).scalar_one()
+        await session.commit()
+    return language or 'ru'
+
+
+# получение языка пользователя из бд
+async def get_user_language(user_id):
+    async with Session() as session:
+        language = await session.scalar(select(User.language).where(User.telegram_id == user_id))
+    return language or 'ru'  # дефолтный язык
+
+
+# установка языка пользователя в бд
+async def set_user_language(user_id, language):
+    async with Session() as session:
+        await session.execute(update(User).where(User.telegram_id == user_id).values(language=language))
+        await session.commit()
+
+
+# пакетная запись времени последней активности (вызывается из ActivityTracker)
+async def save_user_activity(batch):
+    table = User.__table__
+    async with Session() as session:
+        await session.execute(
+            update(table).where(table.c.telegram_id == bindparam("uid")).values(last_activity=bindparam("ts")),
+            [{"uid": user_id, "ts": ts} for user_id, ts in batch.items()]
+        )
+        await session.commit()
+
+
+async def load_history_sync(coin_id, currency, resolution):
+    async with Session() as session:
+        return await session.get(PriceHistorySync, (coin_id, currency, resolution))
+
+
+# точки ряда с шагом resolution
+async def load_price_points(coin_id, currency, since, resolution):
+    stmt = (
+        select(PricePoint.ts, PricePoint.price)
+        .where(PricePoint.coin_id == coin_id, PricePoint.currency == currency,
+               PricePoint.resolution == resolution, PricePoint.ts >= since)
+        .order_by(PricePoint.ts)
+    )
+    async with Session() as session:
+        return [(ts, price) for ts, price in await session.execute(stmt)]
+
+
+# сохранение точек ряда resolution (уже по одной на интервал шага) и состояния синхронизации
+# в одной транзакции. точки ряда с интервала первой новой точки заменяются новыми, так что
+# незаконченный интервал не раздваивается. extend=False — окно скачано заново, старое покрытие не в счет
+async def save_price_points(coin_id, currency, resolution, points, covered_from, synced_at, extend=True):
+    step_ms = resolution * 1000
+    replaced = delete(PricePoint).where(
+        PricePoint.coin_id == coin_id, PricePoint.currency == currency, PricePoint.resolution == resolution,
+        PricePoint.ts >= (points[0][0] // step_ms * step_ms if points else 0)
+    )
+    sync_stmt = _insert(PriceHistorySync.__table__).values(
+        coin_id=coin_id,
+        currency=currency,
+        resolution=resolution,
+        covered_from=covered_from,
+        last_ts=max((ts for ts, _ in points), default=0),
+        synced_at=synced_at
+    )
+    sync_stmt = sync_stmt.on_conflict_do_update(
+        index_elements=[PriceHistorySync.coin_id, PriceHistorySync.currency, PriceHistorySync.resolution],
+        set_={
+            "covered_from": (_least(PriceHistorySync.covered_from, sync_stmt.excluded.covered_from) if extend
+                             else sync_stmt.excluded.covered_from),
+            "last_ts": _greatest(PriceHistorySync.last_ts, sync_stmt.excluded.last_ts),
+            "synced_at": sync_stmt.excluded.synced_at
+        }
+    )
+    async with Session() as session:
+        if points:
+            await session.execute(replaced)
+            await session.execute(
+                _insert(PricePoint.__table__),
+                [{"coin_id": coin_id, "currency": currency, "resolution": resolution, "ts": int(ts), "price": price}
+                 for ts, price in points]
+            )
+        await session.execute(sync_stmt)
+        await session.commit()
+
+
+_alert_columns = (PriceAlert.id, PriceAlert.user_id, PriceAlert.coin_id, PriceAlert.currency,
+                  PriceAlert.direction, PriceAlert.threshold)
+
+
+async def add_price_alert(user_id, coin_id, currency, direction, threshold):
+    alert = PriceAlert(user_id=user_id, coin_id=coin_id, currency=currency, direction=direction, threshold=threshold)
+    async with Session() as session:
+        session.add(alert)
+        await session.commit()
+    return alert
+
+
+async def load_active_alerts(after_id=0):
+    stmt = select(*_alert_columns).where(PriceAlert.is_active, PriceAlert.id > after_id).order_by(PriceAlert.id)
+    async with Session() as session:
+        return (await session.execute(stmt)).all()
+
+
+async def list_user_alerts(user_id):
+    stmt = select(*_alert_columns).where(PriceAlert.user_id == user_id, PriceAlert.is_active).order_by(PriceAlert.id)
+    async with Session() as session:
+        return (await session.execute(stmt)).all()
+
+
+# отключение подписки пользователем; False, если такой активной подписки у него нет
+async def delete_price_alert(user_id, alert_id):
+    stmt = (
+        update(PriceAlert)
+        .where(PriceAlert.id == alert_id, PriceAlert.user_id == user_id, PriceAlert.is_active)
+        .values(is_active=False)
+    )
+    async with Session() as session:
+        result = await session.execute(stmt)
+        await session.commit()
+    return result.rowcount > 0
+
+
+# сработавшие подписки выключаются одним запросом на пачку; возвращаются id, которые
+# выключил именно этот запрос — при нескольких воркерах уведомление отправит только один
+async def deactivate_alerts(alert_ids):
+    stmt = (
+        update(PriceAlert)
+        .where(PriceAlert.id.in_(alert_ids), PriceAlert.is_active)
+        .values(is_active=False, triggered_at=func.now())
+        .returning(PriceAlert.id)
+    )
+    async with Session() as session:
+        claimed = set((await session.execute(stmt)).scalars())
+        await session.commit()
+    return claimed
+
+
+# все языки описания коина одним запросом: {lang: (сжатый текст, время загрузки)}
+async def load_descriptions(coin_id):
+    stmt = select(TokenDescription.lang, TokenDescription.text, TokenDescription.fetched_at).where(
+        TokenDescription.coin_id == coin_id
+    )
+    async with Session() as session:
+        return {lang: (text, fetched_at) for lang, text, fetched_at in await session.execute(stmt)}
+
+
+async def save_descriptions(coin_id, texts, fetched_at):
+    stmt = _insert(TokenDescription.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[TokenDescription.coin_id, TokenDescription.lang],
+        set_={"text": stmt.excluded.text, "fetched_at": stmt.excluded.fetched_at}
+    )
+    async with Session() as session:
+        await session.execute(
+            stmt,
+            [{"coin_id": coin_id, "lang": lang, "text": text, "fetched_at": fetched_at} for lang, text in texts.items()]
+        )
+        await session.commit()
+
+
+# пользователь заблокировал бота: больше ему не пишем, пока он сам не вернется
+async def deactivate_user(user_id):
+    async with Session() as session:
+        await session.execute(update(User).where(User.telegram_id == user_id).values(is_active=False))
+        await session.commit()
+
+
+_broadcast_columns = (Broadcast.id, Broadcast.created_by, Broadcast.text, Broadcast.status, Broadcast.last_user_id,
+                      Broadcast.total, Broadcast.sent, Broadcast.failed, Broadcast.blocked,
+                      Broadcast.started_at, Broadcast.heartbeat, Broadcast.finished_at)
+
+
+# новая рассылка, получатели считаются на момент создания; возвращает (id, число получателей)
+async def create_broadcast(text, created_by=None):
+    async with Session() as session:
+        total = await session.scalar(select(func.count()).select_from(User).where(User.is_active))
+        broadcast = Broadcast(text=text, created_by=created_by, total=total or 0)
+        session.add(broadcast)
+        await session.commit()
+    return broadcast.id, broadcast.total
+
+
+# берем ожидающую рассылку или брошенную упавшим воркером (heartbeat старше stale_before);
+# условие повторяется в update, поэтому одну рассылку получает только один воркер
+async def claim_broadcast(now, stale_before):
+    claimable = (Broadcast.status == BROADCAST_PENDING) | (
+        (Broadcast.status == BROADCAST_RUNNING) & (Broadcast.heartbeat < stale_before)
+    )
+    next_id = select(Broadcast.id).where(claimable).order_by(Broadcast.id).limit(1).scalar_subquery()
+    stmt = (
+        update(Broadcast)
+        .where(Broadcast.id == next_id, claimable)
+        .values(status=BROADCAST_RUNNING, heartbeat=now, started_at=func.coalesce(Broadcast.started_at, now))
+        .returning(*_broadcast_columns)
+    )
+    async with Session() as session:
+        row = (await session.execute(stmt)).first()
+        await session.commit()
+    return row
+
+
+# сохранение прогресса; False, если рассылку тем временем отменили
+async def save_broadcast_progress(broadcast_id, last_user_id, sent, failed, blocked, now, finished=False):
+    values = {"last_user_id": last_user_id, "sent": sent, "failed": failed, "blocked": blocked, "heartbeat": now}
+    if finished:
+        values.update(status=BROADCAST_DONE, finished_at=now)
+    stmt = (
+        update(Broadcast)
+        .where(Broadcast.id == broadcast_id, Broadcast.status == BROADCAST_RUNNING)
+        .values(**values)
+    )
+    async with Session() as session:
+        result = await session.execute(stmt)
+        await session.commit()
+    return result.rowcount > 0
+
+
+async def cancel_broadcast(broadcast_id):
+    stmt = (
+        update(Broadcast)
+        .where(Broadcast.id == broadcast_id, Broadcast.status.in_((BROADCAST_PENDING, BROADCAST_RUNNING)))
+        .values(status=BROADCAST_CANCELLED)
+    )
+    async with Session() as session:
+        result = await session.execute(stmt)
+        await session.commit()
+    return result.rowcount > 0
+
+
+async def list_broadcasts(limit=5):
+    stmt = select(*_broadcast_columns).order_by(Broadcast.id.desc()).limit(limit)
+    async with Session() as session:
+        return (await session.execute(stmt)).all()
+
+
+# получатели рассылки страницами по telegram_id (keyset): каждая страница — проход по индексу
+# от курсора, без offset и без загрузки всех пользователей в память
+async def get_active_recipients(after_user_id, limit):
+    stmt = (
+        select(User.telegram_id)
+        .where(User.is_active, User.telegram_id > after_user_id)
+        .order_by(User.telegram_id)
+        .limit(limit)
+    )
+    async with Session() as session:
+        return list((await session.execute(stmt)).scalars())
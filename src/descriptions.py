@@ -0,0 +1,124 @@
+import os
+import re
+import time
+import zlib
+import asyncio
+import logging
+
+from cache import TTLCache
+from market import INTERACTIVE, BACKGROUND
+from database import load_descriptions, save_descriptions
+
+# описания токенов: из документа коина берутся только тексты нужных языков,
+# хранятся сжатыми в бд по (коин, язык) и живут неделю. устаревшие отдаются сразу
+# и обновляются в фоне, поэтому пользователь ждет апи только при самом первом запросе коина
+
+DESCRIPTION_TTL = float(os.getenv("DESCRIPTION_TTL", str(7 * 24 * 3600)))           # секунды
+DESCRIPTION_WAIT = float(os.getenv("DESCRIPTION_WAIT", "2"))                         # ожидание первой загрузки
+DESCRIPTION_REFRESH_INTERVAL = float(os.getenv("DESCRIPTION_REFRESH_INTERVAL", "3600"))
+DESCRIPTION_LANGUAGES = ("ru", "en")
+DESCRIPTION_MAX_CHARS = 1000
+
+logger = logging.getLogger(__name__)
+
+TAG = re.compile(r"<[^>]+>")
+
+
+def extract_description(text, max_chars=DESCRIPTION_MAX_CHARS):
+    # в описаниях CoinGecko html-ссылки и \r\n; бот шлет обычный текст
+    text = TAG.sub("", text or "").replace("\r\n", "\n").strip()
+    return text[:max_chars] + "..." if len(text) > max_chars else text
+
+
+class DescriptionStore:
+    def __init__(self, client, languages=DESCRIPTION_LANGUAGES, ttl=DESCRIPTION_TTL,
+                 wait=DESCRIPTION_WAIT, refresh_interval=DESCRIPTION_REFRESH_INTERVAL):
+        self.client = client
+        self.languages = languages
+        self.ttl = ttl
+        self.wait = wait
+        self.refresh_interval = refresh_interval
+        self.cache = TTLCache(ttl, max_size=512)    # coin_id -> {lang: (текст, время загрузки)}
+        self._fetches = {}                          # coin_id -> задача загрузки из апи
+        self._watch = []
+        self._task = None
+        self.fetched = 0
+
+    async def get(self, coin_id, lang='ru'):
+        """Описание на языке lang (или английское); None, если его нет или оно еще грузится."""
+        texts = await self.cache.get_or_load(coin_id, lambda: self._load(coin_id))
+        if not texts:
+            # коин видим впервые: ждем загрузку недолго, дальше она доедет в фоне
+            task = self._fetch(coin_id, INTERACTIVE)
+            try:
+                texts = await asyncio.wait_for(asyncio.shield(task), self.wait)
+            except Exception:
+                # таймаут или ошибка апи (она уже в логе) — отвечаем без описания
+                return None
+        elif self._is_stale(texts):
+            self._fetch(coin_id, BACKGROUND)
+        text = texts.get(lang, ("", 0))[0] or texts.get("en", ("", 0))[0]
+        return text or None
+
+    def _is_stale(self, texts):
+        return min(fetched_at for _, fetched_at in texts.values()) < time.time() - self.ttl
+
+    async def _load(self, coin_id):
+        rows = await load_descriptions(coin_id)
+        return {lang: (zlib.decompress(blob).decode(), fetched_at) for lang, (blob, fetched_at) in rows.items()}
+
+    # одна загрузка на коин, сколько бы запросов ни пришло
+    def _fetch(self, coin_id, priority):
+        task = self._fetches.get(coin_id)
+        if task is None:
+            task = asyncio.create_task(self._refresh(coin_id, priority))
+            self._fetches[coin_id] = task
+            task.add_done_callback(lambda t: self._fetches.pop(coin_id, None))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception() is None or
+                                   logger.warning("description refresh for %s failed: %s", coin_id, t.exception()))
+        return task
+
+    async def _refresh(self, coin_id, priority):
+        data = await self.client.coin_description(coin_id, priority=priority)
+        descriptions = data.get("description") or {}
+        now = time.time()
+        texts = {lang: (extract_description(descriptions.get(lang)), now) for lang in self.languages}
+        await save_descriptions(
+            coin_id, {lang: zlib.compress(text.encode()) for lang, (text, _) in texts.items()}, int(now)
+        )
+        self.cache.set(coin_id, texts)
+        self.fetched += 1
+        return texts
+
+    # фоном держим свежими описания популярных коинов
+    async def run(self):
+        while True:
+            for coin_id in self._watch:
+                try:
+                    # без get_or_load: его загрузка защищена от отмены и пережила бы остановку бота
+                    found, texts = self.cache.lookup(coin_id)
+                    if not found:
+                        texts = await self._load(coin_id)
+                        self.cache.set(coin_id, texts)
+                    if not texts or self._is_stale(texts):
+                        await self._fetch(coin_id, BACKGROUND)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.warning("description refresh for %s failed: %s", coin_id, e)
+            await asyncio.sleep(self.refresh_interval)
+
+    async def start(self, coin_ids=()):
+        self._watch = list(coin_ids)
+        if self._task is None:
+            # сохраненные описания популярных коинов — в память до первого запроса
+            for coin_id in self._watch:
+                self.cache.set(coin_id, await self._load(coin_id))
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        tasks = [t for t in (self._task, *self._fetches.values()) if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
@@ -0,0 +1,97 @@
+import os
+import math
+import time
+import asyncio
+import logging
+
+from database import load_history_sync, load_price_points, save_price_points
+
+# история цен на диске: при запросе докачивается только хвост после последней
+# сохраненной точки, любые окна (1d/7d/30d/1y) читаются из бд.
+# шаг точек CoinGecko выбирает сам по длине окна, поэтому у каждого шага свой ряд и свое покрытие:
+# после годового графика с дневными точками суточный все равно получит свои пятиминутные.
+# хвост приходит с более мелким шагом и перед записью прореживается до шага ряда
+
+HISTORY_SYNC_INTERVAL = float(os.getenv("HISTORY_SYNC_INTERVAL", "300"))   # секунды между докачками
+DAY_MS = 24 * 3600 * 1000
+
+logger = logging.getLogger(__name__)
+
+
+# шаг точек market_chart в секундах: 1 день — 5 минут, до 90 дней — час, дальше — день
+def resolution_for(days):
+    if days <= 1:
+        return 300
+    if days <= 90:
+        return 3600
+    return 86400
+
+
+# ряд на сетке шага: последняя цена каждого интервала со временем его начала,
+# у самой свежей точки время настоящее; points отсортированы по времени
+def resample(points, resolution):
+    step_ms = resolution * 1000
+    buckets = {}
+    for ts, price in points:
+        buckets[ts // step_ms * step_ms] = price
+    result = list(buckets.items())
+    if result:
+        result[-1] = points[-1]
+    return result
+
+
+class HistoryStore:
+    def __init__(self, client, sync_interval=HISTORY_SYNC_INTERVAL):
+        self.client = client
+        self.sync_interval = sync_interval
+        self._locks = {}   # (coin_id, currency, шаг) -> lock, чтобы одну историю не качали дважды
+        self.full_syncs = 0
+        self.tail_syncs = 0
+
+    async def get_history(self, coin_id, currency='usd', days=7):
+        await self.sync(coin_id, currency, days)
+        return await self.load(coin_id, currency, days)
+
+    async def load(self, coin_id, currency='usd', days=7):
+        now_ms = int(time.time() * 1000)
+        return await load_price_points(coin_id, currency, now_ms - days * DAY_MS, resolution_for(days))
+
+    async def sync(self, coin_id, currency='usd', days=7):
+        """Докачивает окно, если нужно; возвращает время последней сохраненной точки (0 — истории нет)."""
+        resolution = resolution_for(days)
+        lock = self._locks.setdefault((coin_id, currency, resolution), asyncio.Lock())
+        async with lock:
+            state = await load_history_sync(coin_id, currency, resolution)
+            now_ms = int(time.time() * 1000)
+            window_start = now_ms - days * DAY_MS
+            tail_days = None if state is None else max(1, math.ceil((now_ms - state.last_ts) / DAY_MS))
+
+            if (state is None or state.covered_from > window_start + DAY_MS
+                    or resolution_for(tail_days) > resolution):
+                # окна еще нет на диске или хвост такой длинный, что придет с крупным шагом: качаем окно целиком
+                fetch_days = days
+                covered_from = window_start
+                extend = False
+                self.full_syncs += 1
+            elif now_ms - state.synced_at > self.sync_interval * 1000:
+                # докачиваем только хвост с последней точки
+                fetch_days = tail_days
+                covered_from = state.covered_from
+                extend = True
+                self.tail_syncs += 1
+            else:
+                return state.last_ts
+
+            try:
+                data = await self.client.market_chart(coin_id, currency, fetch_days)
+            except Exception as e:
+                if state is None:
+                    raise
+                # апи недоступно: отдаем то, что уже есть на диске
+                logger.warning("history sync failed for %s/%s, serving stored data: %s", coin_id, currency, e)
+                return state.last_ts
+
+            points = resample(sorted((int(x[0]), x[1]) for x in data['prices']), resolution)
+            await save_price_points(coin_id, currency, resolution, points, covered_from, now_ms, extend)
+            last_ts = max((ts for ts, _ in points), default=0)
+            return max(last_ts, state.last_ts) if state is not None else last_ts
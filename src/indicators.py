@@ -0,0 +1,201 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# технические индикаторы по ряду цен на numpy, значения — как при расчете с начала окна.
+# ряд сначала приводится к сетке шага окна: окна индикаторов считаются в точках,
+# и при точках разной частоты SMA20 годового графика покрыл бы пару последних часов.
+# состояние ряда хранится между запросами: пока начало окна то же, при новых точках считается
+# только хвост (EMA продолжаются с последнего значения, окна — с последних точек).
+# последняя точка ряда живая: к следующему запросу ее интервал закрывается и она ложится на сетку,
+# поэтому она пересчитывается от состояния перед ней.
+# если окно сдвинулось, ряд считается заново: сглаживания, начатые раньше окна, дали бы
+# в его начале другие значения, чем расчет по самому окну
+
+SMA_WINDOW = 20
+EMA_SPAN = 20
+BB_WIDTH = 2.0          # полосы Боллинджера: SMA ± BB_WIDTH * std
+RSI_PERIOD = 14
+MACD_FAST, MACD_SLOW, MACD_SIGNAL = 12, 26, 9
+VOLATILITY_WINDOW = 20
+EMA_BLOCK = 64          # длина блока векторного EMA, чтобы степени затухания не переполнялись
+YEAR_MS = 365 * 24 * 3600 * 1000
+
+INDICATORS_CACHE_SIZE = int(os.getenv("INDICATORS_CACHE_SIZE", "256"))   # рядов в памяти
+
+
+def ema(values, alpha, initial=None):
+    """Экспоненциальное сглаживание y_t = (1 - alpha) * y_{t-1} + alpha * x_t без цикла по точкам.
+
+    initial — последнее значение из предыдущего вызова; без него ряд начинается с values[0].
+    """
+    values = np.asarray(values, dtype=np.float64)
+    out = np.empty_like(values)
+    if not len(values):
+        return out
+    decay = 1.0 - alpha
+    prev = values[0] if initial is None else initial
+    # внутри блока: y_t = d^(t+1) * (prev + alpha * sum_{i<=t} x_i / d^(i+1))
+    powers = decay ** np.arange(1, EMA_BLOCK + 1)
+    for start in range(0, len(values), EMA_BLOCK):
+        block = values[start:start + EMA_BLOCK]
+        p = powers[:len(block)]
+        out[start:start + len(block)] = p * (prev + alpha * np.cumsum(block / p))
+        prev = out[start + len(block) - 1]
+    return out
+
+
+def rolling_mean_std(values, window, tail=()):
+    """Скользящие среднее и std; tail — последние window - 1 значений перед values.
+    Позиции без полного окна заполняются NaN."""
+    data = np.concatenate((tail, values))
+    missing = min(len(values), window - 1 - len(tail))
+    if len(data) < window:
+        nan = np.full(len(values), np.nan)
+        return nan, nan.copy()
+    windows = sliding_window_view(data, window)
+    head = np.full(missing, np.nan)
+    return np.concatenate((head, windows.mean(axis=1))), np.concatenate((head, windows.std(axis=1)))
+
+
+def resample(ts, prices, step):
+    """Ряд на сетке шага step (мс): последняя цена каждого интервала со временем его начала,
+    у последней точки время настоящее."""
+    if not len(ts):
+        return ts, prices
+    buckets = ts // step
+    last = np.append(buckets[1:] != buckets[:-1], True)
+    grid = buckets[last] * step
+    grid[-1] = ts[-1]
+    return grid, prices[last]
+
+
+class IndicatorSeries:
+    FIELDS = ("ts", "price", "sma", "ema", "bb_upper", "bb_lower", "rsi", "macd", "signal", "returns", "volatility")
+
+    def __init__(self, step):
+        self.step = step     # номинальный шаг ряда, мс
+        for name in self.FIELDS:
+            setattr(self, name, np.empty(0, dtype=np.int64 if name == "ts" else np.float64))
+        self.seen = 0        # сколько точек обработано с начала окна, для прогрева RSI/MACD
+        # последние значения сглаживаний, с них продолжается расчет
+        self._ema = self._fast = self._slow = self._signal = self._gain = self._loss = None
+        self._before_last = None   # те же значения перед последней точкой, для drop_last
+
+    def __len__(self):
+        return len(self.ts)
+
+    def update(self, ts, prices):
+        """Добавляет точки новее последней; возвращает число добавленных."""
+        if len(self.ts):
+            fresh = ts > self.ts[-1]
+            ts, prices = ts[fresh], prices[fresh]
+        if len(ts):
+            self._extend(ts, prices)
+        return len(ts)
+
+    def drop_last(self):
+        """Убирает последнюю точку и возвращает сглаживания к состоянию перед ней."""
+        for name in self.FIELDS:
+            setattr(self, name, getattr(self, name)[:-1])
+        self.seen -= 1
+        self._ema, self._fast, self._slow, self._signal, self._gain, self._loss = self._before_last
+        self._before_last = None
+
+    def _extend(self, ts, prices):
+        prev_price = self.price[-1] if len(self.price) else prices[0]
+        previous = np.concatenate(([prev_price], prices[:-1]))
+        index = self.seen + np.arange(len(prices))
+
+        sma, std = rolling_mean_std(prices, SMA_WINDOW, self.price[-(SMA_WINDOW - 1):])
+        ema_line = ema(prices, 2 / (EMA_SPAN + 1), self._ema)
+
+        fast = ema(prices, 2 / (MACD_FAST + 1), self._fast)
+        slow = ema(prices, 2 / (MACD_SLOW + 1), self._slow)
+        macd_raw = fast - slow
+        signal_raw = ema(macd_raw, 2 / (MACD_SIGNAL + 1), self._signal)
+
+        # RSI по Уайлдеру: сглаживание приростов и падений с alpha = 1 / период
+        delta = prices - previous
+        gain = ema(np.clip(delta, 0, None), 1 / RSI_PERIOD, self._gain)
+        loss = ema(np.clip(-delta, 0, None), 1 / RSI_PERIOD, self._loss)
+        total = gain + loss
+        rsi = np.divide(100 * gain, total, out=np.full(len(total), 50.0), where=total > 0)
+
+        returns = np.log(prices / previous)
+        _, volatility = rolling_mean_std(returns, VOLATILITY_WINDOW,
+                                         self.returns[-(VOLATILITY_WINDOW - 1):])
+
+        if len(prices) > 1:
+            self._before_last = (ema_line[-2], fast[-2], slow[-2], signal_raw[-2], gain[-2], loss[-2])
+        else:
+            self._before_last = (self._ema, self._fast, self._slow, self._signal, self._gain, self._loss)
+        self._ema, self._fast, self._slow = ema_line[-1], fast[-1], slow[-1]
+        self._signal, self._gain, self._loss = signal_raw[-1], gain[-1], loss[-1]
+
+        # первые точки ряда, пока сглаживание не набрало историю, не показываем
+        rsi[index < RSI_PERIOD] = np.nan
+        macd = np.where(index < MACD_SLOW, np.nan, macd_raw)
+        signal = np.where(index < MACD_SLOW + MACD_SIGNAL, np.nan, signal_raw)
+
+        new = {
+            "ts": ts, "price": prices, "sma": sma, "ema": ema_line,
+            "bb_upper": sma + BB_WIDTH * std, "bb_lower": sma - BB_WIDTH * std,
+            "rsi": rsi, "macd": macd, "signal": signal, "returns": returns, "volatility": volatility
+        }
+        for name in self.FIELDS:
+            setattr(self, name, np.concatenate((getattr(self, name), new[name])))
+        self.seen += len(prices)
+
+    def arrays(self, indices=None):
+        """Словарь массивов для графика; indices — точки после прореживания."""
+        return {name: getattr(self, name) if indices is None else getattr(self, name)[indices]
+                for name in self.FIELDS}
+
+    def summary(self):
+        """Последние значения индикаторов; волатильность — годовая (по номинальному шагу), в процентах."""
+        if not len(self):
+            return None
+        annualize = np.sqrt(YEAR_MS / self.step)
+        result = {name: float(getattr(self, name)[-1]) for name in self.FIELDS if name not in ("ts", "returns")}
+        result["volatility"] = result["volatility"] * annualize * 100
+        return result
+
+
+class IndicatorEngine:
+    def __init__(self, max_size=INDICATORS_CACHE_SIZE):
+        self.max_size = max_size
+        self._series = OrderedDict()    # (коин, валюта, дней) -> IndicatorSeries
+        self.full_computes = 0
+        self.incremental_updates = 0
+
+    def __len__(self):
+        return len(self._series)
+
+    def compute(self, key, ts, prices, step):
+        """Ряд индикаторов для окна ts/prices на сетке шага step (мс); если сохраненный ряд без
+        живой последней точки — начало нового, пересчитываются только она и новые точки."""
+        ts, prices = resample(ts, prices, step)
+        series = self._series.get(key)
+        n = len(series) if series is not None else 0
+        if (n < 2 or series.step != step or len(ts) < n - 1 or ts[0] != series.ts[0]
+                or ts[n - 2] != series.ts[-2] or series._before_last is None):
+            # нет ряда или окно сдвинулось: считаем с нуля по окну
+            series = IndicatorSeries(step)
+            series.update(ts, prices)
+            self.full_computes += 1
+        else:
+            series.drop_last()
+            series.update(ts, prices)
+            self.incremental_updates += 1
+
+        self._series[key] = series
+        self._series.move_to_end(key)
+        while len(self._series) > self.max_size:
+            self._series.popitem(last=False)
+        return series
+
+
+indicator_engine = IndicatorEngine()
@@ -0,0 +1,116 @@
+import os
+import asyncio
+import logging
+
+from aiogram.types import InlineQueryResultArticle, InputTextMessageContent
+
+from cache import TTLCache
+from coins import normalize
+from market import BACKGROUND
+from prices import PRICE_BATCH_SIZE
+from tasks import cancel_task
+
+# инлайн-режим (@bot btc): ответы собираются только из памяти — индекс коинов и
+# известные цены. коины без цены догружаются в фоне одним пакетом, и следующее
+# нажатие клавиши уже видит цену. хендлер сам никогда не ходит в апи
+
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "30"))                 # cache_time телеграма, секунды
+INLINE_PARTIAL_CACHE_TIME = int(os.getenv("INLINE_PARTIAL_CACHE_TIME", "3"))  # если часть цен еще грузится
+INLINE_CACHE_TTL = float(os.getenv("INLINE_CACHE_TTL", "15"))                 # свой кэш готовых ответов
+INLINE_RESULTS = 10
+INLINE_PREFETCH_TICK = 0.3     # окно сбора коинов для фоновой догрузки цен, секунды
+
+logger = logging.getLogger(__name__)
+
+
+def format_price(price):
+    return f"{price:,.2f}" if price >= 1 else f"{price:.6g}"
+
+
+class InlineAnswers:
+    def __init__(self, resolver, price_service, client, default_coins, currency='usd',
+                 ttl=INLINE_CACHE_TTL, limit=INLINE_RESULTS):
+        self.resolver = resolver
+        self.price_service = price_service
+        self.client = client
+        self.default_coins = list(default_coins)    # ответ на пустой запрос
+        self.currency = currency
+        self.limit = limit
+        self.cache = TTLCache(ttl, max_size=4096)   # запрос -> (результаты, cache_time)
+        self._missing = set()
+        self._prefetch_task = None
+        self.prefetched = 0
+
+    def answer(self, query):
+        """(результаты, cache_time) для инлайн-запроса, без обращений к апи."""
+        key = normalize(query)[:64]
+        found, value = self.cache.lookup(key)
+        if found:
+            return value
+
+        if key:
+            coins = self.resolver.search(key, self.limit)
+        else:
+            coins = [self._coin(coin_id) for coin_id in self.default_coins]
+        results, missing = [], []
+        for coin_id, symbol, name in coins:
+            known, price = self.price_service.peek(coin_id, self.currency)
+            if not known:
+                missing.append(coin_id)
+            results.append(self._article(coin_id, symbol, name, price, known))
+
+        if missing:
+            # неполный ответ не кэшируем надолго ни у себя, ни в телеграме
+            self._prefetch(missing)
+            return results, INLINE_PARTIAL_CACHE_TIME
+        value = (results, INLINE_CACHE_TIME)
+        self.cache.set(key, value)
+        return value
+
+    def _coin(self, coin_id):
+        return self.resolver.index.coins.get(coin_id) or (coin_id, "", coin_id.capitalize())
+
+    def _article(self, coin_id, symbol, name, price, known):
+        currency = self.currency.upper()
+        title = f"{name} ({symbol.upper()})" if symbol else name
+        if price is not None:
+            description = f"{format_price(price)} {currency}"
+            text = f"💱 {name} ({symbol.upper() or coin_id}): {format_price(price)} {currency}"
+        else:
+            description = "…" if not known else "—"
+            text = f"💱 {name} ({symbol.upper() or coin_id})"
+        return InlineQueryResultArticle(
+            id=coin_id[:64],
+            title=title,
+            description=description,
+            input_message_content=InputTextMessageContent(message_text=text)
+        )
+
+    def _prefetch(self, coin_ids):
+        self._missing.update(coin_ids)
+        if self._prefetch_task is None:
+            self._prefetch_task = asyncio.create_task(self._run_prefetch())
+
+    # догрузка цен для коинов из инлайн-ответов: фоновый приоритет, один запрос на окно
+    async def _run_prefetch(self):
+        try:
+            await asyncio.sleep(INLINE_PREFETCH_TICK)
+            coin_ids = list(self._missing)[:PRICE_BATCH_SIZE]
+            self._missing.difference_update(coin_ids)
+            data = await self.client.simple_price(coin_ids, self.currency, priority=BACKGROUND)
+            for coin_id in coin_ids:
+                self.price_service.put(coin_id, self.currency, data.get(coin_id, {}).get(self.currency))
+            self.prefetched += len(coin_ids)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("inline price prefetch failed: %s", e)
+        finally:
+            self._prefetch_task = None
+        # пока шел запрос, могли набраться новые коины
+        if self._missing:
+            self._prefetch_task = asyncio.create_task(self._run_prefetch())
+
+    async def stop(self):
+        await cancel_task(self._prefetch_task)
+        self._prefetch_task = None
@@ -1,103 +1,70 @@
 import os
+import math
 import asyncio
-import requests
-import matplotlib.pyplot as plt
+import logging
 from io import BytesIO
 from datetime import datetime
 
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, Dispatcher, Router, F, types
 from aiogram.filters import CommandStart, Command
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, BufferedInputFile
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InlineQuery, BufferedInputFile
 
+import numpy as np
 from dotenv import load_dotenv, find_dotenv
 
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, func
-from sqlalchemy.orm import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
+from database import (engine, init_db, close_db, upsert_user, get_user_language, set_user_language, save_user_activity,
+                      add_price_alert, load_active_alerts, list_user_alerts, delete_price_alert, deactivate_alerts,
+                      deactivate_user, create_broadcast, cancel_broadcast, list_broadcasts, is_sqlite)
+from market import market_client, RateLimitedError, INTERACTIVE, BACKGROUND
+from prices import price_service
+from poller import PricePoller, POLL_WATCHLIST
+from history import HistoryStore, resolution_for
+from activity import ActivityTracker
+from command_log import command_log, worker_log_path
+from profiles import UserProfiles, UserMiddleware
+from metrics import METRICS_ENABLED, registry, metrics_server, timed, instrument_engine, HandlerMetricsMiddleware
+from webhook import BOT_MODE, WEBHOOK_WORKERS, serve, run_webhook
+from charts import (chart_renderer, chart_cache, chart_version, price_series, downsample_minmax,
+                    downsample_indices, ChartBusyError, CHART_PREWARM)
+from indicators import SMA_WINDOW, EMA_SPAN, RSI_PERIOD, indicator_engine
+from alerts import AlertEngine, ALERTS_PER_USER, ABOVE, BELOW
+from notifier import Notifier, TELEGRAM_RATE_PER_SEC
+from broadcast import Broadcaster
+from state import backend, shared_backend, shared_rate_limit, UpdateDedupMiddleware
+from coins import CoinResolver
+from inline import InlineAnswers
+from descriptions import DescriptionStore
+from risk import (Positions, SIDES, LONG, RISK_MAX_LEVERAGE, evaluate, leverage_sweep, parse_csv, build_positions,
+                  format_table, to_csv)
 
 # загрузка токена из .env
 load_dotenv(find_dotenv())     # даша
-bot = Bot(token=os.getenv("TOKEN"))
-dp = Dispatcher()
+# хендлеры регистрируются на роутере при импорте; бот и диспетчер собираются в create_bot/create_dispatcher
+router = Router()
+# повторно доставленный апдейт не обрабатываем второй раз, даже если он пришел на другой инстанс
+update_dedup = UpdateDedupMiddleware(backend)
 
-# путь к файлу логов
-LOG_FILE = "resources/command_logs.txt"
+logger = logging.getLogger(__name__)
 
-DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///bot_database.db")
-engine = create_engine(DATABASE_URL)
-Base = declarative_base()
-session_factory = sessionmaker(bind=engine)
-Session = scoped_session(session_factory)
+activity_tracker = ActivityTracker(save_user_activity)
+# заблокировавшие бота пользователи выключаются и больше не попадают в рассылки;
+# бот у очереди появляется на старте диспетчера
+notifier = Notifier(on_blocked=deactivate_user,
+                    shared_limit=shared_rate_limit("telegram", TELEGRAM_RATE_PER_SEC, 1))
 
-# даша
-class User(Base):
-    __tablename__ = "users"
-
-    id = Column(Integer, primary_key=True)
-    telegram_id = Column(Integer, unique=True, nullable=False)
-    username = Column(String(255), nullable=True)
-    full_name = Column(String(255), nullable=True)
-    language = Column(String(2), default='ru')
-    is_active = Column(Boolean, default=True)
-    first_seen = Column(DateTime, default=func.now())
-    last_activity = Column(DateTime, default=func.now(), onupdate=func.now())
-
-    def __repr__(self):
-        return f"<User(telegram_id={self.telegram_id}, username={self.username})>"
-
-
-Base.metadata.create_all(engine)
-
-
-# функция для получения/создания пользователя
-async def get_or_create_user(user_id, username=None, full_name=None):
-    session = Session()
-    try:
-        user = session.query(User).filter(User.telegram_id == user_id).first()
-        if not user:
-            user = User(
-                telegram_id=user_id,
-                username=username,
-                full_name=full_name
-            )
-            session.add(user)
-            session.commit()
-        return user
-    finally:
-        session.close()
+# рассылки запускают только админы из ADMIN_IDS (telegram id через запятую)
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
 
 
-# функция для обновления времени последней активности
-async def update_user_activity(user_id):
-    session = Session()
-    try:
-        user = session.query(User).filter(User.telegram_id == user_id).first()
-        if user:
-            user.last_activity = func.now()
-            session.commit()
-    finally:
-        session.close()
+# единая точка логирования: отметка активности + запись в журнал команд
+def log_event(user: types.User, kind, value):
+    activity_tracker.record(user.id)
+    command_log.log_user_event(user, kind, value)
 
 
 # функция для логирования команд
 async def log_command(message: types.Message, command: str):
-    user_id = message.from_user.id
-    username = message.from_user.username or "No username"
-    full_name = message.from_user.full_name or "No name"
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    # обновление информации о пользователе в бд
-    await get_or_create_user(user_id, username, full_name)
-    await update_user_activity(user_id)
-
-    log_entry = f"[{timestamp}] User ID: {user_id}, Username: @{username}, Name: {full_name}, Command: {command}\n"
-
-    # создание директории для лога
-    os.makedirs(os.path.dirname(LOG_FILE) if os.path.dirname(LOG_FILE) else '.', exist_ok=True)
-
-    # запись информации в файл
-    with open(LOG_FILE, "a", encoding="utf-8") as log_file:
-        log_file.write(log_entry)
+    log_event(message.from_user, "command", command)
 
 
 # популярные токены
@@ -109,6 +76,28 @@ popular_tokens = {
     'DOGE': 'dogecoin'
 }
 
+# коины в /crypto по умолчанию, поллер держит их цены в памяти вместе с популярными
+DEFAULT_PRICE_COINS = ('bitcoin', 'ethereum', 'tether')
+
+# справочник коинов: тикеры и названия -> id CoinGecko
+coin_resolver = CoinResolver(market_client, aliases=popular_tokens)
+
+# готовые ответы на инлайн-запросы; пустой запрос — популярные токены
+inline_answers = InlineAnswers(coin_resolver, price_service, market_client, popular_tokens.values())
+
+# описания токенов: сжатые тексты на нужных языках в бд, популярные обновляются в фоне
+description_store = DescriptionStore(market_client)
+
+# периоды графиков: кнопка -> число дней
+chart_ranges = {'1d': 1, '7d': 7, '30d': 30, '1y': 365}
+
+# фоновый опрос цен для популярных токенов
+poller = PricePoller(market_client, price_service,
+                     POLL_WATCHLIST or dict.fromkeys([*popular_tokens.values(), *DEFAULT_PRICE_COINS]))
+
+# локальная история цен для остальных коинов и длинных периодов
+history_store = HistoryStore(market_client)
+
 # словари с переводами для интерфейса бота
 translations = {              # катя
     'ru': {
@@ -117,14 +106,22 @@ translations = {              # катя
         "open_menu": "📋 Открыть меню",
         "menu_title": "📋 Меню команд:",
         "menu_crypto": "/crypto — курсы самых популярных криптовалют.",
-        "menu_calc": "/calc <цена_входа> <плечо> <баланс> — калькулятор позиции.",
+        "menu_calc": "/calc [long|short] <вход> <плечо> <баланс> — калькулятор позиции, "
+                     "/calc sweep <вход> <баланс> — карта ROE по плечам, CSV-файл — пакет позиций.",
         "menu_chart": "/chart — выбор коина и его график.",
+        "menu_indicators": "/indicators <коин> [1d|7d|30d|1y] — технические индикаторы.",
         "menu_faq": "/faq — часто задаваемые вопросы и ответы на них.",
         "menu_help": "/help — помощь",
+        "menu_alert": "/alert <коин> above|below <цена> — уведомление о цене, /alert — список.",
         "menu_language": "/language — изменить язык интерфейса.",
         "crypto_prices": "💱 Актуальные курсы:",
         "error": "Ошибка: {}",
-        "calc_usage": "Используй: /calc <вход> <плечо> <баланс>",
+        "calc_usage": "Используй: /calc [long|short] <вход> <плечо> <баланс> [mmr=..] [fee=..] [funding=..], "
+                      "по позиции на строку или CSV-файлом; /calc sweep <вход> <баланс> [long|short] [диапазон%]",
+        "calc_errors": "⚠️ Пропущены строки:",
+        "calc_result_file": "📄 Расчет {} позиций в файле",
+        "calc_file_too_big": "Файл слишком большой, максимум {} КБ.",
+        "calc_sweep_caption": "🔥 {} с маржой {}: ROE при плече 1–{}x и цене ±{}% от входа {}",
         "position_size": "📈 Размер позиции: {}",
         "liquidation_price": "⚠️ Ликвидация: {:.2f}",
         "faq_select": "❓ Выберите вопрос:",
@@ -133,18 +130,57 @@ translations = {              # катя
                      "Я — крипто-бот, помогаю следить за курсами популярных токенов, строить графики и рассчитывать позиции.",
         "why_bot": "🚀 <b>Зачем нужен бот?</b>\n"
                    "- Быстро узнать текущий курс BTC, ETH, SOL и др.\n"
-                   "- Построить 7-дневный график цены.\n"
+                   "- Построить график цены за день, неделю, месяц или год.\n"
                    "- Рассчитать размер позиции и цену ликвидации с любым плечом.",
         "calc_help": "🧮 <b>Как работает /calc?</b>\n"
-                     "Отправьте <code>/calc &lt;цена_входа&gt; &lt;плечо&gt; &lt;баланс&gt;</code>:\n"
+                     "Отправьте <code>/calc [long|short] &lt;цена_входа&gt; &lt;плечо&gt; &lt;баланс&gt;</code>:\n"
+                     "• <b>long/short</b> — направление позиции, по умолчанию long\n"
                      "• <b>цена_входа</b> — цена, по которой вы вошли (например, 20000)\n"
-                     "• <b>плечо</b> — желаемое кредитное плечо (например, 10)\n"
-                     "• <b>баланс</b> — ваш депозит в USD (например, 100)\n"
-                     "Бот вернёт размер позиции и цену ликвидации.",
+                     f"• <b>плечо</b> — кредитное плечо от 1 до {RISK_MAX_LEVERAGE} (например, 10)\n"
+                     "• <b>баланс</b> — маржа позиции в USD (например, 100)\n"
+                     "• необязательно <code>mmr=</code>, <code>fee=</code>, <code>funding=</code> — поддерживающая маржа, "
+                     "комиссия и фандинг долей от объема (например, <code>fee=0.0004</code>)\n"
+                     "Бот вернёт размер позиции и цену ликвидации, с направлением или опциями — таблицу с PnL "
+                     "при движении цены на ±5% и ±10%.\n\n"
+                     "Несколько позиций — по одной на строку под командой или CSV-файлом с колонками "
+                     "<code>side,entry,leverage,balance[,mmr,fee,funding]</code> (заголовок необязателен). "
+                     "Большой пакет бот вернёт файлом.\n\n"
+                     "<code>/calc sweep &lt;цена_входа&gt; &lt;баланс&gt; [long|short] [диапазон%]</code> — "
+                     "тепловая карта ROE для всех плеч и цен в пределах ±диапазона от входа (по умолчанию 20%).",
         "select_token": "Выбери токен для графика:",
-        "chart_caption": "📈 График {} за 7 дней",
+        "chart_caption": "📈 График {} за {}",
+        "periods": {"1d": "1 день", "7d": "7 дней", "30d": "30 дней", "1y": "1 год"},
         "description": "🧾 Описание:",
         "chart_error": "Ошибка при получении данных: {}",
+        "stale_data": "⏳ Данные на {} (обновление задерживается)",
+        "indicators_usage": "Используй: /indicators <коин> [коин ...] [1d|7d|30d|1y]",
+        "indicators_summary": "📊 <b>{coin}</b> за {period}\n"
+                              "Цена: {price} | SMA{sma_window}: {sma} | EMA{ema_span}: {ema}\n"
+                              "RSI{rsi_period}: {rsi} | MACD: {macd} / сигнал {signal}\n"
+                              "Боллинджер: {bb_lower} – {bb_upper}\n"
+                              "Волатильность: {volatility}% годовых",
+        "no_data": "{}: нет данных",
+        "alert_usage": "Используй: /alert <коин> above|below <цена>, удалить: /alert delete <номер>",
+        "alert_directions": {"above": "выше", "below": "ниже"},
+        "alert_created": "🔔 Алерт #{} создан: {} {} {} USD (сейчас {} USD)",
+        "alert_triggered": "🔔 {} {} {} {}: сейчас {} {}",
+        "alert_list": "🔔 Твои алерты:",
+        "alert_list_empty": "У тебя нет активных алертов.",
+        "alert_deleted": "Алерт #{} удален.",
+        "alert_not_found": "Алерт #{} не найден.",
+        "alert_limit": "Можно держать не больше {} алертов, удали ненужные: /alert delete <номер>",
+        "broadcast_usage": "Используй: /broadcast <текст>, /broadcast status, /broadcast cancel <номер>",
+        "broadcast_created": "📣 Рассылка #{} поставлена в очередь, получателей: {}.",
+        "broadcast_status": "📣 #{} {}: {}/{}, отправлено {}, заблокировали {}, ошибок {}, {:.1f} сообщ./с",
+        "broadcast_eta": "осталось ~{} мин",
+        "broadcast_none": "Рассылок еще не было.",
+        "broadcast_cancelled": "Рассылка #{} отменена.",
+        "broadcast_not_found": "Активной рассылки #{} нет.",
+        "broadcast_finished": "📣 Рассылка #{} завершена: отправлено {}, заблокировали бота {}, ошибок {}, {:.1f} сообщ./с",
+        "unknown_coin": "Коин {} не найден.",
+        "did_you_mean": "Может, {}?",
+        "chart_busy": "⏳ Сейчас строится слишком много графиков, попробуй через минуту.",
+        "rate_limited": "⏳ Источник данных ограничил число запросов, попробуй через минуту.",
         "hello_response": "И тебе привет!",
         "bye_response": "До встречи!",
         "unknown_command": "Не понял 😅 Напиши /menu для списка команд.",
@@ -159,14 +195,22 @@ translations = {              # катя
         "open_menu": "📋 Open menu",
         "menu_title": "📋 Command menu:",
         "menu_crypto": "/crypto — rates of the most popular cryptocurrencies.",
-        "menu_calc": "/calc <entry_price> <leverage> <balance> — position calculator.",
+        "menu_calc": "/calc [long|short] <entry> <leverage> <balance> — position calculator, "
+                     "/calc sweep <entry> <balance> — ROE map across leverages, a CSV file — a batch of positions.",
         "menu_chart": "/chart — select a coin and see its chart.",
+        "menu_indicators": "/indicators <coin> [1d|7d|30d|1y] — technical indicators.",
         "menu_faq": "/faq — frequently asked questions and answers.",
         "menu_help": "/help — help",
+        "menu_alert": "/alert <coin> above|below <price> — price notification, /alert — list.",
         "menu_language": "/language — change interface language.",
         "crypto_prices": "💱 Current rates:",
         "error": "Error: {}",
-        "calc_usage": "Usage: /calc <entry> <leverage> <balance>",
+        "calc_usage": "Usage: /calc [long|short] <entry> <leverage> <balance> [mmr=..] [fee=..] [funding=..], "
+                      "one position per line or as a CSV file; /calc sweep <entry> <balance> [long|short] [range%]",
+        "calc_errors": "⚠️ Skipped lines:",
+        "calc_result_file": "📄 Results for {} positions in the file",
+        "calc_file_too_big": "The file is too big, at most {} KB.",
+        "calc_sweep_caption": "🔥 {} with margin {}: ROE for leverage 1–{}x and price ±{}% of entry {}",
         "position_size": "📈 Position size: {}",
         "liquidation_price": "⚠️ Liquidation: {:.2f}",
         "faq_select": "❓ Select a question:",
@@ -175,18 +219,57 @@ translations = {              # катя
                      "I'm a crypto bot, helping you track popular token rates, build charts and calculate positions.",
         "why_bot": "🚀 <b>Why use this bot?</b>\n"
                    "- Quickly check current BTC, ETH, SOL rates and more.\n"
-                   "- Build a 7-day price chart.\n"
+                   "- Build a price chart for a day, week, month or year.\n"
                    "- Calculate position size and liquidation price with any leverage.",
         "calc_help": "🧮 <b>How does /calc work?</b>\n"
-                     "Send <code>/calc &lt;entry_price&gt; &lt;leverage&gt; &lt;balance&gt;</code>:\n"
+                     "Send <code>/calc [long|short] &lt;entry_price&gt; &lt;leverage&gt; &lt;balance&gt;</code>:\n"
+                     "• <b>long/short</b> — position side, long by default\n"
                      "• <b>entry_price</b> — price at which you entered (e.g., 20000)\n"
-                     "• <b>leverage</b> — desired leverage (e.g., 10)\n"
-                     "• <b>balance</b> — your deposit in USD (e.g., 100)\n"
-                     "The bot will return position size and liquidation price.",
+                     f"• <b>leverage</b> — leverage from 1 to {RISK_MAX_LEVERAGE} (e.g., 10)\n"
+                     "• <b>balance</b> — position margin in USD (e.g., 100)\n"
+                     "• optional <code>mmr=</code>, <code>fee=</code>, <code>funding=</code> — maintenance margin, "
+                     "fee and funding as a fraction of the position size (e.g., <code>fee=0.0004</code>)\n"
+                     "The bot will return position size and liquidation price; with a side or options, a table with PnL "
+                     "for a ±5% and ±10% price move.\n\n"
+                     "Several positions — one per line below the command, or a CSV file with columns "
+                     "<code>side,entry,leverage,balance[,mmr,fee,funding]</code> (the header is optional). "
+                     "A large batch comes back as a file.\n\n"
+                     "<code>/calc sweep &lt;entry_price&gt; &lt;balance&gt; [long|short] [range%]</code> — "
+                     "ROE heat map for every leverage and price within ±range of the entry (20% by default).",
         "select_token": "Select a token for the chart:",
-        "chart_caption": "📈 {} chart for 7 days",
+        "chart_caption": "📈 {} chart for {}",
+        "periods": {"1d": "1 day", "7d": "7 days", "30d": "30 days", "1y": "1 year"},
         "description": "🧾 Description:",
         "chart_error": "Error getting data: {}",
+        "stale_data": "⏳ Data as of {} (update delayed)",
+        "indicators_usage": "Usage: /indicators <coin> [coin ...] [1d|7d|30d|1y]",
+        "indicators_summary": "📊 <b>{coin}</b> for {period}\n"
+                              "Price: {price} | SMA{sma_window}: {sma} | EMA{ema_span}: {ema}\n"
+                              "RSI{rsi_period}: {rsi} | MACD: {macd} / signal {signal}\n"
+                              "Bollinger: {bb_lower} – {bb_upper}\n"
+                              "Volatility: {volatility}% annualized",
+        "no_data": "{}: no data",
+        "alert_usage": "Usage: /alert <coin> above|below <price>, delete: /alert delete <number>",
+        "alert_directions": {"above": "above", "below": "below"},
+        "alert_created": "🔔 Alert #{} created: {} {} {} USD (now {} USD)",
+        "alert_triggered": "🔔 {} is {} {} {}: now {} {}",
+        "alert_list": "🔔 Your alerts:",
+        "alert_list_empty": "You have no active alerts.",
+        "alert_deleted": "Alert #{} deleted.",
+        "alert_not_found": "Alert #{} not found.",
+        "alert_limit": "You can keep at most {} alerts, delete unused ones: /alert delete <number>",
+        "broadcast_usage": "Usage: /broadcast <text>, /broadcast status, /broadcast cancel <number>",
+        "broadcast_created": "📣 Broadcast #{} queued, recipients: {}.",
+        "broadcast_status": "📣 #{} {}: {}/{}, sent {}, blocked {}, failed {}, {:.1f} msg/s",
+        "broadcast_eta": "~{} min left",
+        "broadcast_none": "No broadcasts yet.",
+        "broadcast_cancelled": "Broadcast #{} cancelled.",
+        "broadcast_not_found": "No active broadcast #{}.",
+        "broadcast_finished": "📣 Broadcast #{} finished: sent {}, blocked the bot {}, failed {}, {:.1f} msg/s",
+        "unknown_coin": "Coin {} not found.",
+        "did_you_mean": "Did you mean {}?",
+        "chart_busy": "⏳ Too many charts are being built right now, try again in a minute.",
+        "rate_limited": "⏳ The data provider is rate limiting us, try again in a minute.",
         "hello_response": "Hello to you too!",
         "bye_response": "See you later!",
         "unknown_command": "I don't understand 😅 Type /menu for a list of commands.",
@@ -237,118 +320,251 @@ faq_data = {     #катя
     }
 }
 
-# даша
-# получение языка пользователя из бд
-async def get_user_language(user_id):
-    session = Session()
-    try:
-        user = session.query(User).filter(User.telegram_id == user_id).first()
-        if user:
-            return user.language
-        return 'ru'  # дефолтный язык
-    finally:
-        session.close()
 
+# загрузка профиля при промахе кэша: создаем пользователя и читаем язык одним запросом
+async def load_user_language(user: types.User):
+    return await upsert_user(user.id, user.username or "No username", user.full_name or "No name")
 
-# установка языка пользователя в бд
-async def set_user_language(user_id, language):
-    session = Session()
-    try:
-        user = session.query(User).filter(User.telegram_id == user_id).first()
-        if user:
-            user.language = language
-            session.commit()
-    finally:
-        session.close()
+
+profiles = UserProfiles(load_user_language, set_user_language, shared=shared_backend)
+user_middleware = UserMiddleware(profiles)
+router.message.outer_middleware(user_middleware)
+router.callback_query.outer_middleware(user_middleware)
 
 
 # Получение курсов криптовалют
-def get_crypto_price(symbols=('bitcoin', 'ethereum', 'tether'), currency='usd'):
-    url = "https://api.coingecko.com/api/v3/simple/price"
-    response = requests.get(url, params={'ids': ','.join(symbols), 'vs_currencies': currency})
-    data = response.json()
+@timed
+async def get_crypto_price(symbols=DEFAULT_PRICE_COINS, currency='usd', lang='ru'):
+    # популярные токены отдаем из памяти поллера, недостающие — через кэш цен
+    snapshot = poller.get_prices(symbols, currency)
+    data = {symbol: price for symbol, (price, _) in snapshot.items()}
+    missing = [symbol for symbol in symbols if symbol not in snapshot]
+    if missing:
+        data.update(await price_service.get_prices(missing, currency))
 
     result = []
     for symbol in symbols:
-        price = data.get(symbol, {}).get(currency)
+        price = data.get(symbol)
         if price:
             result.append(f"{symbol.upper()}: {price} {currency.upper()}")
+
+    if snapshot:
+        updated_at = min(ts for _, ts in snapshot.values())
+        if poller.is_stale(updated_at):
+            result.append(stale_marker(updated_at, lang))
     return '\n'.join(result)
 
 
-# Калькулятор позиции и ликвидации
+# цены для движка алертов: снапшот поллера или общий кэш цен с объединением запросов.
+# проверки движка идут фоновым приоритетом и не отнимают у пользователей резерв лимита апи
+async def get_alert_prices(coin_ids, currency='usd', priority=BACKGROUND):
+    snapshot = poller.get_prices(coin_ids, currency)
+    prices = {coin_id: price for coin_id, (price, _) in snapshot.items()}
+    missing = [coin_id for coin_id in coin_ids if coin_id not in snapshot]
+    if missing:
+        prices.update(await price_service.get_prices(missing, currency, priority))
+    return prices
+
+
+# уведомление о сработавшем алерте уходит через очередь с лимитами телеграма
+async def send_alert(alert, price):
+    lang = profiles.cache.get(alert.user_id) or await get_user_language(alert.user_id)
+    notifier.notify(alert.user_id, translations[lang]["alert_triggered"].format(
+        alert.coin_id.upper(), translations[lang]["alert_directions"][alert.direction],
+        format_number(alert.threshold), alert.currency.upper(), format_number(price), alert.currency.upper()
+    ))
+
+
+alert_engine = AlertEngine(load_active_alerts, deactivate_alerts, get_alert_prices, send_alert)
+
+
+# итог рассылки — автору
+async def report_broadcast(job):
+    if job.created_by is None:
+        return
+    lang = profiles.cache.get(job.created_by) or await get_user_language(job.created_by)
+    notifier.notify(job.created_by, translations[lang]["broadcast_finished"].format(
+        job.id, job.sent, job.blocked, job.failed, job.rate
+    ))
+
+
+broadcaster = Broadcaster(notifier, on_finish=report_broadcast)
+
+# направление алерта: по-английски, по-русски или знаком
+alert_directions = {'above': ABOVE, 'выше': ABOVE, '>': ABOVE, 'below': BELOW, 'ниже': BELOW, '<': BELOW}
+
+
+# тикеры/названия из сообщения -> id коинов без повторов и список нераспознанных
+def resolve_coins(texts):
+    coin_ids, unknown = [], []
+    for text in texts:
+        coin_id = coin_resolver.resolve(text)
+        if coin_id is None:
+            unknown.append(text)
+        elif coin_id not in coin_ids:
+            coin_ids.append(coin_id)
+    return coin_ids, unknown
+
+
+def unknown_coins_message(unknown, lang='ru'):
+    lines = []
+    for text in unknown:
+        line = translations[lang]["unknown_coin"].format(text)
+        suggestions = coin_resolver.suggest(text)
+        if suggestions:
+            line += " " + translations[lang]["did_you_mean"].format(", ".join(suggestions))
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def stale_marker(updated_at, lang='ru'):
+    return translations[lang]["stale_data"].format(datetime.fromtimestamp(updated_at).strftime("%H:%M"))
+
+
+# Калькулятор позиции и ликвидации (лонг с изолированной маржой, комиссии и mmr по умолчанию)
 def calculate_position(entry_price: float, leverage: float, balance: float):
-    position_size = balance * leverage
-    liquidation_price = entry_price - (entry_price * (1 / leverage)) if leverage != 0 else 0
+    result = evaluate(Positions(LONG, entry_price, leverage, balance))
     return {
-        "position_size": position_size,
-        "liquidation_price": liquidation_price
+        "position_size": float(result["notional"]),
+        "liquidation_price": float(result["liquidation"])
     }
 
 
+CALC_TABLE_ROWS = 30          # больше позиций — ответ файлом
+CALC_MAX_FILE_KB = 1024
+CALC_SWEEP_POINTS = 400       # цен в сетке тепловой карты
+
+
+# расчет пакета позиций: таблица в сообщении или csv-файл для больших пакетов
+async def answer_positions(message: types.Message, token_rows, lang):
+    positions, errors = build_positions(token_rows)
+    if errors:
+        lines = [f"{number}: {error}" for number, error in errors[:10]]
+        if len(errors) > 10:
+            lines.append(f"… +{len(errors) - 10}")
+        await message.answer("\n".join([translations[lang]["calc_errors"], *lines]))
+    if not len(positions):
+        await message.answer(translations[lang]["calc_usage"])
+        return
+
+    result = evaluate(positions)
+    if len(positions) <= CALC_TABLE_ROWS:
+        await message.answer(f"<pre>{format_table(positions, result, lang)}</pre>", parse_mode="HTML")
+    else:
+        data = await asyncio.to_thread(to_csv, positions, result)
+        await message.answer_document(
+            BufferedInputFile(data, filename="positions.csv"),
+            caption=translations[lang]["calc_result_file"].format(len(positions))
+        )
+
+
+# /calc sweep <вход> <баланс> [long|short] [диапазон%]: ROE по всем плечам и ценам одной матрицей
+async def answer_sweep(message: types.Message, args, lang):
+    side = next((SIDES[a] for a in args if a in SIDES), LONG)
+    numbers = [float(a.replace(',', '.').rstrip('%')) for a in args if a not in SIDES]
+    if len(numbers) not in (2, 3) or numbers[0] <= 0 or numbers[1] <= 0:
+        raise ValueError(translations[lang]['calc_usage'])
+    entry, balance = numbers[:2]
+    spread = min(max(numbers[2], 1.0), 99.0) if len(numbers) == 3 else 20.0
+
+    prices = np.linspace(entry * (1 - spread / 100), entry * (1 + spread / 100), CALC_SWEEP_POINTS)
+    leverages = np.arange(1, RISK_MAX_LEVERAGE + 1)
+    roe, liquidation = leverage_sweep(entry, balance, prices, side, leverages)
+    side_name = "long" if side == LONG else "short"
+    png = await chart_renderer.render("render_leverage_heatmap", leverages, prices, roe, liquidation, entry, side_name, lang)
+    await message.answer_photo(
+        BufferedInputFile(png, filename="sweep.png"),
+        caption=translations[lang]["calc_sweep_caption"].format(
+            side_name.upper(), format_number(balance), RISK_MAX_LEVERAGE, format_number(spread), format_number(entry)
+        )
+    )
+
+
 # История цены и график
-def get_price_history(symbol='bitcoin', currency='usd', days=7):
-    url = f'https://api.coingecko.com/api/v3/coins/{symbol}/market_chart'
-    params = {'vs_currency': currency, 'days': days}
-    res = requests.get(url, params=params)
-    res.raise_for_status()
-    data = res.json()
-    return [(x[0], x[1]) for x in data['prices']]
-
-
-def generate_price_chart(symbol='bitcoin', currency='usd', lang='ru'):
-    history = get_price_history(symbol, currency)
-    timestamps = [datetime.fromtimestamp(ts / 1000).strftime('%b %d') for ts, _ in history]
-    prices = [price for _, price in history]
-
-    plt.figure(figsize=(8, 4))
-    plt.plot(timestamps, prices, label=f"{symbol.upper()}", color='blue')
-    plt.xticks(rotation=45)
-
-    # заголовок графика на основе выбранного языка
-    title = f"{symbol.upper()} Цена за 7 дней" if lang == 'ru' else f"{symbol.upper()} Price for 7 days"
-    x_label = "Дата" if lang == 'ru' else "Date"
-    y_label = f"Цена в {currency.upper()}" if lang == 'ru' else f"Price in {currency.upper()}"
-
-    plt.title(title)
-    plt.xlabel(x_label)
-    plt.ylabel(y_label)
-    plt.tight_layout()
-    plt.grid(True)
-    plt.legend()
-
-    buf = BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
-    plt.close()
-    return buf
+@timed
+async def get_price_history(symbol='bitcoin', currency='usd', days=7):
+    cached = poller.get_history(symbol, currency, days)
+    if cached is not None:
+        return cached[0]
+    # остальное — из локального хранилища с докачкой хвоста
+    return await history_store.get_history(symbol, currency, days)
+
+
+# возвращает ключ и запись кэша графиков (png и, если уже отправляли, file_id).
+# версия берется из состояния синхронизации, сами точки читаются из бд только при промахе кэша
+async def generate_price_chart(symbol='bitcoin', currency='usd', lang='ru', period='7d'):
+    days = chart_ranges[period]
+    cached = poller.get_history(symbol, currency, days)
+    if cached is not None:
+        last_ts = cached[0][-1][0] if cached[0] else 0
+    else:
+        last_ts = await history_store.sync(symbol, currency, days)
+    key = (symbol, currency, lang, period, chart_version(last_ts))
+    period_label = translations[lang]["periods"][period]
+
+    async def render():
+        history = cached[0] if cached is not None else await history_store.load(symbol, currency, days)
+        # в воркер уходят уже прореженные массивы, не больше двух точек на пиксель
+        return await chart_renderer.render(
+            "render_price_chart", *downsample_minmax(*price_series(history)), symbol, currency, lang, period_label
+        )
 
+    entry = await chart_cache.get_or_render(key, render)
+    return key, entry
 
-# Получение описания токена
-def get_token_description(symbol='bitcoin', lang='ru'):
-    url = f"https://api.coingecko.com/api/v3/coins/{symbol}"
-    res = requests.get(url, params={"localization": "true"})
-    res.raise_for_status()
-    data = res.json()
 
-    desc = data.get("description", {}).get(lang) or data.get("description", {}).get("en", "")
-    return desc.strip()[
-           :1000] + "..." if desc else "Описание недоступно." if lang == 'ru' else "Description not available."
+# индикаторы по той же истории, что и график, на сетке шага окна
+@timed
+async def get_indicators(symbol='bitcoin', currency='usd', period='7d'):
+    history = await get_price_history(symbol, currency, chart_ranges[period])
+    series = indicator_engine.compute((symbol, currency, period), *price_series(history),
+                                      resolution_for(chart_ranges[period]) * 1000)
+    return history, series
 
 
-# Хендлеры
+async def generate_indicator_chart(symbol, history, series, currency='usd', lang='ru', period='7d'):
+    key = (symbol, currency, lang, period, chart_version(history[-1][0] if history else 0), "indicators")
+    period_label = translations[lang]["periods"][period]
+    entry = await chart_cache.get_or_render(
+        key,
+        lambda: chart_renderer.render(
+            "render_indicator_chart", series.arrays(downsample_indices(series.price)), symbol, currency, lang, period_label
+        )
+    )
+    return key, entry
 
-@dp.message(CommandStart())
-async def start_cmd(message: types.Message):  # катя
-    await log_command(message, "/start")
-    user_id = message.from_user.id
-    username = message.from_user.username or "No username"
-    full_name = message.from_user.full_name or "No name"
 
-    # создаем или получаем запись пользователя
-    await get_or_create_user(user_id, username, full_name)
+# крупные значения с двумя знаками, мелкие (дешевые токены, MACD) — по значащим цифрам
+def format_number(value):
+    if math.isnan(value):
+        return "—"
+    return f"{value:.2f}" if abs(value) >= 1 else f"{value:.4g}"
 
-    lang = await get_user_language(user_id)
+
+def format_indicators(symbol, series, lang='ru', period='7d'):
+    summary = series.summary()
+    if summary is None:
+        return translations[lang]["no_data"].format(symbol.upper())
+    values = {name: format_number(value) for name, value in summary.items()}
+    values["volatility"] = "—" if math.isnan(summary["volatility"]) else f"{summary['volatility']:.1f}"
+    return translations[lang]["indicators_summary"].format(
+        coin=symbol.upper(), period=translations[lang]["periods"][period],
+        sma_window=SMA_WINDOW, ema_span=EMA_SPAN, rsi_period=RSI_PERIOD, **values
+    )
+
+
+# Получение описания токена
+@timed
+async def get_token_description(symbol='bitcoin', lang='ru'):
+    desc = await description_store.get(symbol, lang)
+    return desc or ("Описание недоступно." if lang == 'ru' else "Description not available.")
+
+
+# Хендлеры
+
+@router.message(CommandStart())
+async def start_cmd(message: types.Message, lang: str):  # катя
+    await log_command(message, "/start")
 
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -361,65 +577,260 @@ async def start_cmd(message: types.Message):  # катя
     )
 
 # катя
-@dp.message(Command("menu"))
-async def menu_cmd(message: types.Message):
+@router.message(Command("menu"))
+async def menu_cmd(message: types.Message, lang: str):
     await log_command(message, "/menu")
-    user_id = message.from_user.id
-    lang = await get_user_language(user_id)
 
     await message.answer(
         f"{translations[lang]['menu_title']}\n"
         f"{translations[lang]['menu_crypto']}\n"
         f"{translations[lang]['menu_calc']}\n"
         f"{translations[lang]['menu_chart']}\n"
+        f"{translations[lang]['menu_indicators']}\n"
+        f"{translations[lang]['menu_alert']}\n"
         f"{translations[lang]['menu_faq']}\n"
         f"{translations[lang]['menu_help']}\n"
         f"{translations[lang]['menu_language']}"
     )
 
 # катя
-@dp.message(Command("crypto"))
-async def crypto_cmd(message: types.Message):
+@router.message(Command("crypto"))
+async def crypto_cmd(message: types.Message, lang: str):
     await log_command(message, message.text)  # логируем полную команду с аргументами
-    user_id = message.from_user.id
-    lang = await get_user_language(user_id)
 
     try:
         parts = message.text.split()
-        tokens = [t.lower() for t in parts[1:]] if len(parts) > 1 else ['bitcoin', 'ethereum', 'tether']
-        prices = get_crypto_price(tokens)
-        await message.answer(f"{translations[lang]['crypto_prices']}\n{prices}")
+        # тикеры и названия переводятся в id до запроса, неверные не уходят в апи
+        tokens, unknown = resolve_coins(parts[1:]) if len(parts) > 1 else (list(DEFAULT_PRICE_COINS), [])
+        if unknown:
+            await message.answer(unknown_coins_message(unknown, lang))
+        if tokens:
+            prices = await get_crypto_price(tokens, lang=lang)
+            await message.answer(f"{translations[lang]['crypto_prices']}\n{prices}")
+    except RateLimitedError:
+        await message.answer(translations[lang]["rate_limited"])
     except Exception as e:
         await message.answer(translations[lang]['error'].format(str(e)))
 
 # даша
-@dp.message(Command("calc"))
-async def calc_cmd(message: types.Message):
+@router.message(Command("calc"))
+async def calc_cmd(message: types.Message, lang: str):
     await log_command(message, message.text)
-    user_id = message.from_user.id
-    lang = await get_user_language(user_id)
 
     try:
-        parts = message.text.split()
-        if len(parts) != 4:
-            raise ValueError(translations[lang]['calc_usage'])
-        entry = float(parts[1])
-        leverage = float(parts[2])
-        balance = float(parts[3])
-        result = calculate_position(entry, leverage, balance)
-        await message.answer(
-            f"{translations[lang]['position_size'].format(result['position_size'])}\n"
-            f"{translations[lang]['liquidation_price'].format(result['liquidation_price'])}"
-        )
+        # первая строка — аргументы команды, следующие строки — еще позиции
+        first, *rest = message.text.split("\n")
+        args = first.split()[1:]
+        if args and args[0].lower() == "sweep":
+            await answer_sweep(message, [a.lower() for a in args[1:]], lang)
+            return
+
+        rows = ([args] if args else []) + [line.split() for line in rest if line.strip()]
+        if len(rows) == 1 and len(rows[0]) == 3 and rows[0][0].lower() not in SIDES:
+            # одна позиция в старом формате <вход> <плечо> <баланс> — прежний короткий ответ
+            try:
+                entry, leverage, balance = (float(a.replace(',', '.')) for a in rows[0])
+            except ValueError:
+                entry = leverage = balance = 0
+            if entry <= 0 or balance <= 0 or not 1 <= leverage <= RISK_MAX_LEVERAGE:
+                await message.answer(translations[lang]['calc_usage'])
+                return
+            result = calculate_position(entry, leverage, balance)
+            await message.answer(
+                f"{translations[lang]['position_size'].format(result['position_size'])}\n"
+                f"{translations[lang]['liquidation_price'].format(result['liquidation_price'])}"
+            )
+            return
+        await answer_positions(message, rows, lang)
+    except ChartBusyError:
+        await message.answer(translations[lang]["chart_busy"])
+    except Exception as e:
+        await message.answer(translations[lang]['error'].format(str(e)))
+
+
+# позиции CSV-файлом: колонки side,entry,leverage,balance[,mmr,fee,funding], заголовок необязателен
+@router.message(F.document.file_name.lower().endswith(".csv"))
+async def calc_csv(message: types.Message, lang: str):
+    log_event(message.from_user, "document", message.document.file_name)
+
+    try:
+        if (message.document.file_size or 0) > CALC_MAX_FILE_KB * 1024:
+            await message.answer(translations[lang]["calc_file_too_big"].format(CALC_MAX_FILE_KB))
+            return
+        data = await message.bot.download(message.document, destination=BytesIO())
+        rows = parse_csv(data.getvalue().decode("utf-8-sig", errors="replace"))
+        await answer_positions(message, rows, lang)
+    except Exception as e:
+        await message.answer(translations[lang]['error'].format(str(e)))
+
+# даша
+@router.message(Command("indicators"))
+async def indicators_cmd(message: types.Message, lang: str):
+    await log_command(message, message.text)
+
+    # /indicators <коин> [коин ...] [период]
+    args = [a.lower() for a in message.text.split()[1:]]
+    period = args.pop() if args and args[-1] in chart_ranges else '7d'
+    if not args:
+        await message.answer(translations[lang]["indicators_usage"])
+        return
+    args, unknown = resolve_coins(args)
+    if unknown:
+        await message.answer(unknown_coins_message(unknown, lang))
+    if not args:
+        return
+    try:
+        results = await asyncio.gather(*(get_indicators(coin, period=period) for coin in args))
+        text = "\n\n".join(format_indicators(coin, series, lang, period) for coin, (_, series) in zip(args, results))
+
+        history, series = results[0]
+        if len(args) > 1 or not len(series):
+            # по нескольким коинам только сводка, без графиков
+            await message.answer(text, parse_mode="HTML")
+            return
+
+        chart_key, chart = await generate_indicator_chart(args[0], history, series, lang=lang, period=period)
+        photo = chart.file_id or BufferedInputFile(chart.png, filename=f"{args[0]}_indicators.png")
+        sent = await message.answer_photo(photo=photo, caption=text, parse_mode="HTML")
+        if chart.file_id is None and sent.photo:
+            await chart_cache.set_file_id(chart_key, sent.photo[-1].file_id)
+    except ChartBusyError:
+        await message.answer(translations[lang]["chart_busy"])
+    except RateLimitedError:
+        await message.answer(translations[lang]["rate_limited"])
+    except Exception as e:
+        await message.answer(translations[lang]["chart_error"].format(str(e)))
+
+# порог алерта: положительное конечное число, запятая тоже считается разделителем
+def parse_price(text):
+    try:
+        value = float(text.replace(',', '.'))
+    except ValueError:
+        return None
+    return value if math.isfinite(value) and value > 0 else None
+
+
+# даша
+@router.message(Command("alert"))
+async def alert_cmd(message: types.Message, lang: str):
+    await log_command(message, message.text)
+
+    user_id = message.from_user.id
+    args = [a.lower() for a in message.text.split()[1:]]
+    try:
+        # без аргументов — список активных алертов
+        if not args:
+            alerts = await list_user_alerts(user_id)
+            if not alerts:
+                await message.answer(f"{translations[lang]['alert_list_empty']}\n{translations[lang]['alert_usage']}")
+                return
+            lines = [
+                f"#{a.id} {a.coin_id.upper()} {translations[lang]['alert_directions'][a.direction]} "
+                f"{format_number(a.threshold)} {a.currency.upper()}"
+                for a in alerts
+            ]
+            await message.answer("\n".join([translations[lang]["alert_list"], *lines]))
+            return
+
+        # /alert delete <номер>
+        if args[0] in ('delete', 'del', 'удалить') and len(args) == 2:
+            alert_id = int(args[1].lstrip('#'))
+            if await delete_price_alert(user_id, alert_id):
+                alert_engine.remove(alert_id)
+                await message.answer(translations[lang]["alert_deleted"].format(alert_id))
+            else:
+                await message.answer(translations[lang]["alert_not_found"].format(alert_id))
+            return
+
+        if len(args) != 3 or args[1] not in alert_directions:
+            raise ValueError(translations[lang]["alert_usage"])
+        coin_id, direction, threshold = coin_resolver.resolve(args[0]), alert_directions[args[1]], parse_price(args[2])
+        if threshold is None:
+            raise ValueError(translations[lang]["alert_usage"])
+        if coin_id is None:
+            await message.answer(unknown_coins_message([args[0]], lang))
+            return
+
+        if len(await list_user_alerts(user_id)) >= ALERTS_PER_USER:
+            await message.answer(translations[lang]["alert_limit"].format(ALERTS_PER_USER))
+            return
+        price = (await get_alert_prices([coin_id], priority=INTERACTIVE)).get(coin_id)
+        if price is None:
+            await message.answer(translations[lang]["unknown_coin"].format(coin_id))
+            return
+
+        alert = await add_price_alert(user_id, coin_id, 'usd', direction, threshold)
+        alert_engine.add(alert)
+        await message.answer(translations[lang]["alert_created"].format(
+            alert.id, coin_id.upper(), translations[lang]["alert_directions"][direction],
+            format_number(threshold), format_number(price)
+        ))
+    except RateLimitedError:
+        await message.answer(translations[lang]["rate_limited"])
     except Exception as e:
         await message.answer(translations[lang]['error'].format(str(e)))
 
 # катя
-@dp.message(Command("faq"))
-async def faq_cmd(message: types.Message):
+# рассылка всем активным пользователям, только для админов
+@router.message(Command("broadcast"))
+async def broadcast_cmd(message: types.Message, lang: str):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer(translations[lang]["unknown_command"])
+        return
+    await log_command(message, "/broadcast")
+
+    # текст рассылки — все после команды, с переносами строк
+    parts = message.text.split(maxsplit=1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    args = text.lower().split()
+    try:
+        if not text:
+            await message.answer(translations[lang]["broadcast_usage"])
+            return
+
+        if args == ['status']:
+            broadcasts = await list_broadcasts()
+            if not broadcasts:
+                await message.answer(translations[lang]["broadcast_none"])
+                return
+            lines = []
+            for b in broadcasts:
+                job = broadcaster.job if broadcaster.job is not None and broadcaster.job.id == b.id else None
+                if job is not None:
+                    # рассылку ведет этот воркер — свежие счетчики из памяти
+                    sent, failed, blocked, rate = job.sent, job.failed, job.blocked, job.rate
+                else:
+                    sent, failed, blocked = b.sent, b.failed, b.blocked
+                    elapsed = (b.finished_at or b.heartbeat or 0) - (b.started_at or 0)
+                    rate = sent / elapsed if b.started_at and elapsed > 0 else 0.0
+                line = translations[lang]["broadcast_status"].format(
+                    b.id, b.status, sent + failed + blocked, b.total, sent, blocked, failed, rate
+                )
+                if job is not None and job.eta is not None:
+                    line += ", " + translations[lang]["broadcast_eta"].format(math.ceil(job.eta / 60))
+                lines.append(line)
+            await message.answer("\n".join(lines))
+            return
+
+        # /broadcast cancel <номер>
+        if len(args) == 2 and args[0] in ('cancel', 'отмена'):
+            broadcast_id = int(args[1].lstrip('#'))
+            if await cancel_broadcast(broadcast_id):
+                await message.answer(translations[lang]["broadcast_cancelled"].format(broadcast_id))
+            else:
+                await message.answer(translations[lang]["broadcast_not_found"].format(broadcast_id))
+            return
+
+        broadcast_id, total = await create_broadcast(text, message.from_user.id)
+        broadcaster.wake()
+        await message.answer(translations[lang]["broadcast_created"].format(broadcast_id, total))
+    except Exception as e:
+        await message.answer(translations[lang]['error'].format(str(e)))
+
+
+@router.message(Command("faq"))
+async def faq_cmd(message: types.Message, lang: str):
     await log_command(message, "/faq")
-    user_id = message.from_user.id
-    lang = await get_user_language(user_id)
 
     buttons = [
         [InlineKeyboardButton(text=faq_data[lang][qid]["question"], callback_data=f"faq_{qid}")]
@@ -429,22 +840,10 @@ async def faq_cmd(message: types.Message):
     await message.answer(translations[lang]["faq_select"], reply_markup=keyboard)
 
 
-@dp.callback_query(lambda c: c.data.startswith("faq_"))
-async def answer_faq(callback: CallbackQuery):
-    user_id = callback.from_user.id
-    username = callback.from_user.username or "No username"
-    full_name = callback.from_user.full_name or "No name"
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    # Обновление активности пользователя
-    await update_user_activity(user_id)
-
-    lang = await get_user_language(user_id)
-
-    # логируем callback-запросы
-    log_entry = f"[{timestamp}] User ID: {user_id}, Username: @{username}, Name: {full_name}, Callback: {callback.data}\n"
-    with open(LOG_FILE, "a", encoding="utf-8") as log_file:
-        log_file.write(log_entry)
+@router.callback_query(lambda c: c.data.startswith("faq_"))
+async def answer_faq(callback: CallbackQuery, lang: str):
+    # логируем callback-запрос и обновляем активность
+    log_event(callback.from_user, "callback", callback.data)
 
     qid = callback.data.split("_", 1)[1]
     faq = faq_data[lang].get(qid)
@@ -455,11 +854,9 @@ async def answer_faq(callback: CallbackQuery):
     await callback.answer()
 
 # катя
-@dp.message(Command("help"))
-async def help_cmd(message: types.Message):
+@router.message(Command("help"))
+async def help_cmd(message: types.Message, lang: str):
     await log_command(message, "/help")
-    user_id = message.from_user.id
-    lang = await get_user_language(user_id)
 
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -476,30 +873,18 @@ async def help_cmd(message: types.Message):
     )
 
 # даша
-@dp.callback_query(lambda c: c.data == "open_menu")
-async def open_menu_callback(callback: CallbackQuery):
-    user_id = callback.from_user.id
-    username = callback.from_user.username or "No username"
-    full_name = callback.from_user.full_name or "No name"
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    # Обновление активности пользователя
-    await update_user_activity(user_id)
+@router.callback_query(lambda c: c.data == "open_menu")
+async def open_menu_callback(callback: CallbackQuery, lang: str):
+    # логируем callback-запрос и обновляем активность
+    log_event(callback.from_user, "callback", callback.data)
 
-    # логируем callback-запросы
-    log_entry = f"[{timestamp}] User ID: {user_id}, Username: @{username}, Name: {full_name}, Callback: open_menu\n"
-    with open(LOG_FILE, "a", encoding="utf-8") as log_file:
-        log_file.write(log_entry)
-
-    await menu_cmd(callback.message)
+    await menu_cmd(callback.message, lang)
     await callback.answer()
 
 # даша
-@dp.message(Command("chart"))
-async def chart_menu(message: types.Message):
+@router.message(Command("chart"))
+async def chart_menu(message: types.Message, lang: str):
     await log_command(message, "/chart")
-    user_id = message.from_user.id
-    lang = await get_user_language(user_id)
 
     buttons = [
         [InlineKeyboardButton(text=name, callback_data=f"chart_{token}")]
@@ -509,44 +894,70 @@ async def chart_menu(message: types.Message):
     await message.answer(translations[lang]["select_token"], reply_markup=keyboard)
 
 
-@dp.callback_query(lambda c: c.data.startswith("chart_"))
-async def send_chart(callback: CallbackQuery):
-    user_id = callback.from_user.id
-    username = callback.from_user.username or "No username"
-    full_name = callback.from_user.full_name or "No name"
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    # обновление активности пользователя
-    await update_user_activity(user_id)
-
-    lang = await get_user_language(user_id)
+@router.callback_query(lambda c: c.data.startswith("chart_"))
+async def send_chart(callback: CallbackQuery, lang: str):
+    # логируем callback-запрос и обновляем активность
+    log_event(callback.from_user, "callback", callback.data)
 
-    # логирование callback-запросов с выбором графика
-    log_entry = f"[{timestamp}] User ID: {user_id}, Username: @{username}, Name: {full_name}, Callback: {callback.data}\n"
-    with open(LOG_FILE, "a", encoding="utf-8") as log_file:
-        log_file.write(log_entry)
-
-    token = callback.data.split("_", 1)[1]
+    # chart_<коин> или chart_<коин>:<период> с кнопок под графиком
+    token, _, period = callback.data.split("_", 1)[1].partition(":")
+    first_view = not period
+    if period not in chart_ranges:
+        period = '7d'
     try:
-        chart_buf = generate_price_chart(token, lang=lang)
-        desc = get_token_description(token, lang)
-
-        photo = BufferedInputFile(chart_buf.read(), filename=f"{token}.png")
-        await callback.message.answer_photo(
+        if first_view:
+            # график и описание грузятся параллельно
+            (chart_key, chart), desc = await asyncio.gather(
+                generate_price_chart(token, lang=lang, period=period),
+                get_token_description(token, lang)
+            )
+        else:
+            chart_key, chart = await generate_price_chart(token, lang=lang, period=period)
+
+        caption = translations[lang]["chart_caption"].format(token.upper(), translations[lang]["periods"][period])
+        cached = poller.get_history(token, days=chart_ranges[period])
+        if cached is not None and poller.is_stale(cached[1], poller.history_interval):
+            caption += "\n" + stale_marker(cached[1], lang)
+
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text=name, callback_data=f"chart_{token}:{name}")
+            for name in chart_ranges
+        ]])
+
+        # уже загруженный в телеграм график отправляем по file_id, без повторной загрузки
+        photo = chart.file_id or BufferedInputFile(chart.png, filename=f"{token}.png")
+        sent = await callback.message.answer_photo(
             photo=photo,
-            caption=translations[lang]["chart_caption"].format(token.upper())
+            caption=caption,
+            reply_markup=keyboard
         )
-        await callback.message.answer(f"{translations[lang]['description']}\n{desc}")
+        if chart.file_id is None and sent.photo:
+            await chart_cache.set_file_id(chart_key, sent.photo[-1].file_id)
+        if first_view:
+            await callback.message.answer(f"{translations[lang]['description']}\n{desc}")
+        await callback.answer()
+    except ChartBusyError:
+        await callback.message.answer(translations[lang]["chart_busy"])
+        await callback.answer()
+    except RateLimitedError:
+        await callback.message.answer(translations[lang]["rate_limited"])
         await callback.answer()
     except Exception as e:
         await callback.message.answer(translations[lang]["chart_error"].format(str(e)))
 
+# @bot <коин> из любого чата: ответ только из памяти, догрузка цен идет в фоне
+@router.inline_query()
+async def inline_prices(inline_query: InlineQuery):
+    log_event(inline_query.from_user, "inline", inline_query.query)
+
+    results, cache_time = inline_answers.answer(inline_query.query)
+    # карточки не зависят от пользователя, телеграм может отдавать их всем из своего кэша
+    await inline_query.answer(results, cache_time=cache_time, is_personal=False)
+
 # даша
-@dp.message(Command("language"))
-async def language_cmd(message: types.Message):
+@router.message(Command("language"))
+async def language_cmd(message: types.Message, lang: str):
     await log_command(message, "/language")
-    user_id = message.from_user.id
-    lang = await get_user_language(user_id)
 
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -557,47 +968,28 @@ async def language_cmd(message: types.Message):
     await message.answer(translations[lang]["select_language"], reply_markup=keyboard)
 
 
-@dp.callback_query(lambda c: c.data.startswith("lang_"))
+@router.callback_query(lambda c: c.data.startswith("lang_"))
 async def set_language_callback(callback: CallbackQuery):
     user_id = callback.from_user.id
-    username = callback.from_user.username or "No username"
-    full_name = callback.from_user.full_name or "No name"
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
     # получаем выбранный язык
     selected_lang = callback.data.split("_", 1)[1]
 
-    # сохранение предпочтений пользователя в бд
-    await set_user_language(user_id, selected_lang)
-    await update_user_activity(user_id)
+    # сохранение предпочтений пользователя в бд и кэш профилей
+    await profiles.set_language(user_id, selected_lang)
 
     # логируем выбор языка
-    log_entry = f"[{timestamp}] User ID: {user_id}, Username: @{username}, Name: {full_name}, Set language: {selected_lang}\n"
-    with open(LOG_FILE, "a", encoding="utf-8") as log_file:
-        log_file.write(log_entry)
+    log_event(callback.from_user, "set_language", selected_lang)
 
     # подтверждение на выбранном языке
     await callback.message.answer(translations[selected_lang]["language_changed"])
     await callback.answer()
 
 # даша
-@dp.message()
-async def echo_handler(message: types.Message):
+@router.message()
+async def echo_handler(message: types.Message, lang: str):
     # логируем обычные сообщения
-    user_id = message.from_user.id
-    username = message.from_user.username or "No username"
-    full_name = message.from_user.full_name or "No name"
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    # обновление информации о пользователе в бд
-    await get_or_create_user(user_id, username, full_name)
-    await update_user_activity(user_id)
-
-    lang = await get_user_language(user_id)
-
-    log_entry = f"[{timestamp}] User ID: {user_id}, Username: @{username}, Name: {full_name}, Message: {message.text}\n"
-    with open(LOG_FILE, "a", encoding="utf-8") as log_file:
-        log_file.write(log_entry)
+    log_event(message.from_user, "message", message.text)
 
     text = message.text.lower()
     if text in ['привет', 'приветик', 'hello', 'hi', 'хэлоу']:
@@ -608,16 +1000,163 @@ async def echo_handler(message: types.Message):
         await message.answer(translations[lang]["unknown_command"])
 
 
-async def main():
-    log_dir = os.path.dirname(LOG_FILE)
-    os.makedirs(log_dir, exist_ok=True)
-    # создание файла логов, если его неь
-    if not os.path.exists(LOG_FILE):
-        with open(LOG_FILE, "w", encoding="utf-8") as f:
-            f.write("Telegram Bot Command Log \n\n")
+# background — этот процесс ведет фоновые задачи (поллер, алерты, обновление описаний);
+# из воркеров вебхука это делает только первый, остальные только отвечают пользователям.
+# рассылки запускаются везде: задание забирает один воркер, остальные его не трогают
+async def on_startup(bot: Bot, background: bool = True):
+    notifier.bot = bot
+    if backend.shared and is_sqlite:
+        logger.warning("STATE_URL is shared between instances, but DATABASE_URL is a local SQLite file")
+    await init_db()
+    notifier.start()
+    if background:
+        poller.start()
+        await alert_engine.start()
+    await coin_resolver.start()
+    await description_store.start(popular_tokens.values() if background else ())
+    broadcaster.start()
+    if CHART_PREWARM:
+        chart_renderer.warm()
+    activity_tracker.start()
+    command_log.start()
+    if METRICS_ENABLED:
+        await metrics_server.start()
+
+
+async def on_shutdown():
+    await metrics_server.stop()
+    await poller.stop()
+    await alert_engine.stop()
+    await coin_resolver.stop()
+    await inline_answers.stop()
+    await broadcaster.stop()
+    await description_store.stop()
+    await notifier.stop()
+    await activity_tracker.stop()
+    await command_log.stop()
+    await market_client.close()
+    chart_renderer.shutdown()
+    await backend.close()
+    await close_db()
+
+
+# метрики: хендлеры, кэши, очереди; без METRICS_ENABLED ничего не подключается
+if METRICS_ENABLED:
+    metrics_middleware = HandlerMetricsMiddleware()
+    router.message.middleware(metrics_middleware)
+    router.callback_query.middleware(metrics_middleware)
+    router.inline_query.middleware(metrics_middleware)
+    instrument_engine(engine.sync_engine)
+    registry.gauge("cache_hit_ratio", "Cache hit ratio", lambda: {
+        ("price",): price_service.stats()["hit_ratio"],
+        ("chart",): chart_cache.stats()["hit_ratio"],
+        ("profile",): profiles.cache.stats()["hit_ratio"],
+        ("inline",): inline_answers.cache.stats()["hit_ratio"]
+    }, ["cache"])
+    registry.gauge("cache_entries", "Cache size", lambda: {
+        ("price",): len(price_service.cache),
+        ("chart",): chart_cache.stats()["size"],
+        ("profile",): len(profiles.cache)
+    }, ["cache"])
+    registry.gauge("coingecko_batched_calls", "simple/price calls made by the price batcher",
+                   lambda: price_service.upstream_calls)
+    registry.gauge("coingecko_retries", "Retried CoinGecko requests", lambda: market_client.retries)
+    registry.gauge("coingecko_fallbacks", "Requests served from the last good response",
+                   lambda: market_client.fallbacks)
+    registry.gauge("activity_pending_users", "Users waiting for last_activity flush",
+                   lambda: activity_tracker.stats()["pending"])
+    registry.gauge("activity_last_flush_seconds", "Duration of the last activity flush",
+                   lambda: activity_tracker.last_flush_seconds)
+    registry.gauge("activity_last_batch_size", "Users written by the last activity flush",
+                   lambda: activity_tracker.last_batch_size)
+    registry.gauge("alerts_active", "Active price alerts in the engine", lambda: len(alert_engine))
+    registry.gauge("alerts_triggered", "Price alerts triggered", lambda: alert_engine.triggered)
+    registry.gauge("alerts_checks", "Alert engine check passes", lambda: alert_engine.checks)
+    registry.gauge("alerts_last_check_seconds", "Duration of the last alert check",
+                   lambda: alert_engine.last_check_seconds)
+    registry.gauge("notifications_pending", "Notifications waiting for send limits", lambda: notifier.pending())
+    registry.gauge("notifications", "Notifications by result", lambda: {
+        ("sent",): notifier.sent,
+        ("blocked",): notifier.blocked,
+        ("failed",): notifier.failed
+    }, ["result"])
+    registry.gauge("telegram_retry_after", "RetryAfter responses from Telegram", lambda: {
+        ("notifier",): notifier.retry_after,
+        ("broadcast",): broadcaster.retry_after
+    }, ["sender"])
+    registry.gauge("broadcast_messages", "Broadcast messages by result", lambda: {
+        ("sent",): broadcaster.sent,
+        ("blocked",): broadcaster.blocked,
+        ("failed",): broadcaster.failed
+    }, ["result"])
+    registry.gauge("broadcast_rate", "Send rate of the running broadcast, msg/s",
+                   lambda: broadcaster.job.rate if broadcaster.job is not None else 0.0)
+    registry.gauge("broadcasts_finished", "Broadcasts finished by this process", lambda: broadcaster.finished)
+    registry.gauge("updates_duplicate", "Redelivered updates skipped", lambda: update_dedup.duplicates)
+    registry.gauge("command_log_dropped", "Command log records dropped on overload",
+                   lambda: command_log.dropped)
+    registry.gauge("command_log_written", "Command log records written", lambda: command_log.written)
+    registry.gauge("command_log_pending", "Command log records waiting for the writer",
+                   lambda: command_log.pending())
+    registry.gauge("indicator_series", "Indicator series kept in memory", lambda: len(indicator_engine))
+    registry.gauge("indicator_computes", "Indicator series computations by kind", lambda: {
+        ("full",): indicator_engine.full_computes,
+        ("incremental",): indicator_engine.incremental_updates
+    }, ["kind"])
+    registry.gauge("history_syncs", "Price history downloads by kind", lambda: {
+        ("full",): history_store.full_syncs,
+        ("tail",): history_store.tail_syncs
+    }, ["kind"])
+    registry.gauge("inline_prefetched_prices", "Prices prefetched for inline answers",
+                   lambda: inline_answers.prefetched)
+    registry.gauge("descriptions_fetched", "Coin descriptions downloaded from CoinGecko",
+                   lambda: description_store.fetched)
+
+
+def create_bot():
+    return Bot(token=os.getenv("TOKEN"))
+
+
+# фабрика приложения: импорт main не создает бота и ничего не запускает,
+# бд, фоновые задачи и пул графиков поднимаются в on_startup
+def create_dispatcher(background=True):
+    # состояния fsm — в общем хранилище, если оно задано (STATE_URL), иначе в памяти
+    dp = Dispatcher(storage=backend.fsm_storage(), background=background)
+    dp.update.outer_middleware(update_dedup)
+    dp.include_router(router)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    return dp
 
+
+async def main():
+    bot, dp = create_bot(), create_dispatcher()
     await bot.delete_webhook(drop_pending_updates=True)
     await dp.start_polling(bot)
 
+
+# создание схемы в родительском процессе до запуска воркеров вебхука
+async def prepare_webhook():
+    await init_db()
+    await close_db()
+
+
+# точка входа процесса-воркера в режиме вебхука. у каждого из нескольких воркеров свой журнал команд
+# и свой порт метрик (METRICS_PORT + номер): счетчики у процессов свои, скрейп не должен попадать в разные.
+# фоновые задачи — только в воркере 0; без общего хранилища (STATE_URL) лимиты апи и телеграма
+# воркеры делят поровну, иначе вместе они превысили бы их в WEBHOOK_WORKERS раз
+def webhook_worker(index=0):
+    if WEBHOOK_WORKERS > 1:
+        command_log.path = worker_log_path(command_log.path, index)
+        metrics_server.port += index
+        if shared_backend is None:
+            market_client.governor.split(WEBHOOK_WORKERS)
+            notifier.governor.split(WEBHOOK_WORKERS)
+    serve(create_dispatcher(background=index == 0), create_bot(), reuse_port=WEBHOOK_WORKERS > 1)
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if BOT_MODE == "webhook":
+        run_webhook(create_bot(), webhook_worker, prepare_webhook)
+    else:
+        asyncio.run(main())
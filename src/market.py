@@ -0,0 +1,218 @@
+import os
+import time
+import random
+import asyncio
+import logging
+
+import aiohttp
+
+from cache import TTLCache
+from state import shared_rate_limit
+from metrics import METRICS_ENABLED, upstream_requests, upstream_seconds
+
+# асинхронный клиент CoinGecko с общим пулом соединений
+
+COINGECKO_URL = os.getenv("COINGECKO_URL", "https://api.coingecko.com/api/v3")
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))          # секунды на весь запрос
+HTTP_CONCURRENCY = int(os.getenv("HTTP_CONCURRENCY", "10"))    # одновременных запросов к апи
+
+# бюджет запросов: бесплатный тариф CoinGecko режет примерно после 30 запросов в минуту
+COINGECKO_RATE_PER_MIN = float(os.getenv("COINGECKO_RATE_PER_MIN", "30"))
+COINGECKO_BURST = int(os.getenv("COINGECKO_BURST", "10"))
+COINGECKO_BACKGROUND_RESERVE = int(os.getenv("COINGECKO_BACKGROUND_RESERVE", "3"))   # токенов только для пользователей
+COINGECKO_MAX_RETRIES = int(os.getenv("COINGECKO_MAX_RETRIES", "3"))
+COINGECKO_BACKOFF_BASE = float(os.getenv("COINGECKO_BACKOFF_BASE", "1"))              # секунды
+COINGECKO_BACKOFF_MAX = float(os.getenv("COINGECKO_BACKOFF_MAX", "30"))
+
+# приоритеты запросов
+INTERACTIVE = 0
+BACKGROUND = 1
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitedError(Exception):
+    pass
+
+
+class RetryableError(Exception):
+    def __init__(self, status, retry_after=None):
+        super().__init__(f"upstream responded {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+# token bucket: фоновые запросы не трогают последние COINGECKO_BACKGROUND_RESERVE токенов,
+# после 429 все ждут до конца Retry-After. shared_limit — общий лимит всех инстансов (state.SharedRateLimit)
+class RateGovernor:
+    def __init__(self, rate_per_min=COINGECKO_RATE_PER_MIN, burst=COINGECKO_BURST,
+                 background_reserve=COINGECKO_BACKGROUND_RESERVE, shared_limit=None):
+        self.shared_limit = shared_limit
+        self.rate = rate_per_min / 60
+        self.capacity = burst
+        self.background_reserve = min(background_reserve, max(0, burst - 1))
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, priority=INTERACTIVE, timeout=None):
+        """Забирает токен; False, если за timeout секунд это невозможно."""
+        need = 1 if priority == INTERACTIVE else 1 + self.background_reserve
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            if now >= self.blocked_until and self.tokens >= need:
+                self.tokens -= 1
+                if self.shared_limit is None:
+                    return True
+                wait = await self.shared_limit.wait_time()
+                if wait <= 0:
+                    return True
+                # окно общего лимита исчерпано другими инстансами: токен возвращаем
+                self.tokens += 1
+            else:
+                wait = max(self.blocked_until - now, (need - self.tokens) / self.rate)
+            if deadline is not None and now + wait > deadline:
+                return False
+            await asyncio.sleep(min(wait, 1.0))
+
+    def split(self, parts):
+        """Оставляет этому процессу 1/parts лимита, когда общего счетчика между процессами нет."""
+        self.rate /= parts
+        self.capacity = max(1, self.capacity // parts)
+        self.background_reserve = min(self.background_reserve, self.capacity - 1)
+        self.tokens = min(self.tokens, self.capacity)
+
+    def penalize(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+        if self.shared_limit is not None:
+            self._block_task = asyncio.create_task(self.shared_limit.block(seconds))
+
+
+class MarketClient:
+    def __init__(self, base_url=COINGECKO_URL, timeout=HTTP_TIMEOUT, concurrency=HTTP_CONCURRENCY,
+                 governor=None, max_retries=COINGECKO_MAX_RETRIES):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.concurrency = concurrency
+        self.governor = governor or RateGovernor()
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._session = None
+        # последние успешные ответы, отдаются, если апи недоступно или режет запросы
+        self._last_good = TTLCache(ttl=7 * 24 * 3600, max_size=256)
+        self.retries = 0
+        self.fallbacks = 0
+
+    # сессия создается лениво, уже внутри работающего event loop
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.concurrency,
+                keepalive_timeout=30,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def _request(self, path, params, endpoint):
+        async with self._semaphore:
+            session = self._get_session()
+            started = time.perf_counter()
+            status = "error"
+            try:
+                async with session.get(f"{self.base_url}{path}", params=params) as res:
+                    status = str(res.status)
+                    if res.status == 429 or res.status >= 500:
+                        raise RetryableError(res.status, parse_retry_after(res.headers.get("Retry-After")))
+                    res.raise_for_status()
+                    return await res.json()
+            finally:
+                if METRICS_ENABLED:
+                    upstream_requests.inc(endpoint or path, status)
+                    upstream_seconds.observe(time.perf_counter() - started, endpoint or path)
+
+    def _backoff(self, attempt):
+        delay = min(COINGECKO_BACKOFF_MAX, COINGECKO_BACKOFF_BASE * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.5)
+
+    # endpoint — имя запроса для метрик, без id коина
+    async def get_json(self, path, params=None, endpoint=None, priority=INTERACTIVE):
+        key = (path, tuple(sorted((params or {}).items())))
+        error = None
+        for attempt in range(self.max_retries + 1):
+            # пользователь не должен ждать токен дольше таймаута запроса
+            wait = self.timeout.total if priority == INTERACTIVE else None
+            if not await self.governor.acquire(priority, wait):
+                error = RateLimitedError("CoinGecko request budget exhausted")
+                break
+            try:
+                data = await self._request(path, params, endpoint)
+            except (RetryableError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                retry_after = getattr(e, "retry_after", None)
+                delay = retry_after if retry_after is not None else self._backoff(attempt)
+                if getattr(e, "status", None) == 429:
+                    self.governor.penalize(delay)
+                    error = RateLimitedError("CoinGecko rate limit")
+                else:
+                    error = e
+                # пользователю лучше сразу отдать старые данные, чем ждать долгий Retry-After
+                if priority == INTERACTIVE and delay > self.timeout.total:
+                    break
+                if attempt < self.max_retries:
+                    self.retries += 1
+                    await asyncio.sleep(delay)
+                continue
+            self._last_good.set(key, data)
+            return data
+
+        found, data = self._last_good.lookup(key)
+        if found:
+            self.fallbacks += 1
+            logger.warning("serving last good response for %s: %s", path, error)
+            return data
+        raise error
+
+    async def simple_price(self, ids, currency='usd', priority=INTERACTIVE):
+        return await self.get_json(
+            "/simple/price", {'ids': ','.join(ids), 'vs_currencies': currency}, "simple_price", priority
+        )
+
+    async def market_chart(self, coin_id, currency='usd', days=7, priority=INTERACTIVE):
+        return await self.get_json(
+            f"/coins/{coin_id}/market_chart", {'vs_currency': currency, 'days': days}, "market_chart", priority
+        )
+
+    # только описание и локализации: без рынков, тикеров и данных сообщества документ в разы меньше
+    async def coin_description(self, coin_id, priority=INTERACTIVE):
+        params = {
+            "localization": "true", "tickers": "false", "market_data": "false",
+            "community_data": "false", "developer_data": "false", "sparkline": "false"
+        }
+        return await self.get_json(f"/coins/{coin_id}", params, "coin_description", priority)
+
+    async def coins_list(self, priority=INTERACTIVE):
+        return await self.get_json("/coins/list", None, "coins_list", priority)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+market_client = MarketClient(governor=RateGovernor(
+    shared_limit=shared_rate_limit("coingecko", COINGECKO_RATE_PER_MIN, 60)
+))
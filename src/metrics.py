@@ -0,0 +1,234 @@
+import os
+import time
+import asyncio
+import functools
+from bisect import bisect_left
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+
+# метрики в формате Prometheus без внешних зависимостей.
+# при METRICS_ENABLED=0 middleware и обертки не ставятся, накладных расходов нет
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))            # воркеры вебхука: METRICS_PORT + номер воркера
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, labels, extra=None):
+    pairs = list(zip(labelnames, labels))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        for labels, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}   # labels -> [счетчики по бакетам, сумма, количество]
+
+    def observe(self, value, *labels):
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def render(self):
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, ('le', le))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}"
+
+
+# значение считается в момент скрейпа: callback возвращает число или {labels: число}
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name, help, callback, labelnames=()):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+
+    def render(self):
+        value = self.callback()
+        if not isinstance(value, dict):
+            value = {(): value}
+        for labels, v in value.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {v}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, callback, labelnames=()):
+        return self.register(Gauge(name, help, callback, labelnames))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+handler_updates = registry.counter("bot_updates_total", "Updates handled", ["handler"])
+handler_seconds = registry.histogram("bot_handler_seconds", "Handler latency", ["handler"])
+handler_errors = registry.counter("bot_handler_errors_total", "Unhandled handler errors", ["handler", "error"])
+fetch_seconds = registry.histogram("bot_fetch_seconds", "Market data function latency", ["function"])
+fetch_errors = registry.counter("bot_fetch_errors_total", "Market data function errors", ["function", "error"])
+upstream_requests = registry.counter("coingecko_requests_total", "Outbound CoinGecko requests", ["endpoint", "status"])
+upstream_seconds = registry.histogram("coingecko_request_seconds", "Outbound CoinGecko latency", ["endpoint"])
+db_query_seconds = registry.histogram("db_query_seconds", "Database query time", ["operation"])
+db_query_errors = registry.counter("db_query_errors_total", "Failed database queries", ["operation", "error"])
+loop_lag_seconds = registry.histogram(
+    "event_loop_lag_seconds", "Event loop scheduling delay",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+
+
+# inner middleware: знает, какой хендлер выбран
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            handler_errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            handler_updates.inc(name)
+            handler_seconds.observe(time.perf_counter() - started, name)
+
+
+# обертка для функций получения данных (async)
+def timed(func):
+    if not METRICS_ENABLED:
+        return func
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            fetch_errors.inc(func.__name__, type(e).__name__)
+            raise
+        finally:
+            fetch_seconds.observe(time.perf_counter() - started, func.__name__)
+
+    return wrapper
+
+
+def _operation(statement):
+    return statement.lstrip().split(None, 1)[0].upper() if statement and statement.strip() else "UNKNOWN"
+
+
+# время запросов к бд через события движка SQLAlchemy.
+# упавший запрос after_cursor_execute не получает: его время снимаем в handle_error,
+# иначе на соединении копились бы метки старта, а следующий запрос забрал бы чужую
+def instrument_engine(sync_engine):
+    from sqlalchemy import event
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        db_query_seconds.observe(time.perf_counter() - started, _operation(statement))
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(context):
+        started = context.connection.info.get("query_started") if context.connection is not None else None
+        if started:
+            started.pop()
+        db_query_errors.inc(_operation(context.statement), type(context.original_exception).__name__)
+
+
+async def metrics_handler(request):
+    return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+
+async def monitor_loop_lag(interval=0.1):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        loop_lag_seconds.observe(max(0.0, time.perf_counter() - started - interval))
+
+
+class MetricsServer:
+    def __init__(self, host=METRICS_HOST, port=METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._runner = None
+        self._lag_task = None
+
+    async def start(self):
+        self._lag_task = asyncio.create_task(monitor_loop_lag())
+        app = web.Application()
+        app.router.add_get("/metrics", metrics_handler)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer()
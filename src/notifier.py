@@ -0,0 +1,140 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
+
+from market import RateGovernor
+from tasks import cancel_task
+
+# очередь исходящих уведомлений с лимитами телеграма:
+# общий лимит сообщений в секунду на бота и не чаще одного сообщения в чат за интервал.
+# несколько уведомлений одному чату склеиваются в одно сообщение
+
+TELEGRAM_RATE_PER_SEC = float(os.getenv("TELEGRAM_RATE_PER_SEC", "25"))     # запас от лимита ~30/с
+TELEGRAM_CHAT_INTERVAL = float(os.getenv("TELEGRAM_CHAT_INTERVAL", "1"))    # секунды между сообщениями в чат
+TELEGRAM_SEND_CONCURRENCY = int(os.getenv("TELEGRAM_SEND_CONCURRENCY", "8"))
+TELEGRAM_BROADCAST_RESERVE = int(os.getenv("TELEGRAM_BROADCAST_RESERVE", "5"))   # токенов, которые рассылка не трогает
+MESSAGE_LIMIT = 4096
+
+logger = logging.getLogger(__name__)
+
+
+class Notifier:
+    def __init__(self, bot=None, rate_per_sec=TELEGRAM_RATE_PER_SEC, chat_interval=TELEGRAM_CHAT_INTERVAL,
+                 concurrency=TELEGRAM_SEND_CONCURRENCY, on_blocked=None, shared_limit=None):
+        self.bot = bot
+        self.chat_interval = chat_interval
+        # общий лимит с рассылкой: она берет токены с фоновым приоритетом и оставляет запас уведомлениям
+        self.governor = RateGovernor(rate_per_min=rate_per_sec * 60, burst=max(1, int(rate_per_sec)),
+                                     background_reserve=TELEGRAM_BROADCAST_RESERVE, shared_limit=shared_limit)
+        # on_blocked(chat_id) — корутина, вызывается, если пользователь заблокировал бота
+        self.on_blocked = on_blocked
+        self._pending = OrderedDict()    # chat_id -> тексты, ждущие отправки
+        self._last_sent = {}             # chat_id -> время последней отправки
+        self._slots = asyncio.Semaphore(concurrency)
+        self._sending = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # метрики
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retry_after = 0
+
+    def notify(self, chat_id, text):
+        self._pending.setdefault(chat_id, []).append(text)
+        self._wakeup.set()
+
+    def pending(self):
+        return sum(len(texts) for texts in self._pending.values())
+
+    async def run(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            next_ready = None
+            for chat_id in list(self._pending):
+                ready_at = self._last_sent.get(chat_id, 0.0) + self.chat_interval
+                if ready_at > now:
+                    next_ready = ready_at if next_ready is None else min(next_ready, ready_at)
+                    continue
+                texts = self._pending.pop(chat_id)
+                await self.governor.acquire()
+                await self._slots.acquire()
+                self._last_sent[chat_id] = time.monotonic()
+                task = asyncio.create_task(self._send(chat_id, texts))
+                self._sending.add(task)
+                task.add_done_callback(self._sending.discard)
+                now = time.monotonic()
+
+            # чаты, которым давно ничего не слали, больше не нужны
+            self._last_sent = {c: t for c, t in self._last_sent.items() if t + self.chat_interval > now}
+            if next_ready is not None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), max(0.0, next_ready - now))
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _send(self, chat_id, texts):
+        try:
+            for text in split_message("\n\n".join(texts)):
+                await self.bot.send_message(chat_id, text)
+            self.sent += len(texts)
+        except TelegramRetryAfter as e:
+            # телеграм просит подождать: останавливаем все отправки и возвращаем тексты в начало очереди
+            self.retry_after += 1
+            self.governor.penalize(e.retry_after)
+            self._pending[chat_id] = texts + self._pending.get(chat_id, [])
+            self._pending.move_to_end(chat_id, last=False)
+            self._wakeup.set()
+        except TelegramForbiddenError:
+            self.blocked += 1
+            if self.on_blocked is not None:
+                await self.on_blocked(chat_id)
+        except Exception as e:
+            self.failed += len(texts)
+            logger.warning("notification to %s failed: %s", chat_id, e)
+        finally:
+            self._slots.release()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        await cancel_task(self._task)
+        self._task = None
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+        if self._pending:
+            logger.warning("notifier stopped with %d unsent notifications", self.pending())
+
+
+# делим длинный текст по строкам на сообщения не длиннее лимита телеграма
+def split_message(text, limit=MESSAGE_LIMIT):
+    parts = []
+    current = ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            parts.append(current)
+            current = line
+        else:
+            current = candidate
+    if current:
+        parts.append(current)
+    return parts
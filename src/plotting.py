@@ -0,0 +1,121 @@
+from io import BytesIO
+
+import numpy as np
+import matplotlib.dates as mdates
+from matplotlib.colors import TwoSlopeNorm
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from charts import CHART_WIDTH_PX, CHART_DPI
+
+# отрисовка на matplotlib. модуль импортируют только воркеры пула графиков (charts.ChartRenderer),
+# основной процесс бота matplotlib не грузит
+
+
+def _date_axis(ax):
+    # ось дат сама подбирает шаг подписей под длину периода
+    locator = mdates.AutoDateLocator()
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator))
+
+
+def _png(fig):
+    buf = BytesIO()
+    fig.savefig(buf, format='png')
+    return buf.getvalue()
+
+
+# выполняется в воркере, поэтому только объектный API без глобального состояния pyplot
+def render_price_chart(ts, prices, symbol='bitcoin', currency='usd', lang='ru', period=None):
+    times = ts.astype('datetime64[ms]')
+
+    fig = Figure(figsize=(CHART_WIDTH_PX / CHART_DPI, 4), dpi=CHART_DPI)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.plot(times, prices, label=f"{symbol.upper()}", color='blue')
+    _date_axis(ax)
+
+    # заголовок графика на основе выбранного языка
+    if period is None:
+        period = "7 дней" if lang == 'ru' else "7 days"
+    title = f"{symbol.upper()} Цена за {period}" if lang == 'ru' else f"{symbol.upper()} Price for {period}"
+    x_label = "Дата" if lang == 'ru' else "Date"
+    y_label = f"Цена в {currency.upper()}" if lang == 'ru' else f"Price in {currency.upper()}"
+
+    ax.set_title(title)
+    ax.set_xlabel(x_label)
+    ax.set_ylabel(y_label)
+    ax.grid(True)
+    ax.legend()
+    fig.tight_layout()
+    return _png(fig)
+
+
+# цена с SMA/EMA и полосами Боллинджера, под ней RSI и MACD; series — словарь массивов
+def render_indicator_chart(series, symbol='bitcoin', currency='usd', lang='ru', period=None):
+    times = series["ts"].astype('datetime64[ms]')
+
+    fig = Figure(figsize=(CHART_WIDTH_PX / CHART_DPI, 7), dpi=CHART_DPI)
+    FigureCanvasAgg(fig)
+    price_ax, rsi_ax, macd_ax = fig.subplots(3, 1, sharex=True, gridspec_kw={"height_ratios": [3, 1, 1]})
+
+    price_ax.plot(times, series["price"], label=symbol.upper(), color='blue')
+    price_ax.plot(times, series["sma"], label="SMA", color='orange', linewidth=1)
+    price_ax.plot(times, series["ema"], label="EMA", color='green', linewidth=1)
+    price_ax.fill_between(times, series["bb_lower"], series["bb_upper"], color='gray', alpha=0.2, label="Bollinger")
+
+    rsi_ax.plot(times, series["rsi"], color='purple', linewidth=1)
+    rsi_ax.axhline(70, color='red', linewidth=0.5)
+    rsi_ax.axhline(30, color='green', linewidth=0.5)
+    rsi_ax.set_ylim(0, 100)
+    rsi_ax.set_ylabel("RSI")
+
+    macd_ax.plot(times, series["macd"], label="MACD", color='blue', linewidth=1)
+    macd_ax.plot(times, series["signal"], label="Signal", color='red', linewidth=1)
+    macd_ax.bar(times, series["macd"] - series["signal"], color='gray', width=0.8 * _bar_width(series["ts"]))
+    macd_ax.set_ylabel("MACD")
+
+    if period is None:
+        period = "7 дней" if lang == 'ru' else "7 days"
+    title = f"{symbol.upper()} Индикаторы за {period}" if lang == 'ru' else f"{symbol.upper()} Indicators for {period}"
+    price_ax.set_title(title)
+    price_ax.set_ylabel(f"Цена в {currency.upper()}" if lang == 'ru' else f"Price in {currency.upper()}")
+    for ax in (price_ax, rsi_ax, macd_ax):
+        ax.grid(True)
+    price_ax.legend(loc='upper left', fontsize='small')
+    macd_ax.legend(loc='upper left', fontsize='small')
+    _date_axis(macd_ax)
+    fig.tight_layout()
+    return _png(fig)
+
+
+# тепловая карта ROE: плечо по вертикали, цена по горизонтали, линия — цена ликвидации
+def render_leverage_heatmap(leverages, prices, roe, liquidation, entry, side='long', lang='ru'):
+    fig = Figure(figsize=(CHART_WIDTH_PX / CHART_DPI, 5), dpi=CHART_DPI)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+
+    # убыток ограничен маржой (-100%), прибыль растет с плечом — шкала несимметричная вокруг нуля
+    norm = TwoSlopeNorm(vcenter=0.0, vmin=-100.0, vmax=max(float(np.nanmax(roe)) * 100, 1.0))
+    image = ax.pcolormesh(prices, leverages, roe * 100, cmap='RdYlGn', norm=norm, shading='auto')
+    ax.plot(liquidation, leverages, color='black', linewidth=1,
+            label="ликвидация" if lang == 'ru' else "liquidation")
+    ax.axvline(entry, color='blue', linewidth=0.8, linestyle='--', label="вход" if lang == 'ru' else "entry")
+    ax.set_xlim(prices[0], prices[-1])
+    ax.set_ylim(leverages[0], leverages[-1])
+
+    cbar = fig.colorbar(image, ax=ax)
+    cbar.set_label("ROE, %")
+    ax.set_title(f"ROE {side} по плечу и цене" if lang == 'ru' else f"{side.capitalize()} ROE by leverage and price")
+    ax.set_xlabel("Цена" if lang == 'ru' else "Price")
+    ax.set_ylabel("Плечо" if lang == 'ru' else "Leverage")
+    ax.legend(loc='upper right', fontsize='small')
+    fig.tight_layout()
+    return _png(fig)
+
+
+# ширина столбика гистограммы MACD в днях (единицы оси дат matplotlib)
+def _bar_width(ts):
+    if len(ts) < 2:
+        return 1.0
+    return float(np.median(np.diff(ts))) / 86400000
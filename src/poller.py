@@ -0,0 +1,98 @@
+import os
+import time
+import asyncio
+import logging
+
+from market import BACKGROUND
+from tasks import cancel_task
+
+# фоновое обновление цен и 7-дневных историй для популярных токенов,
+# чтобы хендлеры отвечали из памяти, а не ходили в апи
+
+POLL_PRICE_INTERVAL = float(os.getenv("POLL_PRICE_INTERVAL", "30"))       # секунды
+POLL_HISTORY_INTERVAL = float(os.getenv("POLL_HISTORY_INTERVAL", "300"))  # секунды
+POLL_WATCHLIST = [c for c in os.getenv("POLL_WATCHLIST", "").split(",") if c]
+POLL_CURRENCIES = [c for c in os.getenv("POLL_CURRENCIES", "usd").split(",") if c]
+
+logger = logging.getLogger(__name__)
+
+
+class PricePoller:
+    def __init__(self, client, price_service, watchlist, currencies=POLL_CURRENCIES,
+                 price_interval=POLL_PRICE_INTERVAL, history_interval=POLL_HISTORY_INTERVAL, history_days=7):
+        self.client = client
+        self.price_service = price_service
+        self.watchlist = list(watchlist)
+        self.currencies = list(currencies)
+        self.price_interval = price_interval
+        self.history_interval = history_interval
+        self.history_days = history_days
+        self._prices = {}       # (coin_id, currency) -> (цена, время обновления)
+        self._histories = {}    # (coin_id, currency) -> (история, время обновления)
+        self._history_refreshed = 0.0
+        self._task = None
+
+    # данные старше трех интервалов считаются устаревшими
+    def is_stale(self, updated_at, interval=None):
+        return time.time() - updated_at > 3 * (interval or self.price_interval)
+
+    def get_prices(self, coin_ids, currency='usd'):
+        """Цены из памяти: {коин: (цена, время обновления)} только для коинов, которые есть в снапшоте."""
+        result = {}
+        for coin_id in coin_ids:
+            entry = self._prices.get((coin_id, currency))
+            if entry is not None:
+                result[coin_id] = entry
+        return result
+
+    def get_history(self, coin_id, currency='usd', days=7):
+        if days != self.history_days:
+            return None
+        return self._histories.get((coin_id, currency))
+
+    async def refresh_prices(self):
+        for currency in self.currencies:
+            data = await self.client.simple_price(self.watchlist, currency, priority=BACKGROUND)
+            now = time.time()
+            for coin_id in self.watchlist:
+                price = data.get(coin_id, {}).get(currency)
+                if price is not None:
+                    self._prices[(coin_id, currency)] = (price, now)
+                    self.price_service.put(coin_id, currency, price)
+
+    async def refresh_histories(self):
+        keys = [(coin_id, currency) for currency in self.currencies for coin_id in self.watchlist]
+        results = await asyncio.gather(
+            *(self.client.market_chart(coin_id, currency, self.history_days, priority=BACKGROUND)
+              for coin_id, currency in keys),
+            return_exceptions=True
+        )
+        now = time.time()
+        for key, data in zip(keys, results):
+            if isinstance(data, Exception):
+                logger.warning("history refresh failed for %s: %s", key, data)
+                continue
+            self._histories[key] = ([(x[0], x[1]) for x in data['prices']], now)
+        self._history_refreshed = time.monotonic()
+
+    async def run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                await self.refresh_prices()
+                if started - self._history_refreshed >= self.history_interval or not self._histories:
+                    await self.refresh_histories()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # при ошибке оставляем старые данные, они будут помечены как устаревшие
+                logger.warning("price poller refresh failed: %s", e)
+            await asyncio.sleep(max(0.0, self.price_interval - (time.monotonic() - started)))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        await cancel_task(self._task)
+        self._task = None
@@ -0,0 +1,169 @@
+import os
+import json
+import asyncio
+import logging
+
+from cache import TTLCache
+from market import market_client, INTERACTIVE, BACKGROUND
+from state import shared_backend
+
+# кэш цен с объединением запросов:
+# промахи разных пользователей за один тик уходят одним вызовом simple/price.
+# при нескольких инстансах перед апи проверяется общий кэш: цену, полученную одним, видят все
+
+PRICE_CACHE_TTL = float(os.getenv("PRICE_CACHE_TTL", "30"))         # секунды
+PRICE_CACHE_SIZE = int(os.getenv("PRICE_CACHE_SIZE", "1024"))
+PRICE_BATCH_TICK = float(os.getenv("PRICE_BATCH_TICK", "0.05"))     # окно сбора запросов, секунды
+PRICE_BATCH_SIZE = 100                                              # ids в одном запросе
+
+logger = logging.getLogger(__name__)
+
+
+class PriceService:
+    def __init__(self, client, ttl=PRICE_CACHE_TTL, max_size=PRICE_CACHE_SIZE, tick=PRICE_BATCH_TICK, shared=None):
+        self.client = client
+        self.cache = TTLCache(ttl, max_size)
+        self.shared = shared
+        self.tick = tick
+        self._pending = {}        # (coin_id, currency) -> future
+        self._priority = BACKGROUND   # приоритет пачки: INTERACTIVE, если ждет хоть один пользователь
+        self._last_good = {}      # (coin_id, currency) -> последняя полученная цена
+        self._flush_task = None
+        self.upstream_calls = 0
+
+    async def get_prices(self, coin_ids, currency='usd', priority=INTERACTIVE):
+        """Словарь coin_id -> цена (None, если коин неизвестен апи); priority — как в market."""
+        result = {}
+        waiting = {}
+        for coin_id in coin_ids:
+            key = (coin_id, currency)
+            found, price = self.cache.lookup(key)
+            if found:
+                result[coin_id] = price
+                continue
+            future = self._pending.get(key)
+            if future is None:
+                future = asyncio.get_running_loop().create_future()
+                self._pending[key] = future
+            waiting[coin_id] = future
+
+        if waiting:
+            self._priority = min(self._priority, priority)
+            if self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush())
+            prices = await asyncio.gather(*(asyncio.shield(f) for f in waiting.values()))
+            result.update(zip(waiting, prices))
+        return result
+
+    def peek(self, coin_id, currency='usd'):
+        """(найдено, цена) только из памяти: свежий кэш или последняя полученная цена, без запроса к апи."""
+        found, price = self.cache.lookup((coin_id, currency))
+        if found:
+            return True, price
+        key = (coin_id, currency)
+        if key in self._last_good:
+            return True, self._last_good[key]
+        return False, None
+
+    def put(self, coin_id, currency, price):
+        self.cache.set((coin_id, currency), price)
+        if price is not None:
+            self._last_good[(coin_id, currency)] = price
+
+    async def _flush(self):
+        await asyncio.sleep(self.tick)
+        pending, self._pending = self._pending, {}
+        priority, self._priority = self._priority, BACKGROUND
+        self._flush_task = None
+        error = None
+        try:
+            await self._fetch(pending, priority)
+        except Exception as e:
+            error = e
+            logger.warning("price flush failed: %s", e)
+        finally:
+            # ошибка на любом шаге (или отмена) не должна оставить ожидающих без ответа
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error or RuntimeError("price flush was interrupted"))
+
+    async def _fetch(self, pending, priority=INTERACTIVE):
+        by_currency = {}
+        for coin_id, currency in pending:
+            by_currency.setdefault(currency, []).append(coin_id)
+
+        if self.shared is not None:
+            by_currency = await self._from_shared(by_currency, pending)
+
+        for currency, coin_ids in by_currency.items():
+            for i in range(0, len(coin_ids), PRICE_BATCH_SIZE):
+                chunk = coin_ids[i:i + PRICE_BATCH_SIZE]
+                self.upstream_calls += 1
+                try:
+                    data = await self.client.simple_price(chunk, currency, priority)
+                except Exception as e:
+                    # если апи недоступно, отдаем последние известные цены; ошибка — только коинам без них
+                    for coin_id in chunk:
+                        future = pending[(coin_id, currency)]
+                        if future.done():
+                            continue
+                        price = self._last_good.get((coin_id, currency))
+                        if price is None:
+                            future.set_exception(e)
+                        else:
+                            future.set_result(price)
+                    continue
+                prices = {}
+                for coin_id in chunk:
+                    price = data.get(coin_id, {}).get(currency)
+                    # None тоже кэшируем, чтобы не дергать апи с неверными ids
+                    self.put(coin_id, currency, price)
+                    prices[coin_id] = price
+                    future = pending[(coin_id, currency)]
+                    if not future.done():
+                        future.set_result(price)
+                if self.shared is not None:
+                    await self._to_shared(currency, prices)
+
+    @staticmethod
+    def _shared_key(coin_id, currency):
+        return f"price:{currency}:{coin_id}"
+
+    # цены, которые уже получил другой инстанс; возвращает то, что осталось запросить у апи
+    async def _from_shared(self, by_currency, pending):
+        keys = [(coin_id, currency) for currency, coin_ids in by_currency.items() for coin_id in coin_ids]
+        try:
+            values = await self.shared.get_many([self._shared_key(*key) for key in keys])
+        except Exception as e:
+            logger.warning("shared price cache unavailable: %s", e)
+            return by_currency
+        missing = {}
+        for (coin_id, currency), value in zip(keys, values):
+            try:
+                price = None if value is None else json.loads(value)
+            except ValueError:
+                logger.warning("bad shared price for %s/%s", coin_id, currency)
+                value = None
+            if value is None:
+                missing.setdefault(currency, []).append(coin_id)
+                continue
+            self.put(coin_id, currency, price)
+            future = pending[(coin_id, currency)]
+            if not future.done():
+                future.set_result(price)
+        return missing
+
+    async def _to_shared(self, currency, prices):
+        try:
+            await self.shared.set_many(
+                {self._shared_key(coin_id, currency): json.dumps(price) for coin_id, price in prices.items()},
+                self.cache.ttl
+            )
+        except Exception as e:
+            logger.warning("shared price cache unavailable: %s", e)
+
+    def stats(self):
+        return {**self.cache.stats(), "upstream_calls": self.upstream_calls}
+
+
+price_service = PriceService(market_client, shared=shared_backend)
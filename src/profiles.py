@@ -0,0 +1,66 @@
+import os
+import logging
+
+from aiogram import BaseMiddleware
+
+from cache import TTLCache
+
+# кэш профилей пользователей (язык), чтобы не ходить в бд на каждое сообщение.
+# запись в кэше означает, что пользователь уже есть в бд.
+# при нескольких инстансах язык лежит и в общем кэше, а своя копия живет недолго,
+# чтобы смена языка через один инстанс быстро доходила до остальных
+
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "3600"))   # секунды
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+PROFILE_LOCAL_TTL = float(os.getenv("PROFILE_LOCAL_TTL", "30"))     # своя копия при общем кэше, секунды
+
+logger = logging.getLogger(__name__)
+
+
+class UserProfiles:
+    def __init__(self, load_language, save_language, ttl=PROFILE_CACHE_TTL, max_size=PROFILE_CACHE_SIZE, shared=None):
+        # load_language(user) создает пользователя при необходимости и возвращает его язык
+        self.load_language = load_language
+        self.save_language = save_language
+        self.shared = shared
+        self.ttl = ttl
+        self.cache = TTLCache(ttl if shared is None else min(ttl, PROFILE_LOCAL_TTL), max_size)
+
+    async def get_language(self, user):
+        return await self.cache.get_or_load(user.id, lambda: self._load(user))
+
+    async def _load(self, user):
+        if self.shared is not None:
+            try:
+                language = await self.shared.get(f"profile:{user.id}")
+                if language is not None:
+                    return language.decode()
+            except Exception as e:
+                logger.warning("shared profile cache unavailable: %s", e)
+        language = await self.load_language(user)
+        await self._share(user.id, language)
+        return language
+
+    async def _share(self, user_id, language):
+        if self.shared is not None:
+            try:
+                await self.shared.set(f"profile:{user_id}", language.encode(), self.ttl)
+            except Exception as e:
+                logger.warning("shared profile cache unavailable: %s", e)
+
+    # write-through: сначала бд, потом кэши
+    async def set_language(self, user_id, language):
+        await self.save_language(user_id, language)
+        self.cache.set(user_id, language)
+        await self._share(user_id, language)
+
+
+# кладет язык пользователя в data["lang"], хендлеры получают его аргументом
+class UserMiddleware(BaseMiddleware):
+    def __init__(self, profiles):
+        self.profiles = profiles
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        data["lang"] = await self.profiles.get_language(user) if user is not None else 'ru'
+        return await handler(event, data)
@@ -0,0 +1,208 @@
+import os
+import csv
+from io import StringIO
+
+import numpy as np
+
+# расчет позиций с изолированной маржой на numpy: размер, цена ликвидации и PnL
+# для многих позиций и цен сразу, без цикла по ячейкам.
+# ликвидация — когда маржа с учетом PnL опускается до поддерживающей маржи и комиссии закрытия
+
+RISK_MAINTENANCE_MARGIN = float(os.getenv("RISK_MAINTENANCE_MARGIN", "0.005"))   # доля от объема позиции
+RISK_FEE_RATE = float(os.getenv("RISK_FEE_RATE", "0.0004"))                       # комиссия за вход и за выход
+RISK_MAX_LEVERAGE = int(os.getenv("RISK_MAX_LEVERAGE", "125"))
+RISK_MAX_POSITIONS = int(os.getenv("RISK_MAX_POSITIONS", "10000"))
+RISK_PRICE_MOVES = (-0.10, -0.05, 0.05, 0.10)     # колонки PnL в таблице: изменение цены от входа
+
+LONG = 1
+SHORT = -1
+SIDES = {'long': LONG, 'лонг': LONG, 'short': SHORT, 'шорт': SHORT}
+OPTIONS = ("mmr", "fee", "funding")
+CSV_COLUMNS = ("side", "entry", "leverage", "balance") + OPTIONS
+
+
+class Positions:
+    """Набор позиций как массивы одинаковой длины.
+
+    side — LONG/SHORT, balance — маржа позиции, mmr — ставка поддерживающей маржи,
+    fee — комиссия за сделку, funding — накопленный фандинг как доля объема
+    (положительный платят лонги, получают шорты).
+    """
+
+    def __init__(self, side, entry, leverage, balance, mmr=RISK_MAINTENANCE_MARGIN, fee=RISK_FEE_RATE, funding=0.0):
+        self.side, self.entry, self.leverage, self.balance, self.mmr, self.fee, self.funding = np.broadcast_arrays(
+            *(np.asarray(v, dtype=np.float64) for v in (side, entry, leverage, balance, mmr, fee, funding))
+        )
+
+    def __len__(self):
+        return self.entry.size
+
+    def take(self, indices):
+        return Positions(*(a[indices] for a in (self.side, self.entry, self.leverage, self.balance,
+                                                self.mmr, self.fee, self.funding)))
+
+    def invalid(self):
+        """Индексы позиций с недопустимыми параметрами."""
+        bad = (
+            ~np.isfinite(self.entry) | (self.entry <= 0)
+            | ~np.isfinite(self.balance) | (self.balance <= 0)
+            | (self.leverage < 1) | (self.leverage > RISK_MAX_LEVERAGE)
+            | (self.mmr < 0) | (self.mmr >= 1) | (self.fee < 0) | (self.fee >= 1)
+            | ~np.isfinite(self.funding)
+        )
+        return np.flatnonzero(bad)
+
+
+def evaluate(p):
+    """Объем, количество монет, маржа после комиссии и фандинга, цена ликвидации и расстояние до нее."""
+    notional = p.balance * p.leverage
+    qty = notional / p.entry
+    # открытие: комиссия с объема, фандинг по знаку стороны
+    margin = p.balance - notional * p.fee - p.side * p.funding * notional
+    # m + s*q*(P - E) = q*P*(mmr + fee)  =>  P = (E - s*m/q) / (1 - s*(mmr + fee))
+    liquidation = (p.entry - p.side * margin / qty) / (1 - p.side * (p.mmr + p.fee))
+    liquidation = np.maximum(liquidation, 0.0)
+    return {
+        "notional": notional,
+        "qty": qty,
+        "margin": margin,
+        "liquidation": liquidation,
+        "distance": (liquidation - p.entry) / p.entry
+    }
+
+
+def pnl_grid(p, prices):
+    """PnL каждой позиции (строки) при каждой цене (столбцы) с комиссиями входа/выхода и фандингом.
+
+    prices — общая сетка цен (m,) или своя сетка для каждой позиции (n, m).
+    Убыток ограничен маржой позиции — изолированная маржа.
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    if prices.ndim == 1:
+        prices = prices[None, :]
+    side, entry, fee, balance = (a[:, None] for a in (p.side, p.entry, p.fee, p.balance))
+    notional = balance * p.leverage[:, None]
+    qty = notional / entry
+    pnl = side * qty * (prices - entry) - notional * fee - qty * prices * fee - side * p.funding[:, None] * notional
+    return np.maximum(pnl, -balance)
+
+
+def leverage_sweep(entry, balance, prices, side=LONG, leverages=None,
+                   mmr=RISK_MAINTENANCE_MARGIN, fee=RISK_FEE_RATE, funding=0.0):
+    """ROE (PnL / маржа) для каждого плеча (строки) и цены (столбцы) плюс цены ликвидации по плечам."""
+    if leverages is None:
+        leverages = np.arange(1, RISK_MAX_LEVERAGE + 1)
+    p = Positions(side, entry, leverages, balance, mmr, fee, funding)
+    return pnl_grid(p, prices) / p.balance[:, None], evaluate(p)["liquidation"]
+
+
+def parse_number(text):
+    return float(text.replace(',', '.'))
+
+
+def parse_row(tokens):
+    """[long|short] <вход> <плечо> <баланс> [mmr=..] [fee=..] [funding=..] -> словарь параметров."""
+    row = {"side": LONG}
+    if tokens and tokens[0].lower() in SIDES:
+        row["side"] = SIDES[tokens[0].lower()]
+        tokens = tokens[1:]
+    numbers = [t for t in tokens if "=" not in t]
+    if len(numbers) != 3:
+        raise ValueError("expected <entry> <leverage> <balance>")
+    row["entry"], row["leverage"], row["balance"] = (parse_number(t) for t in numbers)
+    for token in tokens:
+        if "=" in token:
+            name, _, value = token.partition("=")
+            if name.lower() not in OPTIONS:
+                raise ValueError(f"unknown option {name}")
+            row[name.lower()] = parse_number(value)
+    return row
+
+
+def parse_csv(text):
+    """Строки CSV (с заголовком из CSV_COLUMNS или без него) -> список списков токенов."""
+    # разделитель — самый частый из ",;\t" в первой строке (excel в русской локали пишет ";")
+    first_line = text.lstrip().split("\n", 1)[0]
+    delimiter = max(",;\t", key=first_line.count)
+    rows = [[c.strip() for c in r] for r in csv.reader(StringIO(text), delimiter=delimiter) if any(c.strip() for c in r)]
+    if not rows or rows[0][0].lower() not in CSV_COLUMNS:
+        return [[c for c in r if c] for r in rows]
+    # с заголовком колонки могут идти в любом порядке, опции — необязательны
+    header = [c.lower() for c in rows[0]]
+    token_rows = []
+    for r in rows[1:]:
+        row = dict(zip(header, r))
+        tokens = [row["side"]] if row.get("side") else []
+        tokens += [row.get(c, "") for c in ("entry", "leverage", "balance")]
+        tokens += [f"{c}={row[c]}" for c in OPTIONS if row.get(c)]
+        token_rows.append([t for t in tokens if t])
+    return token_rows
+
+
+def build_positions(token_rows):
+    """Позиции из строк токенов; возвращает (Positions, [(номер строки, ошибка)]).
+    Строки с ошибками разбора или недопустимыми параметрами в позиции не попадают."""
+    rows, numbers, errors = [], [], []
+    for number, tokens in enumerate(token_rows[:RISK_MAX_POSITIONS], 1):
+        try:
+            rows.append(parse_row(tokens))
+            numbers.append(number)
+        except ValueError as e:
+            errors.append((number, str(e)))
+    if len(token_rows) > RISK_MAX_POSITIONS:
+        errors.append((RISK_MAX_POSITIONS + 1, f"more than {RISK_MAX_POSITIONS} positions"))
+    columns = {
+        name: [row.get(name, default) for row in rows]
+        for name, default in (("side", LONG), ("entry", 0), ("leverage", 0), ("balance", 0),
+                              ("mmr", RISK_MAINTENANCE_MARGIN), ("fee", RISK_FEE_RATE), ("funding", 0.0))
+    }
+    positions = Positions(**columns)
+
+    invalid = positions.invalid()
+    if len(invalid):
+        errors.extend((numbers[i], "invalid entry, leverage (1-%d), balance or option" % RISK_MAX_LEVERAGE)
+                      for i in invalid)
+        errors.sort()
+        positions = positions.take(np.setdiff1d(np.arange(len(positions)), invalid))
+    return positions, errors
+
+
+def _fmt(value):
+    return f"{value:.2f}" if abs(value) >= 1 else f"{value:.4g}"
+
+
+def format_table(p, result, lang='ru', moves=RISK_PRICE_MOVES):
+    """Компактная моноширинная таблица: позиция, объем, ликвидация и PnL при движении цены от входа."""
+    pnl = pnl_grid(p, p.entry[:, None] * (1 + np.asarray(moves))[None, :])
+    header = ["#", "side", "entry", "lev", "size", "liq", "liq%"] if lang != 'ru' else \
+        ["#", "сторона", "вход", "плечо", "объем", "ликв.", "ликв.%"]
+    lines = [header + [f"{m:+.0%}" for m in moves]]
+    for i in range(len(p)):
+        lines.append([
+            str(i + 1),
+            "long" if p.side[i] == LONG else "short",
+            _fmt(p.entry[i]),
+            f"{p.leverage[i]:g}x",
+            _fmt(result["notional"][i]),
+            _fmt(result["liquidation"][i]),
+            f"{result['distance'][i]:+.1%}",
+            *(_fmt(v) for v in pnl[i])
+        ])
+    widths = [max(len(row[c]) for row in lines) for c in range(len(lines[0]))]
+    return "\n".join(" ".join(cell.rjust(w) for cell, w in zip(row, widths)) for row in lines)
+
+
+def to_csv(p, result, moves=RISK_PRICE_MOVES):
+    """Полный результат для больших пакетов — файлом вместо сообщения."""
+    pnl = pnl_grid(p, p.entry[:, None] * (1 + np.asarray(moves))[None, :])
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(list(CSV_COLUMNS) + ["notional", "qty", "liquidation", "distance"]
+                    + [f"pnl_{m:+.0%}" for m in moves])
+    table = np.column_stack((
+        p.side, p.entry, p.leverage, p.balance, p.mmr, p.fee, p.funding,
+        result["notional"], result["qty"], result["liquidation"], result["distance"], pnl
+    ))
+    for row in table:
+        writer.writerow(["long" if row[0] == LONG else "short", *(f"{v:.8g}" for v in row[1:])])
+    return buf.getvalue().encode()
@@ -0,0 +1,178 @@
+import os
+import time
+import logging
+
+from aiogram import BaseMiddleware
+
+from cache import TTLCache
+
+# общее состояние нескольких инстансов бота: fsm, кэши, счетчики лимитов и обработанные апдейты.
+# без STATE_URL все живет в памяти процесса (разработка, один инстанс);
+# с redis://... — в redis, и воркеры на разных машинах видят одно и то же
+
+STATE_URL = os.getenv("STATE_URL", "")                              # redis://host:6379/0
+STATE_PREFIX = os.getenv("STATE_PREFIX", "cryptobot:")
+STATE_MEMORY_SIZE = int(os.getenv("STATE_MEMORY_SIZE", "100000"))   # ключей в памяти без redis
+UPDATE_DEDUP_TTL = float(os.getenv("UPDATE_DEDUP_TTL", "3600"))     # сколько помнить обработанные апдейты, секунды
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBackend:
+    shared = False
+
+    def __init__(self, max_size=STATE_MEMORY_SIZE):
+        self._data = TTLCache(ttl=3600, max_size=max_size)
+
+    async def get(self, key):
+        return self._data.get(key)
+
+    async def get_many(self, keys):
+        return [self._data.get(key) for key in keys]
+
+    async def set(self, key, value, ttl):
+        self._data.set(key, value, ttl)
+
+    async def set_many(self, items, ttl):
+        for key, value in items.items():
+            self._data.set(key, value, ttl)
+
+    async def add(self, key, value, ttl):
+        """Записывает, только если ключа нет; True, если записали."""
+        found, _ = self._data.lookup(key)
+        if not found:
+            self._data.set(key, value, ttl)
+        return not found
+
+    async def incr(self, key, ttl, amount=1):
+        value = (self._data.get(key) or 0) + amount
+        self._data.set(key, value, ttl)
+        return value
+
+    async def delete(self, key):
+        self._data.delete(key)
+
+    def fsm_storage(self):
+        from aiogram.fsm.storage.memory import MemoryStorage
+        return MemoryStorage()
+
+    async def close(self):
+        self._data.clear()
+
+
+class RedisBackend:
+    shared = True
+
+    def __init__(self, url, prefix=STATE_PREFIX):
+        # redis нужен только в этом режиме
+        from redis.asyncio import Redis
+        self.redis = Redis.from_url(url)
+        self.prefix = prefix
+
+    async def get(self, key):
+        return await self.redis.get(self.prefix + key)
+
+    async def get_many(self, keys):
+        if not keys:
+            return []
+        return await self.redis.mget([self.prefix + key for key in keys])
+
+    async def set(self, key, value, ttl):
+        await self.redis.set(self.prefix + key, value, px=int(ttl * 1000))
+
+    # пачка значений одним проходом по сети
+    async def set_many(self, items, ttl):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key, value in items.items():
+                pipe.set(self.prefix + key, value, px=int(ttl * 1000))
+            await pipe.execute()
+
+    async def add(self, key, value, ttl):
+        return bool(await self.redis.set(self.prefix + key, value, px=int(ttl * 1000), nx=True))
+
+    async def incr(self, key, ttl, amount=1):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.incrby(self.prefix + key, amount)
+            pipe.pexpire(self.prefix + key, int(ttl * 1000))
+            value, _ = await pipe.execute()
+        return value
+
+    async def delete(self, key):
+        await self.redis.delete(self.prefix + key)
+
+    def fsm_storage(self):
+        from aiogram.fsm.storage.redis import RedisStorage, DefaultKeyBuilder
+        return RedisStorage(self.redis, key_builder=DefaultKeyBuilder(prefix=f"{self.prefix}fsm"))
+
+    async def close(self):
+        await self.redis.aclose()
+
+
+def create_backend(url=STATE_URL, prefix=STATE_PREFIX):
+    if url:
+        return RedisBackend(url, prefix)
+    return MemoryBackend()
+
+
+# лимит на все инстансы: счетчик запросов в окне фиксированной длины и общая пауза после 429/RetryAfter.
+# локальный RateGovernor сглаживает поток внутри процесса, этот — не дает инстансам превысить лимит вместе
+class SharedRateLimit:
+    def __init__(self, backend, name, limit, window):
+        self.backend = backend
+        self.name = name
+        self.limit = max(1, int(limit))
+        self.window = window
+
+    async def wait_time(self):
+        """0, если запрос можно отправить (и он уже учтен), иначе сколько секунд ждать."""
+        now = time.time()
+        slot = int(now // self.window)
+        key = f"rate:{self.name}:{slot}"
+        try:
+            # во время паузы запрос не учитываем: ожидающие не должны занимать места в окне
+            blocked_until = await self.backend.get(f"rate:{self.name}:blocked")
+            if blocked_until is not None and float(blocked_until) > now:
+                return float(blocked_until) - now
+            count = await self.backend.incr(key, self.window * 2)
+            if count > self.limit:
+                # запрос не уйдет — возвращаем его место в окне
+                await self.backend.incr(key, self.window * 2, -1)
+                return (slot + 1) * self.window - now
+        except Exception as e:
+            # общее хранилище недоступно — остается только локальный лимит
+            logger.warning("shared rate limit %s unavailable: %s", self.name, e)
+        return 0.0
+
+    async def block(self, seconds):
+        try:
+            await self.backend.set(f"rate:{self.name}:blocked", str(time.time() + seconds).encode(), seconds)
+        except Exception as e:
+            logger.warning("shared rate limit %s unavailable: %s", self.name, e)
+
+
+# апдейт, который телеграм доставил повторно (в том числе на другой инстанс), обрабатывается один раз
+class UpdateDedupMiddleware(BaseMiddleware):
+    def __init__(self, backend, ttl=UPDATE_DEDUP_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.duplicates = 0
+
+    async def __call__(self, handler, event, data):
+        try:
+            first = await self.backend.add(f"update:{data['bot'].id}:{event.update_id}", b"1", self.ttl)
+        except Exception as e:
+            logger.warning("update dedup unavailable: %s", e)
+            first = True
+        if not first:
+            self.duplicates += 1
+            return None
+        return await handler(event, data)
+
+
+backend = create_backend()
+# то, что имеет смысл класть в общее хранилище только при нескольких инстансах
+shared_backend = backend if backend.shared else None
+
+
+def shared_rate_limit(name, limit, window):
+    return SharedRateLimit(backend, name, limit, window) if backend.shared else None
@@ -0,0 +1,12 @@
+import asyncio
+
+
+# остановка фоновой задачи: отменяем и ждем, пока она выйдет
+async def cancel_task(task):
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
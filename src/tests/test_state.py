@@ -0,0 +1,107 @@
+import asyncio
+from types import SimpleNamespace
+
+from benchmarks.resp_server import RespServer
+from state import RedisBackend, SharedRateLimit, UpdateDedupMiddleware
+
+# общее состояние против локальной замены redis: тот же протокол, что у настоящего сервера
+
+WINDOW = 10 ** 9    # окно лимита, которое не закончится посреди теста
+
+
+def with_redis(test):
+    def run():
+        async def main():
+            server = RespServer()
+            port = await server.start()
+            backend = RedisBackend(f"redis://127.0.0.1:{port}/0", prefix="test:")
+            try:
+                await test(backend, server)
+            finally:
+                await backend.close()
+                await server.stop()
+        asyncio.run(main())
+    run.__name__ = test.__name__
+    return run
+
+
+@with_redis
+async def test_get_set_many(backend, server):
+    assert await backend.get("missing") is None
+    await backend.set("a", b"1", 60)
+    await backend.set_many({"b": b"2", "c": b"3"}, 60)
+    assert await backend.get_many(["a", "b", "missing", "c"]) == [b"1", b"2", None, b"3"]
+    assert b"test:a" in server._data
+    await backend.delete("a")
+    assert await backend.get("a") is None
+
+
+@with_redis
+async def test_add_only_once(backend, server):
+    assert await backend.add("k", b"1", 60)
+    assert not await backend.add("k", b"2", 60)
+    assert await backend.get("k") == b"1"
+
+
+@with_redis
+async def test_ttl(backend, server):
+    await backend.set("short", b"1", 0.05)
+    await backend.set("long", b"1", 60)
+    assert await backend.incr("counter", 0.05) == 1
+    await asyncio.sleep(0.1)
+    assert await backend.get("short") is None
+    assert await backend.get("long") == b"1"
+    # счетчик с истекшим сроком начинается заново
+    assert await backend.incr("counter", 60) == 1
+
+
+@with_redis
+async def test_incr(backend, server):
+    assert [await backend.incr("n", 60) for _ in range(3)] == [1, 2, 3]
+    assert await backend.incr("n", 60, -1) == 2
+    assert await backend.get("n") == b"2"
+
+
+@with_redis
+async def test_rate_limit_window(backend, server):
+    limit = SharedRateLimit(backend, "api", 3, WINDOW)
+    other = SharedRateLimit(backend, "api", 3, WINDOW)    # тот же лимит в другом инстансе
+    waits = [await limit.wait_time(), await other.wait_time(), await limit.wait_time(), await other.wait_time()]
+    assert waits[:3] == [0.0, 0.0, 0.0]
+    assert waits[3] > 0
+    # отказ не занимает место в окне
+    assert await backend.get("rate:api:1") == b"3"
+
+
+@with_redis
+async def test_rate_limit_blocked(backend, server):
+    limit = SharedRateLimit(backend, "api", 3, WINDOW)
+    await limit.block(30)
+    for _ in range(5):
+        assert 29 < await limit.wait_time() <= 30
+    # пока действует пауза, запросы не учитываются
+    assert await backend.get("rate:api:1") is None
+
+
+@with_redis
+async def test_rate_limit_unavailable(backend, server):
+    await server.stop()
+    await backend.redis.connection_pool.disconnect()
+    assert await SharedRateLimit(backend, "api", 3, WINDOW).wait_time() == 0.0
+
+
+@with_redis
+async def test_update_dedup_across_workers(backend, server):
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event.update_id)
+        return "ok"
+
+    workers = [UpdateDedupMiddleware(backend), UpdateDedupMiddleware(backend)]
+    data = {"bot": SimpleNamespace(id=42)}
+    results = [await worker(handler, SimpleNamespace(update_id=update_id), data)
+               for update_id in (1, 2, 1) for worker in workers]
+    assert handled == [1, 2]
+    assert results == ["ok", None, "ok", None, None, None]
+    assert [worker.duplicates for worker in workers] == [1, 3]
@@ -0,0 +1,103 @@
+import os
+import signal
+import logging
+import asyncio
+import multiprocessing
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+# режим вебхука: апдейты приходят POST-запросами в aiohttp,
+# несколько процессов слушают один порт через SO_REUSEPORT.
+# /metrics на публичном порту нет: каждый воркер отдает свои метрики на localhost
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")                      # polling | webhook
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")                       # публичный адрес, например https://bot.example.com
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+WEBHOOK_SHUTDOWN_TIMEOUT = float(os.getenv("WEBHOOK_SHUTDOWN_TIMEOUT", "30"))
+
+logger = logging.getLogger(__name__)
+
+
+async def health(request):
+    return web.json_response({"status": "ok", "pid": os.getpid()})
+
+
+def create_app(dp, bot, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+    app = web.Application()
+    # SimpleRequestHandler сам проверяет заголовок X-Telegram-Bot-Api-Secret-Token
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret or None).register(app, path=path)
+    app.router.add_get("/health", health)
+    # startup/shutdown диспетчера привязываются к жизненному циклу приложения
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+# один воркер: run_app сам обрабатывает SIGINT/SIGTERM и дожидается текущих запросов
+def serve(dp, bot, host=WEBHOOK_HOST, port=WEBHOOK_PORT, reuse_port=False):
+    web.run_app(
+        create_app(dp, bot),
+        host=host,
+        port=port,
+        reuse_port=reuse_port,
+        shutdown_timeout=WEBHOOK_SHUTDOWN_TIMEOUT,
+        print=None
+    )
+
+
+async def register_webhook(bot, url=WEBHOOK_URL, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+    try:
+        if url:
+            await bot.set_webhook(f"{url.rstrip('/')}{path}", secret_token=secret or None, drop_pending_updates=True)
+        else:
+            logger.warning("WEBHOOK_URL is not set, webhook is not registered in Telegram")
+    finally:
+        await bot.session.close()
+
+
+# воркеры в своей группе процессов: сигнал всей группе родителя не должен
+# прилетать им второй раз поверх пересланного
+def _worker_main(worker, index):
+    os.setpgrp()
+    worker(index)
+
+
+def run_webhook(bot, worker, prepare=None, workers=WEBHOOK_WORKERS):
+    """Выполняет prepare(), регистрирует вебхук и запускает worker(index) в workers процессах."""
+    # общая подготовка (например, схема бд) делается один раз до запуска воркеров,
+    # иначе процессы гоняются друг с другом
+    if prepare is not None:
+        asyncio.run(prepare())
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET is not set, anyone who knows the webhook path can send updates")
+    asyncio.run(register_webhook(bot))
+
+    if workers <= 1:
+        worker(0)
+        return
+
+    processes = [multiprocessing.Process(target=_worker_main, args=(worker, i), name=f"webhook-worker-{i}") for i in range(workers)]
+    for process in processes:
+        process.start()
+
+    # SIGTERM/SIGINT пересылаем воркерам один раз, они завершаются штатно;
+    # повторный сигнал прервал бы их graceful shutdown
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if stopping:
+            return
+        stopping = True
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for process in processes:
+        process.join()